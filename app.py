@@ -1,43 +1,102 @@
 # app.py
-from flask import Flask, render_template, send_from_directory,request, send_file, redirect
+"""サイト全体のアプリケーション
+
+create_app() が静的なページ・ZIP作成（このモジュール）、色の分析（image.py）、
+Dropboxへのアップロード（dropbox_app.py）のブループリントを1つのアプリにまとめる。
+起動を速くするため、重いモジュールや後片付けのスレッドは最初に使うときに読み込む・起動する。
+
+使い方:
+    flask --app app run
+    gunicorn 'app:create_app()'
+    # 色の分析に使うsklearnをマスターで読み込み、フォークしたワーカーとメモリを共有する
+    PRELOAD_IMAGE_MODULES=1 gunicorn --preload 'app:create_app()'
+    # 計測値は /metrics（Prometheusのテキスト形式）。集計はワーカープロセスごと
+"""
+from flask import Blueprint, Flask, current_app, render_template, request, send_file, redirect, Response, stream_with_context, jsonify, url_for, abort
 import os
+import re
+import shlex
+import sys
+import threading
 
+import dropbox_app
+import image
+import ingest
+import metrics
+import responsive_images
+import static_assets
+import temp_reaper
+from image_pipeline import ImagePipeline, ImageStore, OUTPUT_MIMETYPE as IMAGE_OUTPUT_MIMETYPE
+from ingest import upload_digest
+from page_cache import pages
 from zip_handler import ZipHandler
+from zip_jobs import ZipJobQueue, QueueFullError
+
+bp = Blueprint('main', __name__)
+
+# ZIPハンドラーとジョブキュー、画像の保存先はディレクトリや後片付けのスレッドを作るため、
+# 最初に使うときに作成する（gunicorn --preload でもフォークした後のワーカーで作られる）
+_zip_handler = None
+_zip_job_queue = None
+_image_pipeline = None
+_lazy_lock = threading.Lock()
+
 
-app = Flask(__name__, static_url_path='/static')
+def get_zip_handler():
+    global _zip_handler, _zip_job_queue
+    with _lazy_lock:
+        if _zip_handler is None:
+            # ZIP_COMPRESS_WORKERSが2以上なら、各メンバーをスレッドで並列に圧縮する
+            _zip_handler = ZipHandler(compress_workers=current_app.config['ZIP_COMPRESS_WORKERS'])
+            # ZIP作成をバックグラウンドで行うジョブキュー
+            _zip_job_queue = ZipJobQueue(_zip_handler)
+        return _zip_handler
 
-# ZIPハンドラーのインスタンス作成
-zip_handler_instance = ZipHandler()  # インスタンスを作成
 
-@app.route('/')
+def get_zip_job_queue():
+    get_zip_handler()
+    return _zip_job_queue
+
+
+def get_image_pipeline():
+    """アップロードされた画像から作った表示用の画像とサムネイルを、内容のハッシュで保存する"""
+    global _image_pipeline
+    with _lazy_lock:
+        if _image_pipeline is None:
+            _image_pipeline = ImagePipeline(ImageStore('image_store'))
+        return _image_pipeline
+
+@bp.route('/')
+@pages.page
 def index():
     return render_template('index.html')
 
-@app.route('/shibuya/hotetu/gikoubutu.html')
+@bp.route('/shibuya/hotetu/gikoubutu.html')
+@pages.page
 def gikoubutu():
     return render_template('gikoubutu.html')
 
-@app.route('/shibuya/recruitment.html')
+@bp.route('/shibuya/recruitment.html')
+@pages.page
 def recruitment():
     return render_template('recruitment.html')
 
-@app.route('/shibuya/rootreplica.html')
+@bp.route('/shibuya/rootreplica.html')
+@pages.page
 def rootreplica():
     return render_template('rootreplica.html')
 
-@app.route('/shibuya/gakukotu.html')
+@bp.route('/shibuya/gakukotu.html')
+@pages.page
 def gakukotu():
     return render_template('gakukotu.html')
 
-@app.route('/colors.html', methods=['GET', 'POST'])
-def colors():
-    return render_template('colors.html')
-
-@app.route('/zip_handler.html')
+@bp.route('/zip_handler.html')
+@pages.page
 def zip_handler():
     return render_template('zip_handler.html')
 
-@app.route('/upload', methods=['GET', 'POST'])
+@bp.route('/upload', methods=['GET', 'POST'])
 def upload_file():
     if 'files[]' not in request.files:
         return 'ファイルがありません', 400
@@ -47,18 +106,82 @@ def upload_file():
         return 'ファイルが選択されていません', 400
 
     try:
+        if request.args.get('mode') == 'job':
+            # ZIP作成はワーカーに任せ、ジョブIDだけをすぐに返す
+            job = get_zip_job_queue().submit(files)
+            return jsonify({
+                **job.to_dict(),
+                'status_url': url_for('.upload_job_status', job_id=job.id),
+                'download_url': url_for('.upload_job_download', job_id=job.id),
+            }), 202
+
+        if request.args.get('mode') == 'stream':
+            # ZIPを生成しながらそのままクライアントへ送る（一時ファイルを作らない）
+            return Response(
+                stream_with_context(get_zip_handler().stream_files(files)),
+                mimetype='application/zip',
+                headers={'Content-Disposition': 'attachment; filename=files.zip'}
+            )
+
         # インスタンスのメソッドを呼び出す
-        zip_path = zip_handler_instance.process_files(files)
-        return send_file(
-            zip_path,
-            as_attachment=True,
-            download_name='files.zip'
-        )
+        handler = get_zip_handler()
+        zip_path = handler.process_files(files)
+        try:
+            # send_fileがファイルを開くまではリーパーやキャッシュに削除させない
+            # （開いた後に削除されても、送信は最後まで続けられる）
+            # 相対パスはアプリのディレクトリからと解釈されるので、作業ディレクトリからの絶対パスにする
+            return send_file(
+                os.path.abspath(zip_path),
+                as_attachment=True,
+                download_name='files.zip'
+            )
+        finally:
+            handler.release(zip_path)
+    except QueueFullError as e:
+        return str(e), 503
     except Exception as e:
         print(f"Error occurred: {str(e)}")
         return str(e), 500
+
+@bp.route('/upload/cache')
+def upload_cache_stats():
+    return jsonify(get_zip_handler().cache.stats())
+
+@bp.route('/upload/reaper')
+def upload_reaper_stats():
+    return jsonify(get_zip_handler().reaper.stats())
+
+# ジョブの記録は作成したプロセスにだけあるため、見つからない理由を返す
+JOB_NOT_FOUND = ('ジョブが見つかりません。ジョブはZIPファイルを作成したサーバープロセスで1時間だけ保持されるため、'
+                 '期限が切れたか、別のプロセスに届いた可能性があります')
+
+@bp.route('/upload/jobs/<job_id>')
+def upload_job_status(job_id):
+    job = get_zip_job_queue().get(job_id)
+    if job is None:
+        return jsonify({'error': JOB_NOT_FOUND}), 404
+    return jsonify(job.to_dict())
+
+@bp.route('/upload/jobs/<job_id>/download')
+def upload_job_download(job_id):
+    job = get_zip_job_queue().get(job_id)
+    if job is None:
+        abort(404, description=JOB_NOT_FOUND)
+    if job.status != 'done':
+        abort(404)
+    # ZIPはジョブの記録がある間pinされているが、記録の削除と重なってもファイルを開くまでは削除させない
+    with get_zip_handler().reaper.pinned(job.zip_path):
+        if not os.path.exists(job.zip_path):
+            abort(404)
+        # conditional=TrueでRangeリクエストに対応し、中断したダウンロードを再開できるようにする
+        return send_file(
+            job.zip_path,
+            as_attachment=True,
+            download_name='files.zip',
+            conditional=True
+        )
     
-@app.route('/upload-images', methods=['GET', 'POST'])
+@bp.route('/upload-images', methods=['GET', 'POST'])
 def upload_images():
     if 'images[]' not in request.files:
         return 'ファイルがありません', 400
@@ -68,21 +191,128 @@ def upload_images():
         return 'ファイルが選択されていません', 400
 
     try:
-        # 画像処理関連のコードをここに書く
-        # 例：保存先ディレクトリを作成したり、画像のリサイズなど
-        
-        # 成功したら結果ページにリダイレクトするか、成功メッセージを返す
-        return '画像がアップロードされました', 200
+        result = get_image_pipeline().run((file.filename, file.stream, upload_digest(file)) for file in files)
+        for item in result['files']:
+            for derivative in item.get('derivatives', {}).values():
+                derivative['url'] = url_for('.image_store_object', name=derivative['file'])
+        # 一部の画像が処理できなかった場合は207で個別の結果を返す
+        ok = all(item['status'] in ('stored', 'duplicate') for item in result['files'])
+        return jsonify(result), 200 if ok else 207
     except Exception as e:
         print(f"Error occurred: {str(e)}")
         return str(e), 500
 
-@app.route('/zoom')
+@bp.route('/upload-images/<digest>')
+def upload_images_lookup(digest):
+    entry = get_image_pipeline().store.lookup(digest)
+    if entry is None:
+        abort(404)
+    return jsonify(entry)
+
+@bp.route('/images/store/<name>')
+def image_store_object(name):
+    # 名前は内容のハッシュなので、内容が変わることはない
+    if not re.fullmatch(r'[0-9a-f]{64}\.[a-z]+', name):
+        abort(404)
+    path = get_image_pipeline().store.path(name)
+    if not os.path.isfile(path):
+        abort(404)
+    response = send_file(os.path.abspath(path), mimetype=IMAGE_OUTPUT_MIMETYPE, etag=name.split('.')[0][:32],
+                         max_age=365 * 24 * 3600, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@bp.route('/zoom')
 def zoom_redirect():
     return redirect('https://us06web.zoom.us/j/84262814694')
 
+def _worker_count():
+    """gunicornのワーカー数（WEB_CONCURRENCY、GUNICORN_CMD_ARGS、コマンドラインの-w/--workers）。分からなければNone"""
+    args = shlex.split(os.environ.get('GUNICORN_CMD_ARGS', ''))
+    if 'gunicorn' in os.path.basename(sys.argv[0]):
+        args += sys.argv[1:]
+    workers = os.environ.get('WEB_CONCURRENCY')
+    for i, arg in enumerate(args):
+        if arg in ('-w', '--workers') and i + 1 < len(args):
+            workers = args[i + 1]
+        elif arg.startswith('--workers='):
+            workers = arg.split('=', 1)[1]
+        elif arg.startswith('-w') and arg[2:].isdigit():
+            workers = arg[2:]
+    try:
+        return int(workers) if workers is not None else None
+    except ValueError:
+        return None
+
+
+def create_app(config=None):
+    """アプリケーションを作成する
+
+    PRELOAD_IMAGE_MODULES（環境変数 PRELOAD_IMAGE_MODULES=1）を有効にすると、色の分析に使う
+    sklearnをここで読み込む。gunicorn --preload と組み合わせて、マスターで一度だけ読み込む
+    """
+    app = Flask(__name__, static_url_path='/static')
+    app.config.from_mapping(
+        SECRET_KEY=os.environ.get('SECRET_KEY', 'your_secret_key'),  # セッションのための秘密鍵
+        PRELOAD_IMAGE_MODULES=os.environ.get('PRELOAD_IMAGE_MODULES') == '1',
+        # ZIPのメンバーを並列に圧縮するスレッド数（zlibは圧縮中にGILを解放する）。
+        # 並列に圧縮する分はメモリに読み込むので、デフォルトの1では使わない
+        ZIP_COMPRESS_WORKERS=int(os.environ.get('ZIP_COMPRESS_WORKERS', 1)),
+        # アップロードの上限（リクエスト全体と1ファイル）
+        MAX_CONTENT_LENGTH=8 * 1024 * 1024 * 1024,
+        MAX_FILE_SIZE=2 * 1024 * 1024 * 1024,
+    )
+    if config:
+        app.config.update(config)
+
+    # 処理の段階ごとの時間を /metrics で公開し、遅いリクエストをログに出す
+    # （METRICS_ENABLED=0 で無効、PROFILE_REQUESTS=1 で ?profile=1 のリクエストをプロファイルする）
+    metrics.init_app(app)
+
+    # アップロードは一時ファイルへ順次書き出し、受信中にサイズの上限とハッシュを計算する
+    # （上限はapp.configの値を使う。色の分析とDropboxのブループリントはそれぞれの上限を設定する）
+    ingest.init_app(app)
+    # 一時ファイルの容量の上限を、アップロードの上限より小さくしない
+    temp_reaper.init_app(app)
+
+    # テンプレートで responsive_img() を使えるようにする（画像は python responsive_images.py で作成）
+    responsive_images.init_app(app)
+
+    # テンプレートの url_for('static', ...) を内容のハッシュ付きのURLにする（python static_assets.py で作成）
+    static_assets.init_app(app)
+
+    # 固定の内容のページは描画結果をメモリに保持する。テンプレートか、URLを決めるマニフェストが
+    # 更新されたら描画し直す（flask --app app export-pages で静的なHTMLとして書き出せる）
+    pages.init_app(app, watch_files=[
+        os.path.join(app.static_folder, static_assets.OUTPUT_DIR, static_assets.MANIFEST_NAME),
+        os.path.join(app.static_folder, responsive_images.OUTPUT_DIR, responsive_images.MANIFEST_NAME),
+    ])
+
+    app.register_blueprint(bp)
+    app.register_blueprint(image.bp)
+    app.register_blueprint(dropbox_app.bp, url_prefix='/dropbox')
+
+    if app.config['PRELOAD_IMAGE_MODULES']:
+        image.preload()
+
+    # ジョブ・結果画像・一括アップロードの結果はプロセスのメモリにあるので、ワーカーは1つにする
+    workers = _worker_count()
+    if workers is not None and workers > 1:
+        print(f"Warning: running with {workers} workers. Upload jobs, color analysis results and Dropbox "
+              f"batch results are kept per process, so requests for them will 404 on other workers. "
+              f"Run with a single worker (gunicorn -w 1 --threads N).")
+    return app
+
+# 本番でも1つのプロセスで動かし、同時に来るリクエストはスレッドで処理する:
+#     gunicorn -w 1 --threads 8 'app:create_app()'
+# 次の状態はプロセスのメモリに置いているので、ワーカーを複数にすると、別のワーカーに
+# 届いたリクエストからは見えずに404になる（ワーカーが複数なのを検出すると起動時に警告を出す）
+#   - ZIP作成のジョブ（zip_jobs。状態の確認とダウンロード）
+#   - 色の分析の結果画像（image.result_store。/colors/result/<id>）
+#   - Dropboxの一括アップロードの結果（dropbox_app.batch_uploads。/dropbox/upload/batch/<id>）
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
 
 
 # Directory structure:
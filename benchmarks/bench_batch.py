@@ -0,0 +1,66 @@
+# benchmarks/bench_batch.py
+"""一括分析（/colors/batch）の画像数ごとのスループット（枚/秒）
+
+static/images 以下の画像をまとめて送信し、NDJSONを最後の行まで受け取るまでの時間を測る。
+キャッシュの影響を除くため、毎回palette_cacheを空にする。
+
+使い方:
+    python benchmarks/bench_batch.py [--sizes 1 4 16 64] [--workers N]
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--workers', type=int, default=None, help='ワーカープロセス数（デフォルトはCPU数）')
+    parser.add_argument('--format', default='WEBP')
+    args = parser.parse_args()
+
+    # uploads/ を作業用ディレクトリに作らせる
+    os.chdir(tempfile.mkdtemp())
+    import image
+    from app import create_app
+    from image_executor import ImageExecutor
+    from palette_cache import PaletteCache
+
+    image.image_executor = ImageExecutor(max_workers=args.workers, timeout=120)
+    client = create_app().test_client()
+
+    paths = sorted(glob.glob(os.path.join(ROOT, 'static', 'images', '**', '*.jpg'), recursive=True))
+    contents = [(os.path.basename(path), open(path, 'rb').read()) for path in paths]
+
+    # ワーカープロセスの起動を測定に含めない
+    client.post('/colors/batch', data={'images[]': [(io.BytesIO(contents[0][1]), contents[0][0])]},
+                content_type='multipart/form-data')
+
+    print(f"workers={image.image_executor.max_workers}")
+    print(f"{'batch':>6} {'seconds':>8} {'images/s':>9} {'errors':>7}")
+    for size in args.sizes:
+        batch = [contents[i % len(contents)] for i in range(size)]
+        image.palette_cache = PaletteCache()
+        start = time.perf_counter()
+        response = client.post(
+            '/colors/batch',
+            data={'images[]': [(io.BytesIO(data), name) for name, data in batch], 'format': args.format},
+            content_type='multipart/form-data')
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        elapsed = time.perf_counter() - start
+        errors = sum(1 for line in lines if 'error' in line)
+        print(f"{size:>6} {elapsed:>8.2f} {size / elapsed:>9.1f} {errors:>7}")
+
+    image.image_executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
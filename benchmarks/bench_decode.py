@@ -0,0 +1,114 @@
+# benchmarks/bench_decode.py
+"""image.process_image のデコード回数削減の効果測定（ピークRSSと処理時間）
+
+旧実装（cv2とPILで2回フル解像度デコード）と現在の実装を、
+画像ごと・方式ごとに別プロセスで実行してピークRSSを比較する。
+
+使い方:
+    python benchmarks/bench_decode.py [--megapixels 12 24 48] [--repeat N]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def legacy_process_image(img_path):
+    """変更前のprocess_imageと同じ処理（比較用）"""
+    import cv2
+    import numpy as np
+    from PIL import Image
+    from sklearn.cluster import KMeans
+
+    cv2_img = cv2.cvtColor(cv2.imread(img_path), cv2.COLOR_BGR2RGB)
+    height, width = cv2_img.shape[:2]
+    if max(height, width) > 1000:
+        scale = 1000 / max(height, width)
+        cv2_img = cv2.resize(cv2_img, (int(width * scale), int(height * scale)))
+    cluster = KMeans(n_clusters=5, random_state=42)
+    cluster.fit(X=cv2_img.reshape((-1, 3)))
+
+    img = Image.open(fp=img_path)
+    if img.width > 500:
+        img = img.resize((500, int(img.height * 500 / img.width)), Image.LANCZOS)
+    return cluster.cluster_centers_, img
+
+
+def current_process_image(img_path):
+    from image import process_image
+    return process_image(img_path)
+
+
+def make_photo(path, megapixels):
+    """写真に近いグラデーションとノイズを持つJPEGを作る"""
+    import numpy as np
+    from PIL import Image
+
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+    noise = rng.integers(0, 32, size=(height, width, 3))
+    Image.fromarray((base + noise).clip(0, 255).astype('uint8')).save(path, quality=90)
+
+
+def peak_rss_kb():
+    """このプロセスのピークRSS（KB）
+
+    ru_maxrssはexec前の親プロセスの値を引き継ぐため、Linuxでは/procのVmHWMを優先する
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def child(variant, img_path, repeat):
+    func = legacy_process_image if variant == 'legacy' else current_process_image
+    func(img_path)  # ウォームアップ（importなど）
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(img_path)
+        timings.append(time.perf_counter() - start)
+    print(json.dumps({'latency': min(timings), 'peak_rss_mb': peak_rss_kb() / 1024}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--megapixels', type=float, nargs='+', default=[12, 24])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--child', nargs=2, metavar=('VARIANT', 'PATH'))
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child[0], args.child[1], args.repeat)
+        return
+
+    print(f"{'MP':>5} {'variant':>8} {'latency[s]':>11} {'peak RSS[MB]':>13}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for megapixels in args.megapixels:
+            path = os.path.join(tmp, f'{megapixels}mp.jpg')
+            make_photo(path, megapixels)
+            for variant in ('legacy', 'current'):
+                result = subprocess.run(
+                    [sys.executable, __file__, '--child', variant, path, '--repeat', str(args.repeat)],
+                    check=True, capture_output=True, text=True, cwd=tmp)
+                stats = json.loads(result.stdout.strip().splitlines()[-1])
+                print(f"{megapixels:>5g} {variant:>8} {stats['latency']:>11.3f} {stats['peak_rss_mb']:>13.1f}")
+
+
+if __name__ == '__main__':
+    main()
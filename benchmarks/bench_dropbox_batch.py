@@ -0,0 +1,88 @@
+# benchmarks/bench_dropbox_batch.py
+"""複数ファイルのDropboxアップロードの比較（ローカルのスタブに対して実行）
+
+1ファイルずつアップロードして共有リンクを同期的に作る方式（変更前のフォームを
+ファイルの数だけ送るのと同じ）と、DropboxUploader.upload_batch（並列にセッションへ送り、
+finish_batchでまとめてコミットし、共有リンクは後から作る）を比較する。
+スタブの疑似遅延はネットワークの往復時間の代わりで、並列化の効果はここに現れる。
+
+使い方:
+    python benchmarks/bench_dropbox_batch.py [--files 24] [--size-mb 2] [--latency 0.05] [--workers 1 4 8] [--drop-every 5]
+"""
+import argparse
+import hashlib
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+sys.path.insert(0, ROOT)
+
+import dropbox_uploader
+from dropbox_uploader import DropboxUploader
+from fake_dropbox import FakeDropboxServer
+
+
+def sequential(uploader, datas, paths):
+    """1ファイルずつアップロードし、その都度共有リンクを作る"""
+    for data, path in zip(datas, paths):
+        uploader.upload(io.BytesIO(data), path)
+        uploader.client.sharing_create_shared_link_with_settings(path)
+
+
+def batch(uploader, datas, paths, workers):
+    """並列にアップロードしてまとめてコミットし、共有リンクが揃うまで待つ"""
+    link_executor = ThreadPoolExecutor(max_workers=2)
+    result = uploader.upload_batch([(io.BytesIO(data), path) for data, path in zip(datas, paths)],
+                                   max_workers=workers, link_executor=link_executor)
+    commit_seconds = result.seconds
+    link_executor.shutdown(wait=True)
+    summary = result.to_dict()
+    if summary['failed_files'] or summary['links_pending']:
+        raise SystemExit(f'batch failed: {summary}')
+    return commit_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=24)
+    parser.add_argument('--size-mb', type=float, default=2)
+    parser.add_argument('--chunk-mb', type=float, default=4)
+    parser.add_argument('--latency', type=float, default=0.05, help='1リクエストあたりの疑似遅延（秒）')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--drop-every', type=int, default=None)
+    args = parser.parse_args()
+
+    datas = [os.urandom(int(args.size_mb * 1024 * 1024)) for _ in range(args.files)]
+    total_mb = args.size_mb * args.files
+    chunk_size = int(args.chunk_mb * 1024 * 1024)
+    variants = [('sequential', None)] + [(f'batch x{workers}', workers) for workers in args.workers]
+
+    print(f"{args.files} files x {args.size_mb:g}MB, latency {args.latency * 1000:.0f}ms")
+    print(f"{'variant':>12} {'commit[s]':>10} {'total[s]':>9} {'MB/s':>8} {'requests':>9} {'dropped':>8}")
+    for name, workers in variants:
+        with FakeDropboxServer(latency=args.latency, drop_every=args.drop_every) as server:
+            dropbox_uploader.forget_client('token')
+            client = dropbox_uploader.get_client('token', session=server.session(max_connections=16))
+            uploader = DropboxUploader(client, chunk_size=chunk_size, retry_wait=0.01)
+            paths = [f'/bench/{name.replace(" ", "_")}/{i:03d}.bin' for i in range(args.files)]
+            start = time.perf_counter()
+            if workers is None:
+                sequential(uploader, datas, paths)
+                commit_seconds = time.perf_counter() - start
+            else:
+                commit_seconds = batch(uploader, datas, paths, workers)
+            total_seconds = time.perf_counter() - start
+
+            for data, path in zip(datas, paths):
+                if hashlib.sha256(server.files[path]).digest() != hashlib.sha256(data).digest():
+                    raise SystemExit(f'{name}: uploaded content of {path} does not match')
+            print(f"{name:>12} {commit_seconds:>10.2f} {total_seconds:>9.2f} {total_mb / commit_seconds:>8.1f} "
+                  f"{sum(server.requests.values()):>9} {server.dropped:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# benchmarks/bench_dropbox_upload.py
+"""Dropboxへのアップロード方式の比較（ローカルのスタブに対して実行）
+
+旧実装（リクエストごとにクライアントを作り、users_get_current_accountを呼んでから
+ファイル全体をfiles_uploadで送る）と、DropboxUploader（クライアントを使い回し、
+チャンクごとにアップロードセッションで送る）の処理時間とリクエスト数を比較する。
+--drop-everyを指定すると、スタブがN回に1回応答を返さずに接続を切り、
+受け取り済みの位置から再送して内容が一致することを確認する。
+
+使い方:
+    python benchmarks/bench_dropbox_upload.py [--sizes-mb 1 20 100] [--chunk-mb 8] [--latency 0.01] [--drop-every 3]
+"""
+import argparse
+import hashlib
+import io
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+sys.path.insert(0, ROOT)
+
+import dropbox
+from dropbox.files import WriteMode
+
+import dropbox_uploader
+from dropbox_uploader import DropboxUploader
+from fake_dropbox import FakeDropboxServer
+
+
+def legacy_upload(server, stream, path):
+    """変更前のupload_fileと同じ処理（比較用）"""
+    dbx = dropbox.Dropbox('token', session=server.session())
+    dbx.users_get_current_account()
+    return dbx.files_upload(stream.read(), path, mode=WriteMode.overwrite)
+
+
+def current_upload(server, stream, path, chunk_size):
+    dbx = dropbox_uploader.get_client('token', session=server.session())
+    uploader = DropboxUploader(dbx, chunk_size=chunk_size, retry_wait=0.01)
+    return uploader.upload(stream, path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes-mb', type=float, nargs='+', default=[1, 20, 100])
+    parser.add_argument('--chunk-mb', type=float, default=8)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.01, help='1リクエストあたりの疑似遅延（秒）')
+    parser.add_argument('--drop-every', type=int, default=None)
+    args = parser.parse_args()
+    chunk_size = int(args.chunk_mb * 1024 * 1024)
+
+    print(f"{'size[MB]':>9} {'variant':>8} {'latency[s]':>11} {'MB/s':>8} {'requests':>9} {'dropped':>8}")
+    for size_mb in args.sizes_mb:
+        data = os.urandom(int(size_mb * 1024 * 1024))
+        expected = hashlib.sha256(data).hexdigest()
+        variants = [('legacy', legacy_upload), ('current', lambda s, f, p: current_upload(s, f, p, chunk_size))]
+        for name, func in variants:
+            # 旧実装は再送の仕組みを持たないので、接続を切るスタブでは測らない
+            drop_every = args.drop_every if name == 'current' else None
+            with FakeDropboxServer(latency=args.latency, drop_every=drop_every) as server:
+                dropbox_uploader.forget_client('token')
+                timings = []
+                for i in range(args.repeat):
+                    path = f'/bench/{name}_{i}.bin'
+                    start = time.perf_counter()
+                    func(server, io.BytesIO(data), path)
+                    timings.append(time.perf_counter() - start)
+                    if hashlib.sha256(server.files[path]).hexdigest() != expected:
+                        raise SystemExit(f'{name}: uploaded content does not match')
+                best = min(timings)
+                requests_per_upload = sum(server.requests.values()) / args.repeat
+                print(f"{size_mb:>9g} {name:>8} {best:>11.3f} {size_mb / best:>8.1f} "
+                      f"{requests_per_upload:>9.1f} {server.dropped:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# benchmarks/bench_image_pipeline.py
+"""image_pipeline の効果測定（合成したJPEGを一度に処理する）
+
+写真に近い大きさのJPEGを作り、段ごとのワーカー数を変えて ImagePipeline.run の
+処理時間と1秒あたりの枚数、段ごとの処理時間を比べる。保存先は毎回空の一時ディレクトリ。
+ワーカー数1は、1枚ずつ順番に処理する場合とほぼ同じ。
+
+使い方:
+    python benchmarks/bench_image_pipeline.py [--images 100] [--size 4000x3000] [--workers 1 2 4]
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+from PIL import Image
+
+from image_pipeline import ImagePipeline, ImageStore, STAGES
+
+
+def make_jpeg(width, height, seed):
+    """グラデーションにノイズを加えた画像（内容が重複しないようseedを変える）"""
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    base = np.stack([x + 0 * y, y + 0 * x, (x + y) / 2], axis=-1)
+    noise = rng.normal(0, 12, (height // 8, width // 8, 3)).repeat(8, axis=0).repeat(8, axis=1)
+    pixels = np.clip(base + noise[:height, :width], 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=100)
+    parser.add_argument('--size', default='4000x3000')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.size.split('x'))
+    # 作成に時間がかかるので、数種類を作ってバイト列の末尾を変えて使い回す
+    samples = [make_jpeg(width, height, seed) for seed in range(min(args.images, 8))]
+    datas = [samples[i % len(samples)] + i.to_bytes(4, 'big') for i in range(args.images)]
+    total_mb = sum(len(data) for data in datas) / 1024 / 1024
+    print(f"{args.images} images {args.size}, {total_mb:.0f}MB, {os.cpu_count()} CPUs")
+    print(f"{'workers':>8} {'seconds':>8} {'img/s':>7} " + ' '.join(f'{stage + "[ms]":>14}' for stage in STAGES))
+
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as tmp:
+            pipeline = ImagePipeline(ImageStore(tmp), workers=workers)
+            result = pipeline.run((f'{i}.jpg', io.BytesIO(data), None) for i, data in enumerate(datas))
+            stats = result['stats']
+            if stats['stored'] != args.images:
+                raise SystemExit(f'workers={workers}: {stats}')
+            print(f"{workers:>8} {stats['seconds']:>8.2f} {stats['images_per_s']:>7.1f} "
+                  + ' '.join(f"{stats['stages'][stage]['ms_per_image']:>14.1f}" for stage in STAGES))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# benchmarks/bench_metrics_overhead.py
+"""metrics の計測にかかる時間の測定
+
+metrics.stage を1回通る時間と、キャッシュ済みのページ（計測の割合が最も大きくなる軽いリクエスト）を
+テストクライアントで取得する時間を、計測を有効にした場合と無効にした場合で比べる。
+
+使い方:
+    python benchmarks/bench_metrics_overhead.py [--calls 200000] [--requests 5000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import metrics
+from app import create_app
+from page_cache import pages
+
+
+def time_stage(calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        with metrics.stage('bench'):
+            pass
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def time_requests(enabled, path, count):
+    # init_app は metrics.enabled も設定する
+    app = create_app({'METRICS_ENABLED': enabled})
+    client = app.test_client()
+    pages.clear(app)
+    client.get(path)
+    start = time.perf_counter()
+    for _ in range(count):
+        client.get(path).close()
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=200000)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--path', default='/')
+    args = parser.parse_args()
+    # uploads/ などを作業用ディレクトリに作らせる
+    os.chdir(tempfile.mkdtemp())
+
+    print(f"{'metrics':>8} {'stage[us]':>10} {'request[us]':>12}")
+    for enabled in (False, True):
+        request_us = time_requests(enabled, args.path, args.requests)
+        print(f"{'on' if enabled else 'off':>8} {time_stage(args.calls):>10.2f} {request_us:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
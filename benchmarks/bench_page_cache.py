@@ -0,0 +1,62 @@
+# benchmarks/bench_page_cache.py
+"""page_cache の効果測定（テストクライアントで固定のページを繰り返し取得する）
+
+毎回 render_template する場合（キャッシュを無効にする）と、キャッシュから返す場合、
+ETagを付けて304を受け取る場合の1秒あたりのリクエスト数と、転送するバイト数を比べる。
+
+使い方:
+    python benchmarks/bench_page_cache.py [--requests 2000] [--paths / /shibuya/rootreplica.html]
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app import create_app
+from page_cache import pages
+
+
+def run(client, path, requests, headers=None):
+    """リクエスト数/秒と、最後のレスポンス"""
+    start = time.perf_counter()
+    for _ in range(requests):
+        response = client.get(path, headers=headers or {})
+    return requests / (time.perf_counter() - start), response
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--paths', nargs='+', default=['/', '/shibuya/rootreplica.html', '/zip_handler.html', '/colors.html'])
+    args = parser.parse_args()
+
+    app = create_app()
+    client = app.test_client()
+    print(f"{'path':>30} {'variant':>10} {'req/s':>9} {'bytes':>8}")
+    for path in args.paths:
+        # デバッグ時はキャッシュしないので、毎回描画する場合として使う
+        app.debug = True
+        rate, response = run(client, path, args.requests)
+        print(f"{path:>30} {'render':>10} {rate:>9.0f} {len(response.get_data()):>8}")
+
+        app.debug = False
+        pages.clear(app)
+        rate, response = run(client, path, args.requests)
+        print(f"{path:>30} {'cached':>10} {rate:>9.0f} {len(response.get_data()):>8}")
+
+        rate, response = run(client, path, args.requests, {'Accept-Encoding': 'gzip, br'})
+        print(f"{path:>30} {response.headers.get('Content-Encoding', 'identity'):>10} {rate:>9.0f} "
+              f"{len(response.get_data()):>8}")
+
+        rate, response = run(client, path, args.requests,
+                             {'Accept-Encoding': 'gzip, br', 'If-None-Match': response.headers['ETag']})
+        if response.status_code != 304:
+            raise SystemExit(f'{path}: expected 304, got {response.status_code}')
+        print(f"{path:>30} {'304':>10} {rate:>9.0f} {len(response.get_data()):>8}")
+
+
+if __name__ == '__main__':
+    main()
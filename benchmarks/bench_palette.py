@@ -0,0 +1,79 @@
+# benchmarks/bench_palette.py
+"""代表色の抽出方法ごとの処理時間と、現在のKMeansの結果との色の差の比較
+
+static/images 以下の画像を対象に、各方式の処理時間と、
+全ピクセルでKMeansを実行した結果との平均色差（RGBのユークリッド距離）を出力する。
+
+使い方:
+    python benchmarks/bench_palette.py [--limit N] [--samples N]
+"""
+import argparse
+import glob
+import itertools
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from image import extract_palette, load_image
+
+
+def palette_distance(reference, palette):
+    """色の対応が最も近くなるように並べ替えたときの平均色差"""
+    reference = np.asarray(reference, dtype=float)
+    palette = np.asarray(palette, dtype=float)
+    best = None
+    for order in itertools.permutations(range(len(palette))):
+        distance = np.linalg.norm(reference - palette[list(order)], axis=1).mean()
+        best = distance if best is None else min(best, distance)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--limit', type=int, default=None, help='対象にする画像の数')
+    parser.add_argument('--samples', type=int, default=20000, help='間引き時のピクセル数')
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(ROOT, 'static', 'images', '**', '*.jpg'), recursive=True))
+    paths = paths[:args.limit]
+
+    variants = [
+        ('kmeans', None),
+        ('kmeans', args.samples),
+        ('minibatch', None),
+        ('minibatch', args.samples),
+        ('mediancut', None),
+        ('mediancut', args.samples),
+    ]
+    timings = {variant: [] for variant in variants}
+    distances = {variant: [] for variant in variants}
+
+    for path in paths:
+        pixels = np.asarray(load_image(path)).reshape(-1, 3)
+        reference = None
+        for variant in variants:
+            engine, max_samples = variant
+            start = time.perf_counter()
+            palette = extract_palette(pixels, engine=engine, max_samples=max_samples)
+            timings[variant].append(time.perf_counter() - start)
+            if reference is None:
+                reference = palette
+            distances[variant].append(palette_distance(reference, palette))
+
+    print(f"{len(paths)} images")
+    print(f"{'engine':>10} {'samples':>8} {'mean[ms]':>9} {'p95[ms]':>8} {'distance':>9} {'max dist':>9}")
+    for variant in variants:
+        engine, max_samples = variant
+        ms = np.array(timings[variant]) * 1000
+        dist = np.array(distances[variant])
+        print(f"{engine:>10} {str(max_samples or 'all'):>8} {ms.mean():>9.1f} {np.percentile(ms, 95):>8.1f} "
+              f"{dist.mean():>9.1f} {dist.max():>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+# benchmarks/bench_responsive_images.py
+"""responsive_images の効果測定（作成時間と配信するバイト数）
+
+static/images を一時ディレクトリにコピーして、初回と2回目（変更なし）の作成時間を測る。
+また、表示幅ごとにブラウザがsrcsetから選ぶ画像の合計サイズを、元の画像と比べる。
+
+使い方:
+    python benchmarks/bench_responsive_images.py [--workers N] [--viewports 360 768 1280]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import responsive_images
+
+
+def chosen(items, viewport):
+    """表示幅以上で最小の候補（無ければ最大のもの）。ブラウザの選び方を単純化したもの"""
+    for item in items:
+        if item['width'] >= viewport:
+            return item
+    return items[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--viewports', type=int, nargs='+', default=[360, 768, 1280])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copytree(os.path.join(ROOT, 'static', 'images'), os.path.join(tmp, 'images'))
+        first = responsive_images.build(static_folder=tmp, workers=args.workers)
+        second = responsive_images.build(static_folder=tmp, workers=args.workers)
+        print(f"build: {first['processed']} images in {first['seconds']:.2f}s, "
+              f"rebuild without changes: {second['seconds']:.3f}s")
+
+        manifest = responsive_images.load_manifest(tmp)
+        original = sum(os.path.getsize(os.path.join(tmp, 'images', name)) for name in manifest['images'])
+        print(f"{'viewport':>9} {'format':>7} {'KB':>8} {'vs original':>12}")
+        for viewport in args.viewports:
+            for fmt in responsive_images.FORMATS:
+                total = sum(os.path.getsize(os.path.join(tmp, chosen(entry['derivatives'][fmt], viewport)['file']))
+                            for entry in manifest['images'].values())
+                print(f"{viewport:>9} {fmt:>7} {total / 1024:>8.0f} {total / original:>11.0%}")
+        print(f"{'':>9} {'original':>7} {original / 1024:>8.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# benchmarks/bench_result_encode.py
+"""分析結果画像のエンコード形式ごとのレスポンスサイズとエンコード時間の比較
+
+変更前はPNGをBase64にしてHTMLに埋め込んでいたため、そのサイズ（data URI）と、
+専用URLから配信するPNG/WebP/JPEGのサイズを比較する。
+
+使い方:
+    python benchmarks/bench_result_encode.py [--limit N] [--quality Q]
+"""
+import argparse
+import base64
+import glob
+import io
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from image import (compose_result_img, extract_palette, get_original_small_img, load_image,
+                   render_color_list_img)
+
+
+def encode(img, output_format, quality):
+    start = time.perf_counter()
+    buffered = io.BytesIO()
+    img.save(buffered, format=output_format, quality=quality)
+    return buffered.getvalue(), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--limit', type=int, default=20, help='対象にする画像の数')
+    parser.add_argument('--quality', type=int, default=85)
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(ROOT, 'static', 'images', '**', '*.jpg'), recursive=True))
+    paths = paths[:args.limit]
+
+    sizes = {}
+    timings = {}
+    for path in paths:
+        img = load_image(path)
+        centers = extract_palette(np.asarray(img).reshape(-1, 3), engine='mediancut')
+        result_img = compose_result_img(get_original_small_img(img), render_color_list_img(centers))
+
+        png, elapsed = encode(result_img, 'PNG', args.quality)
+        inline = 'data:image/png;base64,' + base64.b64encode(png).decode()
+        sizes.setdefault('PNG inline (before)', []).append(len(inline))
+        timings.setdefault('PNG inline (before)', []).append(elapsed)
+
+        for output_format in ('PNG', 'WEBP', 'JPEG'):
+            data, elapsed = encode(result_img, output_format, args.quality)
+            sizes.setdefault(output_format, []).append(len(data))
+            timings.setdefault(output_format, []).append(elapsed)
+
+    baseline = np.mean(sizes['PNG inline (before)'])
+    print(f"{len(paths)} images, quality={args.quality}")
+    print(f"{'format':>20} {'mean size[KB]':>14} {'vs before':>10} {'encode[ms]':>11}")
+    for name in sizes:
+        size = np.mean(sizes[name])
+        print(f"{name:>20} {size / 1024:>14.1f} {size / baseline:>9.0%} {np.mean(timings[name]) * 1000:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# benchmarks/bench_startup.py
+"""起動時間とメモリの測定（app.create_app）
+
+新しいPythonプロセスで app の読み込みと create_app() にかかる時間、その時点の最大RSSを測る。
+続いて gunicorn と同じようにマスターからワーカーをフォークし、各ワーカーで最初の色の分析に
+必要な読み込み（image.preload）にかかる時間と、ワーカー固有のメモリ（USS、他のプロセスと
+共有していないページ）を測る。preload はマスターでsklearnを読み込んでおく場合
+（PRELOAD_IMAGE_MODULES=1 gunicorn --preload）。
+
+使い方:
+    python benchmarks/bench_startup.py [--workers 4] [--repeat 3]
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ('lazy', 'preload')
+
+
+def private_mb():
+    """このプロセスだけが使っているメモリ（/proc/self/smaps_rollup の Private_*）"""
+    total = 0
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            if line.startswith(('Private_Clean:', 'Private_Dirty:')):
+                total += int(line.split()[1])
+    return total / 1024
+
+
+def child(mode, workers):
+    """新しいプロセスで実行され、結果をJSONで標準出力に書く"""
+    start = time.perf_counter()
+    import app
+    imported = time.perf_counter()
+    app.create_app({'PRELOAD_IMAGE_MODULES': mode == 'preload'})
+    created = time.perf_counter()
+    result = {
+        'import_ms': (imported - start) * 1000,
+        'create_ms': (created - imported) * 1000,
+        'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'sklearn': 'sklearn' in sys.modules,
+        'workers': [],
+    }
+
+    import image
+    pipes = []
+    for _ in range(workers):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            began = time.perf_counter()
+            image.preload()
+            worker = {'first_job_ms': (time.perf_counter() - began) * 1000, 'private_mb': private_mb()}
+            os.write(write_fd, json.dumps(worker).encode())
+            os._exit(0)
+        os.close(write_fd)
+        pipes.append((pid, read_fd))
+    for pid, read_fd in pipes:
+        with os.fdopen(read_fd) as f:
+            result['workers'].append(json.loads(f.read()))
+        os.waitpid(pid, 0)
+    print(json.dumps(result))
+
+
+def run(mode, workers):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', mode, '--workers', str(workers)],
+                            cwd=os.environ.get('TMPDIR', '/tmp'), capture_output=True, text=True, check=True,
+                            env={**os.environ, 'PYTHONPATH': ROOT})
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.workers)
+        return
+
+    print(f"{'mode':>8} {'import[ms]':>11} {'create[ms]':>11} {'RSS[MB]':>8} {'sklearn':>8} "
+          f"{'1st job[ms]':>12} {'worker USS[MB]':>15}")
+    for mode in MODES:
+        results = [run(mode, args.workers) for _ in range(args.repeat)]
+        median = lambda values: statistics.median(values)
+        print(f"{mode:>8} {median(r['import_ms'] for r in results):>11.0f} "
+              f"{median(r['create_ms'] for r in results):>11.0f} {median(r['rss_mb'] for r in results):>8.0f} "
+              f"{str(results[0]['sklearn']):>8} "
+              f"{median(w['first_job_ms'] for r in results for w in r['workers']):>12.0f} "
+              f"{median(w['private_mb'] for r in results for w in r['workers']):>15.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# benchmarks/bench_zip.py
+"""ZipHandler.process_files の直列圧縮と並列圧縮の比較
+
+使い方:
+    python benchmarks/bench_zip.py [--workers N] [--repeat N]
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.datastructures import FileStorage
+
+from zip_handler import ZipHandler
+
+FILE_COUNTS = [11, 50, 200]
+FILE_SIZES = [64 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+
+
+def make_payload(size, seed):
+    """ほどほどに圧縮が効くテストデータを作る"""
+    rng = random.Random(seed)
+    words = [bytes(rng.choices(b'abcdefghijklmnopqrstuvwxyz', k=rng.randint(3, 9))) for _ in range(500)]
+    out = bytearray()
+    while len(out) < size:
+        out += rng.choice(words) + b' '
+    return bytes(out[:size])
+
+
+def make_files(payloads):
+    return [FileStorage(stream=io.BytesIO(data), filename=f'file_{i:04d}.txt')
+            for i, data in enumerate(payloads)]
+
+
+def run(handler, payloads, workers, repeat):
+    best = None
+    for _ in range(repeat):
+        files = make_files(payloads)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            zip_path = handler.process_files(files, workers=workers)
+        elapsed = time.perf_counter() - start
+        with zipfile.ZipFile(zip_path) as zipf:
+            assert zipf.testzip() is None
+        size = os.path.getsize(zip_path)
+        os.remove(zip_path)
+        best = elapsed if best is None else min(best, elapsed)
+    return best, size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        handler = ZipHandler(os.path.join(tmp, 'uploads'), os.path.join(tmp, 'temp_zips'))
+        print(f"workers={args.workers}")
+        print(f"{'files':>6} {'size':>8} {'serial[s]':>10} {'parallel[s]':>12} {'speedup':>8} {'zip[MB]':>8}")
+        for count in FILE_COUNTS:
+            for size in FILE_SIZES:
+                payloads = [make_payload(size, seed) for seed in range(count)]
+                serial, serial_size = run(handler, payloads, 1, args.repeat)
+                parallel, parallel_size = run(handler, payloads, args.workers, args.repeat)
+                print(f"{count:>6} {size // 1024:>6}KB {serial:>10.3f} {parallel:>12.3f} "
+                      f"{serial / parallel:>7.2f}x {parallel_size / 1e6:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
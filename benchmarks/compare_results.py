@@ -0,0 +1,96 @@
+# benchmarks/compare_results.py
+"""loadtest.py の2つの結果を比べ、悪化したものを示す
+
+ドライバー・シナリオ・並列数の組ごとに、スループット、p50/p99のレイテンシ、最大RSS、エラー数を並べる。
+--threshold（%）より悪化したものに ! を付け、1つでもあれば終了コード1で終わる（デプロイ前の確認用）。
+負荷の条件（seed、scale、リクエスト数）やCPU数が違う場合は警告する。
+
+使い方:
+    python benchmarks/compare_results.py before.json after.json [--threshold 15]
+"""
+import argparse
+import json
+import sys
+
+# (結果のキー, 表示名, 大きいほど良いか)
+METRICS = (
+    (('throughput_rps',), 'req/s', True),
+    (('latency_ms', 'p50'), 'p50[ms]', False),
+    (('latency_ms', 'p99'), 'p99[ms]', False),
+    (('peak_rss_mb',), 'RSS[MB]', False),
+)
+CONDITIONS = ('seed', 'scale', 'requests', 'repeat', 'warmup', 'dropbox_latency', 'url')
+
+
+def load(path):
+    with open(path) as f:
+        report = json.load(f)
+    results = {(r['driver'], r['scenario'], r['concurrency']): r for r in report['results']}
+    return report['meta'], results
+
+
+def value(result, keys):
+    for key in keys:
+        result = result.get(key) if result is not None else None
+    return result
+
+
+def change(before, after, higher_is_better):
+    """悪化した割合（%、良くなった場合は負）。比べられなければNone"""
+    if before is None or after is None or before == 0:
+        return None
+    ratio = (after - before) / before * 100
+    return -ratio if higher_is_better else ratio
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=15.0, help='悪化とみなす割合（%%）')
+    args = parser.parse_args()
+
+    before_meta, before = load(args.before)
+    after_meta, after = load(args.after)
+    print(f"before: {before_meta.get('revision')} {before_meta['created']}")
+    print(f"after:  {after_meta.get('revision')} {after_meta['created']}")
+    for key in CONDITIONS:
+        if before_meta['args'].get(key) != after_meta['args'].get(key):
+            print(f"Warning: {key} differs ({before_meta['args'].get(key)} -> {after_meta['args'].get(key)})")
+    if before_meta.get('cpus') != after_meta.get('cpus'):
+        print(f"Warning: CPU count differs ({before_meta.get('cpus')} -> {after_meta.get('cpus')})")
+
+    print(f"\n{'driver':>7} {'scenario':>11} {'conc':>5} "
+          + ' '.join(f'{name:>22}' for _, name, _ in METRICS) + f" {'errors':>9}")
+    regressions = 0
+    for key in sorted(before.keys() & after.keys()):
+        old, new = before[key], after[key]
+        cells = []
+        for keys, _, higher_is_better in METRICS:
+            a, b = value(old, keys), value(new, keys)
+            worse = change(a, b, higher_is_better)
+            if worse is None:
+                cells.append(f"{'-':>22}")
+                continue
+            flag = '!' if worse > args.threshold else ' '
+            regressions += flag == '!'
+            # 表示は変化の向き（+は増加）
+            delta = (b - a) / a * 100
+            cells.append(f"{a:>8.1f} -> {b:>7.1f} {delta:>+4.0f}%{flag}")
+        errors = f"{old['errors']}->{new['errors']}"
+        if new['errors'] > old['errors']:
+            errors += '!'
+            regressions += 1
+        print(f"{key[0]:>7} {key[1]:>11} {key[2]:>5} " + ' '.join(cells) + f" {errors:>9}")
+
+    for key in sorted(before.keys() ^ after.keys()):
+        print(f"Only in {'before' if key in before else 'after'}: {' '.join(map(str, key))}")
+
+    if regressions:
+        print(f"\n{regressions} regression(s) over {args.threshold:.0f}%")
+        sys.exit(1)
+    print(f"\nNo regressions over {args.threshold:.0f}%")
+
+
+if __name__ == '__main__':
+    main()
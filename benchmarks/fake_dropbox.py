@@ -0,0 +1,275 @@
+# benchmarks/fake_dropbox.py
+"""ローカルで動くDropbox HTTP APIの簡易スタブ
+
+dropbox_uploaderの動作確認とベンチマーク用。アップロード関連のルートだけを実装し、
+受け取ったファイルはメモリ上に保持する。drop_everyを指定すると、N回に1回の
+append/finishでデータを受け取った後に応答を返さずに接続を切り、再送の動作を確認できる。
+expired_tokensに入れたアクセストークンには期限切れのエラーを返し、/oauth2/tokenで
+リフレッシュトークンから新しいアクセストークンを発行する。
+
+使い方:
+    with FakeDropboxServer() as server:
+        client = dropbox.Dropbox('token', session=server.session())
+        ...
+        server.files['/uploads/a.txt']
+"""
+import hashlib
+import itertools
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+
+def _metadata(path, data):
+    now = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    return {
+        '.tag': 'file',
+        'name': path.rsplit('/', 1)[-1],
+        'id': 'id:' + hashlib.sha256(path.encode('utf-8')).hexdigest()[:22],
+        'client_modified': now,
+        'server_modified': now,
+        'rev': hashlib.sha256(data).hexdigest()[:16],
+        'size': len(data),
+        'path_lower': path.lower(),
+        'path_display': path,
+    }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # ヘッダーと本文を別々に書くため、Nagleアルゴリズムによる遅延を避ける
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server.fake
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.path.startswith('/oauth2/token'):
+            self._reply(200, server.refresh(parse_qs(urlsplit(self.path).query or body.decode('utf-8'))))
+            return
+        token = self.headers.get('Authorization', '')[len('Bearer '):]
+        if token in server.expired_tokens:
+            self._reply(401, {'error_summary': 'expired_access_token/', 'error': {'.tag': 'expired_access_token'}})
+            return
+        arg = self.headers.get('Dropbox-API-Arg')
+        arg = json.loads(arg) if arg else json.loads(body or b'null')
+        route = self.path[len('/2/'):]
+        if server.latency:
+            time.sleep(server.latency)
+
+        handler = server.routes.get(route)
+        if handler is None:
+            self._reply(404, {'error_summary': 'not_found', 'error': {'.tag': 'other'}})
+            return
+        with server.lock:
+            server.requests[route] = server.requests.get(route, 0) + 1
+        status, result = handler(arg, body)
+        if status is None:
+            # データは受け取ったが応答が届かなかった状況を再現する
+            self.close_connection = True
+            self.connection.shutdown(2)
+            return
+        self._reply(status, result)
+
+    def _reply(self, status, result):
+        data = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class _LocalAdapter(requests.adapters.HTTPAdapter):
+    """https://api.dropboxapi.com などへのリクエストをローカルのスタブへ向ける"""
+
+    def __init__(self, base_url, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url
+
+    def send(self, request, **kwargs):
+        request.url = self.base_url + urlsplit(request.url).path
+        return super().send(request, **kwargs)
+
+
+class FakeDropboxServer:
+    def __init__(self, latency=0.0, drop_every=None):
+        self.latency = latency
+        self.drop_every = drop_every
+        self.files = {}
+        self.sessions = {}  # session_id -> bytearray
+        self.closed = set()  # closeを指定して送り終えたsession_id
+        self.requests = {}  # ルート名 -> 回数
+        self.dropped = 0
+        self.expired_tokens = set()
+        self.refreshes = 0
+        self.lock = threading.Lock()
+        self._counter = itertools.count(1)
+        self.routes = {
+            'files/upload': self._upload,
+            'files/upload_session/start': self._session_start,
+            'files/upload_session/append_v2': self._session_append,
+            'files/upload_session/finish': self._session_finish,
+            'files/upload_session/finish_batch_v2': self._session_finish_batch,
+            'sharing/create_shared_link_with_settings': self._create_shared_link,
+            'users/get_current_account': self._current_account,
+        }
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self._httpd.server_address[1]}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def session(self, max_connections=8):
+        """このスタブへ接続するrequestsのセッション（dropbox.Dropboxのsessionに渡す）"""
+        session = requests.Session()
+        session.mount('https://', _LocalAdapter(self.url, pool_maxsize=max_connections))
+        return session
+
+    def refresh(self, params):
+        """リフレッシュトークンから新しいアクセストークンを発行する"""
+        with self.lock:
+            self.refreshes += 1
+            count = self.refreshes
+        return {'access_token': f'refreshed-{count}', 'token_type': 'bearer', 'expires_in': 14400}
+
+    def _should_drop(self):
+        with self.lock:
+            if self.drop_every and next(self._counter) % self.drop_every == 0:
+                self.dropped += 1
+                return True
+        return False
+
+    def _store(self, path, data):
+        data = bytes(data)
+        with self.lock:
+            self.files[path] = data
+        return _metadata(path, data)
+
+    def _upload(self, arg, body):
+        return 200, self._store(arg['path'], body)
+
+    def _session_start(self, arg, body):
+        session_id = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[session_id] = bytearray(body)
+            if arg and arg.get('close'):
+                self.closed.add(session_id)
+        return 200, {'session_id': session_id}
+
+    def _check_cursor(self, cursor):
+        """(セッションのデータ, エラー) を返す"""
+        with self.lock:
+            data = self.sessions.get(cursor['session_id'])
+        if data is None:
+            return None, {'.tag': 'not_found'}
+        if cursor['offset'] != len(data):
+            return None, {'.tag': 'incorrect_offset', 'correct_offset': len(data)}
+        return data, None
+
+    def _session_append(self, arg, body):
+        data, error = self._check_cursor(arg['cursor'])
+        if error is None and arg['cursor']['session_id'] in self.closed:
+            error = {'.tag': 'closed'}
+        if error:
+            return 409, {'error_summary': error['.tag'], 'error': error}
+        data.extend(body)
+        if arg.get('close'):
+            with self.lock:
+                self.closed.add(arg['cursor']['session_id'])
+        if self._should_drop():
+            return None, None
+        return 200, None
+
+    def _session_finish(self, arg, body):
+        data, error = self._check_cursor(arg['cursor'])
+        if error:
+            return 409, {'error_summary': 'lookup_failed', 'error': {'.tag': 'lookup_failed', 'lookup_failed': error}}
+        data.extend(body)
+        if self._should_drop():
+            return None, None
+        with self.lock:
+            del self.sessions[arg['cursor']['session_id']]
+        return 200, self._store(arg['commit']['path'], data)
+
+    def _session_finish_batch(self, arg, body):
+        entries = []
+        for entry in arg['entries']:
+            session_id = entry['cursor']['session_id']
+            data, error = self._check_cursor(entry['cursor'])
+            if error is None and session_id not in self.closed:
+                error = {'.tag': 'not_closed'}
+            if error:
+                entries.append({'.tag': 'failure', 'failure': {'.tag': 'lookup_failed', 'lookup_failed': error}})
+                continue
+            with self.lock:
+                del self.sessions[session_id]
+                self.closed.discard(session_id)
+            metadata = self._store(entry['commit']['path'], data)
+            del metadata['.tag']
+            entries.append({'.tag': 'success', **metadata})
+        return 200, {'entries': entries}
+
+    def _create_shared_link(self, arg, body):
+        with self.lock:
+            data = self.files.get(arg['path'])
+        if data is None:
+            return 409, {'error_summary': 'path/not_found', 'error': {'.tag': 'path', 'path': {'.tag': 'not_found'}}}
+        metadata = _metadata(arg['path'], data)
+        return 200, {
+            '.tag': 'file',
+            'url': 'https://www.dropbox.com/s/' + metadata['id'][3:] + '/' + metadata['name'] + '?dl=0',
+            'name': metadata['name'],
+            'link_permissions': {
+                'can_revoke': True, 'visibility_policies': [], 'can_set_expiry': False,
+                'can_remove_expiry': False, 'allow_download': True, 'can_allow_download': True,
+                'can_disallow_download': False, 'allow_comments': True, 'team_restricts_comments': False,
+            },
+            'client_modified': metadata['client_modified'],
+            'server_modified': metadata['server_modified'],
+            'rev': metadata['rev'],
+            'size': metadata['size'],
+            'id': metadata['id'],
+            'path_lower': metadata['path_lower'],
+        }
+
+    def _current_account(self, arg, body):
+        return 200, {
+            'account_id': 'dbid:' + 'a' * 35,
+            'name': {'given_name': 'Test', 'surname': 'User', 'familiar_name': 'Test',
+                     'display_name': 'Test User', 'abbreviated_name': 'TU'},
+            'email': 'test@example.com',
+            'email_verified': True,
+            'disabled': False,
+            'locale': 'ja',
+            'referral_link': 'https://db.tt/test',
+            'is_paired': False,
+            'account_type': {'.tag': 'basic'},
+            'root_info': {'.tag': 'user', 'root_namespace_id': '1', 'home_namespace_id': '1'},
+            'country': 'JP',
+        }
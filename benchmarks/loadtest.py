@@ -0,0 +1,414 @@
+# benchmarks/loadtest.py
+"""アップロードと分析のエンドポイントの負荷試験（結果はJSONで保存して compare_results.py で比べる）
+
+合成したファイル（JPEGとテキストの混在、数と大きさはシナリオごと）を multipart で送り、
+スループット、レイテンシ（p50/p90/p99）、プロセス（ワーカープロセスを含む）の最大RSSを記録する。
+
+シナリオ:
+    zip_mixed   /upload                 テキスト5件とJPEG3件
+    zip_large   /upload                 大きいテキスト1件と写真の大きさのJPEG2件
+    zip_stream  /upload?mode=stream     zip_mixed と同じ内容をストリーミングで
+    colors      /colors.html            JPEG1件の色の分析
+    dropbox     /dropbox/upload         ローカルのスタブ（fake_dropbox.py）へのアップロード
+
+ドライバー:
+    client  Flaskのテストクライアントから直接呼ぶ（HTTPを含まないアプリの処理時間）
+    http    このプロセスでwerkzeugのサーバーを起動し、concurrency本のスレッドから接続する
+            （--url を指定すると、起動済みのサーバー（gunicornなど）に送る。RSSは --server-pid で指定した
+            プロセスの分を測る。dropboxはスタブに向けられないので除く）
+
+ファイルの内容はseedから決まり、実行ごとに同じになる。ZIPと色の分析のキャッシュに当たらないよう、
+リクエストごとに内容を少しずつ変える（ZIPは小さなメンバーを1つ加え、JPEGは末尾にバイトを足す）。
+1CPUの環境では、http はサーバーと負荷をかける側が同じCPUを使うことに注意。
+
+使い方:
+    python benchmarks/loadtest.py [--scenarios zip_mixed colors dropbox] [--drivers client http]
+        [--concurrency 1 4] [--requests 20] [--repeat 3] [--scale 1.0] [--output loadtest.json]
+    python benchmarks/compare_results.py before.json after.json
+"""
+import argparse
+import contextlib
+import http.client
+import io
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+sys.path.insert(0, ROOT)
+
+from werkzeug.datastructures import FileStorage, MultiDict
+from werkzeug.serving import WSGIRequestHandler, make_server
+from werkzeug.test import encode_multipart
+
+from bench_image_pipeline import make_jpeg
+
+SCENARIOS = ('zip_mixed', 'zip_large', 'zip_stream', 'colors', 'dropbox')
+DRIVERS = ('client', 'http')
+BOUNDARY = 'loadtest-boundary'
+TOKEN = 'loadtest-token'
+RSS_INTERVAL = 0.02
+WORDS = ('upload', 'image', 'color', 'palette', 'zip', 'archive', 'shibuya', 'dental', 'implant', 'root',
+         'replica', 'clinic', 'tooth', 'case', 'report', 'patient', 'record', 'scan', 'photo', 'data')
+
+
+def make_text(size, rng):
+    """ログに近い、ある程度圧縮の効くテキスト"""
+    lines = []
+    total = 0
+    while total < size:
+        line = f"{rng.randrange(10 ** 6):06d} " + ' '.join(rng.choices(WORDS, k=rng.randint(4, 16))) + '\n'
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines).encode('ascii')[:size]
+
+
+class Workload:
+    """シナリオ1つ分の送信内容。ファイルは最初に作っておき、リクエストごとに少し変えて送る"""
+
+    def __init__(self, name, path, field, files, form=None, check=None):
+        self.name = name
+        self.path = path
+        self.field = field
+        self.files = files  # (ファイル名, Content-Type, バイト列)
+        self.form = form or {}
+        self.check = check or (lambda status, location: status == 200)
+        # 並列数やドライバーを変えても同じ内容を送らないよう、通し番号で内容を変える
+        self._counter = itertools.count()
+
+    @property
+    def upload_bytes(self):
+        return sum(len(data) for _, _, data in self.files)
+
+    def body(self):
+        """次のリクエストの (Content-Type, 本文)"""
+        index = next(self._counter)
+        values = MultiDict(self.form)
+        for filename, mimetype, data in self.files:
+            if mimetype == 'image/jpeg' and self.field == 'file':
+                # JPEGは終端より後ろのバイトを無視して読めるので、末尾を変えて別の内容にする
+                data = data + index.to_bytes(4, 'big')
+            values.add(self.field, FileStorage(io.BytesIO(data), filename, content_type=mimetype))
+        if self.field == 'files[]':
+            # 同じ組み合わせのZIPはキャッシュから返るので、メンバーを1つ加えて毎回作らせる
+            values.add(self.field, FileStorage(io.BytesIO(f'{index}\n'.encode()), 'request.txt',
+                                               content_type='text/plain'))
+        boundary, body = encode_multipart(values, boundary=BOUNDARY)
+        return f'multipart/form-data; boundary={boundary}', body
+
+
+def build_workloads(seed, scale):
+    rng = random.Random(seed)
+
+    def size(n):
+        return max(1024, int(n * scale))
+
+    def jpeg(width, height):
+        # make_jpegのノイズは8ピクセル単位なので、幅と高さも8の倍数にする
+        factor = math.sqrt(scale)
+        return make_jpeg(max(16, int(width * factor) // 8 * 8), max(16, int(height * factor) // 8 * 8),
+                         rng.randrange(2 ** 32))
+
+    mixed = [(f'log{i}.txt', 'text/plain', make_text(size(int(16 * 1024 * 16 ** rng.random())), rng))
+             for i in range(5)]
+    mixed += [(f'photo{i}.jpg', 'image/jpeg', jpeg(800, 600)) for i in range(3)]
+    large = [('large.txt', 'text/plain', make_text(size(8 * 1024 * 1024), rng))]
+    large += [(f'large{i}.jpg', 'image/jpeg', jpeg(3000, 2000)) for i in range(2)]
+
+    def dropbox_ok(status, location):
+        return status == 302 and 'message_class=success' in (location or '')
+
+    return {
+        'zip_mixed': Workload('zip_mixed', '/upload', 'files[]', mixed),
+        'zip_large': Workload('zip_large', '/upload', 'files[]', large),
+        'zip_stream': Workload('zip_stream', '/upload?mode=stream', 'files[]', mixed),
+        'colors': Workload('colors', '/colors.html', 'file', [('photo.jpg', 'image/jpeg', jpeg(1600, 1200))]),
+        'dropbox': Workload('dropbox', '/dropbox/upload', 'file',
+                            [('report.txt', 'text/plain', make_text(size(4 * 1024 * 1024), rng))],
+                            form={'path': '/loadtest/'}, check=dropbox_ok),
+    }
+
+
+def rss_tree_mb(pid):
+    """pidとその子孫のプロセスのRSSの合計（MB）。/proc が無い環境やプロセスが無ければNone"""
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    total = 0
+    pending = [pid]
+    try:
+        while pending:
+            current = pending.pop()
+            with open(f'/proc/{current}/statm') as f:
+                total += int(f.read().split()[1]) * page_size
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children') as f:
+                    pending.extend(int(child) for child in f.read().split())
+    except (OSError, ValueError):
+        if total == 0:
+            return None
+    return total / 1024 / 1024
+
+
+class RssSampler:
+    """一定間隔でRSSを測り、最大値を記録する"""
+
+    def __init__(self, pid, interval=RSS_INTERVAL):
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        value = rss_tree_mb(self.pid)
+        if value is not None and (self.peak is None or value > self.peak):
+            self.peak = value
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+
+class ClientDriver:
+    """Flaskのテストクライアント。スレッドごとにクライアントを作る"""
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def send(self, path, content_type, body):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.post(path, data=body, content_type=content_type)
+        try:
+            response.get_data()
+            return response.status_code, response.headers.get('Location')
+        finally:
+            response.close()
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """アクセスログを出さない（出力の時間を測らないため）"""
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class HttpDriver:
+    """HTTPで送る。リクエストごとに接続する"""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+
+    def send(self, path, content_type, body):
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=300)
+        try:
+            connection.request('POST', path, body, headers={'Content-Type': content_type})
+            response = connection.getresponse()
+            response.read()
+            return response.status, response.getheader('Location')
+        finally:
+            connection.close()
+
+
+def percentile(values, q):
+    """最近順位法の百分位数（件数が少ないとp99は最大値になる）"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+def run_scenario(driver, workload, concurrency, requests, repeat, warmup, pid):
+    """requests件をconcurrency本のスレッドから送る処理をrepeat回繰り返す
+
+    スループットは成功したリクエストの件数から求め、繰り返しの中央値にする。
+    レイテンシは成功したリクエストだけで集計する（混雑で503をすぐに返したものは含めない）
+    """
+    for _ in range(warmup):
+        driver.send(workload.path, *workload.body())
+
+    def one(_):
+        content_type, body = workload.body()
+        start = time.perf_counter()
+        status, location = driver.send(workload.path, content_type, body)
+        return time.perf_counter() - start, workload.check(status, location), status
+
+    rss_before = rss_tree_mb(pid) if pid else None
+    peak = None
+    rounds = []
+    latencies = []
+    errors = []
+    for _ in range(repeat):
+        sampler = RssSampler(pid) if pid else contextlib.nullcontext()
+        start = time.perf_counter()
+        with sampler, ThreadPoolExecutor(max_workers=concurrency) as pool:
+            outcomes = list(pool.map(one, range(requests)))
+        seconds = time.perf_counter() - start
+        succeeded = [latency * 1000 for latency, ok, _ in outcomes if ok]
+        latencies += succeeded
+        errors += [status for _, ok, status in outcomes if not ok]
+        rounds.append((len(succeeded) / seconds, seconds))
+        if pid and sampler.peak is not None:
+            peak = max(peak or 0, sampler.peak)
+
+    throughput, seconds = sorted(rounds)[len(rounds) // 2]
+    latency_ms = None
+    if latencies:
+        latency_ms = {
+            'p50': round(percentile(latencies, 0.50), 2),
+            'p90': round(percentile(latencies, 0.90), 2),
+            'p99': round(percentile(latencies, 0.99), 2),
+            'mean': round(sum(latencies) / len(latencies), 2),
+            'max': round(max(latencies), 2),
+        }
+    return {
+        'scenario': workload.name,
+        'path': workload.path,
+        'files': len(workload.files),
+        'upload_mb': round(workload.upload_bytes / 1024 / 1024, 3),
+        'concurrency': concurrency,
+        'requests': requests * repeat,
+        'errors': len(errors),
+        'error_statuses': sorted(set(errors)),
+        'seconds': round(seconds, 3),
+        'throughput_rps': round(throughput, 3),
+        'upload_mb_per_s': round(throughput * workload.upload_bytes / 1024 / 1024, 3),
+        'latency_ms': latency_ms,
+        'rss_before_mb': round(rss_before, 1) if rss_before is not None else None,
+        'peak_rss_mb': round(peak, 1) if peak is not None else None,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def create_local_app(server, workdir):
+    """作業ディレクトリで動かすアプリ。Dropboxへのアップロードはスタブに送る"""
+    import dropbox_app
+    import dropbox_uploader
+    from app import create_app
+    from token_store import TokenStore
+
+    app = create_app({'TESTING': True})
+    # トークンごとのクライアントを先に作っておくと、アプリはスタブへ接続するクライアントを使い回す
+    dropbox_app.token_store = TokenStore(os.path.join(workdir, 'dropbox_token.json'))
+    dropbox_app.token_store.save(TOKEN)
+    dropbox_uploader.get_client(TOKEN, session=server.session())
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--drivers', nargs='+', choices=DRIVERS, default=list(DRIVERS))
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--requests', type=int, default=20, help='シナリオと並列数の組ごと、1回あたりのリクエスト数')
+    parser.add_argument('--repeat', type=int, default=3, help='繰り返す回数（スループットは中央値）')
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--scale', type=float, default=1.0, help='ファイルの大きさ（JPEGは面積）の倍率')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dropbox-latency', type=float, default=0.01, help='スタブの1リクエストあたりの疑似遅延（秒）')
+    parser.add_argument('--url', default=None, help='起動済みのサーバーに送る場合のURL（http ドライバーのみ）')
+    parser.add_argument('--server-pid', type=int, default=None, help='--url のサーバーのPID（RSSの測定用）')
+    parser.add_argument('--output', default='loadtest.json')
+    parser.add_argument('--verbose', action='store_true', help='アプリが標準出力に書くログも表示する')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+    report_to = sys.stdout
+    if not args.verbose:
+        # ファイルごとのログは並列のリクエストで行が混ざるので、表だけを表示する
+        sys.stdout = open(os.devnull, 'w')
+
+    from fake_dropbox import FakeDropboxServer
+
+    print(f"Generating workloads (seed={args.seed}, scale={args.scale})", file=report_to)
+    workloads = build_workloads(args.seed, args.scale)
+    scenarios = list(args.scenarios)
+    if args.url and 'dropbox' in scenarios:
+        print("Skipping dropbox: the stub can only be used with the in-process server", file=report_to)
+        scenarios.remove('dropbox')
+
+    results = []
+    # uploads/ などを作業用ディレクトリに作らせる
+    with tempfile.TemporaryDirectory() as workdir, FakeDropboxServer(latency=args.dropbox_latency) as server:
+        os.chdir(workdir)
+        app = create_local_app(server, workdir)
+        httpd = None
+        for driver_name in args.drivers:
+            if driver_name == 'client':
+                if args.url:
+                    continue
+                driver, pid = ClientDriver(app), os.getpid()
+            elif args.url:
+                driver, pid = HttpDriver(args.url), args.server_pid
+            else:
+                httpd = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler)
+                threading.Thread(target=httpd.serve_forever, daemon=True).start()
+                driver, pid = HttpDriver(f'http://127.0.0.1:{httpd.server_port}'), os.getpid()
+
+            print(f"\n{driver_name}", file=report_to)
+            print(f"{'scenario':>11} {'conc':>5} {'req/s':>8} {'MB/s':>8} {'p50[ms]':>9} {'p99[ms]':>9} "
+                  f"{'peak RSS[MB]':>13} {'errors':>7}", file=report_to)
+            for name in scenarios:
+                for concurrency in args.concurrency:
+                    result = run_scenario(driver, workloads[name], concurrency, args.requests, args.repeat,
+                                          args.warmup, pid)
+                    result['driver'] = driver_name
+                    results.append(result)
+                    latency = result['latency_ms'] or {}
+                    cells = [latency.get('p50'), latency.get('p99'), result['peak_rss_mb']]
+                    print(f"{name:>11} {concurrency:>5} {result['throughput_rps']:>8.2f} "
+                          f"{result['upload_mb_per_s']:>8.2f} "
+                          + ' '.join(f"{'-' if v is None else f'{v:.1f}':>{w}}" for v, w in zip(cells, (9, 9, 13)))
+                          + f" {result['errors']:>7}", file=report_to)
+        if httpd is not None:
+            httpd.shutdown()
+        os.chdir(ROOT)
+
+    report = {
+        'meta': {
+            'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'url': args.url,
+            'args': {key: value for key, value in vars(args).items() if key != 'output'},
+        },
+        'results': results,
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\nWrote {output}", file=report_to)
+
+
+if __name__ == '__main__':
+    main()
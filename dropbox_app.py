@@ -0,0 +1,255 @@
+"""Dropboxへのアップロード
+
+一括アップロードの結果（batch_uploads）はこのプロセスのメモリにだけあるので、状態の確認が
+別のプロセスに届くと404になる。アプリは1つのワーカープロセスで動かす（app.py の起動方法を参照）
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from flask import Blueprint, request, redirect, url_for, render_template_string, flash, jsonify, session
+
+import ingest
+from token_store import TokenStore
+
+# Dropboxへのアップロード（/dropbox 以下に登録する）
+# Dropbox SDKは読み込みに時間がかかるため、使うルートの中で読み込む
+bp = Blueprint('dropbox', __name__)
+
+# アップロードセッションでチャンクごとに送るため、files_uploadの150MBの制限は受けない
+ingest.init_blueprint(bp, max_content_length=2 * 1024 * 1024 * 1024 + 64 * 1024, max_file_size=2 * 1024 * 1024 * 1024)
+
+# Dropboxの設定
+APP_KEY = "YOUR_APP_KEY"
+APP_SECRET = "YOUR_APP_SECRET"
+REDIRECT_URI = "http://localhost:5000/dropbox/auth"
+TOKEN_FILE = "token.txt"
+
+# 認証情報は起動後に一度だけ読み込み、メモリ上に保持する
+token_store = TokenStore(TOKEN_FILE, app_key=APP_KEY, app_secret=APP_SECRET)
+
+# 認証フローのための状態（最初に使うときに作成し、以後は使い回す）
+oauth_flow = None
+
+# 一括アップロードの設定
+BATCH_WORKERS = 4  # 同時にセッションへ送るファイル数
+BATCH_TTL = 3600  # 結果を保持する時間（秒）
+# 共有リンクはコミット後にこのスレッドで作成する
+link_executor = ThreadPoolExecutor(max_workers=2)
+# プロセス内にだけ保持する（ワーカーを複数にすると別のワーカーからは見えない）
+batch_uploads = OrderedDict()  # batch_id -> BatchUpload（古い順）
+batch_uploads_lock = threading.Lock()
+
+@bp.route('/')
+def index():
+    """
+    メインページを表示。トークンが保存されていればファイルアップロードフォームを、
+    なければDropbox認証リンクを表示
+    """
+    if token_store.get() is not None:
+        return render_template_string('''
+            <!DOCTYPE html>
+            <html>
+            <head>
+                <title>Dropboxファイルアップロード</title>
+                <style>
+                    body { font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto; padding: 20px; }
+                    .form-group { margin-bottom: 15px; }
+                    label { display: block; margin-bottom: 5px; }
+                    button { padding: 8px 15px; background: #0061ff; color: white; border: none; cursor: pointer; }
+                    .success { color: green; }
+                    .error { color: red; }
+                </style>
+            </head>
+            <body>
+                <h1>Dropboxファイルアップロード</h1>
+                {% if message %}
+                    <p class="{{ message_class }}">{{ message }}</p>
+                {% endif %}
+                <form action="{{ url_for('.upload_file') }}" method="post" enctype="multipart/form-data">
+                    <div class="form-group">
+                        <label for="file">アップロードするファイル:</label>
+                        <input type="file" id="file" name="file" required>
+                    </div>
+                    <div class="form-group">
+                        <label for="path">Dropbox内の保存先パス (例: /uploads/myfile.txt):</label>
+                        <input type="text" id="path" name="path" value="/uploads/" required>
+                    </div>
+                    <button type="submit">アップロード</button>
+                </form>
+                <h2>複数ファイルの一括アップロード</h2>
+                <form action="{{ url_for('.upload_batch') }}" method="post" enctype="multipart/form-data">
+                    <div class="form-group">
+                        <label for="files">アップロードするファイル（複数選択可）:</label>
+                        <input type="file" id="files" name="files[]" multiple required>
+                    </div>
+                    <div class="form-group">
+                        <label for="batch-path">Dropbox内の保存先フォルダ (例: /uploads/):</label>
+                        <input type="text" id="batch-path" name="path" value="/uploads/" required>
+                    </div>
+                    <button type="submit">一括アップロード</button>
+                </form>
+            </body>
+            </html>
+        ''', message=request.args.get('message'), message_class=request.args.get('message_class', ''))
+    
+    # トークンがない場合は認証リンクを表示
+    auth_url = get_auth_url()
+    return render_template_string('''
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <title>Dropbox認証</title>
+            <style>
+                body { font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto; padding: 20px; }
+                .auth-button { padding: 10px 20px; background: #0061ff; color: white; text-decoration: none; display: inline-block; }
+            </style>
+        </head>
+        <body>
+            <h1>Dropbox APIとの連携</h1>
+            <p>ファイルをアップロードするには、まずDropboxアカウントとの連携が必要です。</p>
+            <a href="{{ auth_url }}" class="auth-button">Dropboxと連携する</a>
+        </body>
+        </html>
+    ''', auth_url=auth_url)
+
+@bp.route('/auth')
+def auth_callback():
+    """Dropbox OAuth認証コールバック"""
+    auth_code = request.args.get('code')
+    if not auth_code:
+        return "認証コードがありません。"
+    
+    try:
+        oauth_result = get_dropbox_auth_flow().finish(request.args)
+        # リフレッシュトークンも保存し、アクセストークンの期限切れで再認証しなくて済むようにする
+        token_store.save(oauth_result.access_token, oauth_result.refresh_token, oauth_result.expires_at)
+        return redirect(url_for('.index', message="認証に成功しました！", message_class="success"))
+    except Exception as e:
+        return f"認証エラー: {str(e)}"
+
+@bp.route('/upload', methods=['POST'])
+def upload_file():
+    """ファイルをDropboxにアップロード"""
+    from dropbox.exceptions import ApiError, AuthError
+    from dropbox.files import WriteMode
+    from dropbox_uploader import DropboxUploader
+
+    if 'file' not in request.files:
+        return redirect(url_for('.index', message="ファイルが選択されていません", message_class="error"))
+    
+    file = request.files['file']
+    if file.filename == '':
+        return redirect(url_for('.index', message="ファイルが選択されていません", message_class="error"))
+    
+    path = request.form.get('path', '/uploads/')
+    if not path.startswith('/'):
+        path = '/' + path
+        
+    # パスにファイル名を追加（パスがディレクトリで終わる場合）
+    if path.endswith('/'):
+        path = path + file.filename
+    
+    # Dropboxクライアントはトークンごとに使い回す（接続も再利用される）
+    dbx = token_store.client()
+    if dbx is None:
+        return redirect(url_for('.index', message="認証が必要です。Dropboxと連携してください。", message_class="error"))
+    
+    try:
+        # 受信済みの一時ファイルからチャンクごとに読み出して送る（ファイル全体をメモリに載せない）
+        # トークンが無効ならここでAuthErrorになるため、事前の確認は行わない
+        result = DropboxUploader(dbx).upload(file.stream, path, mode=WriteMode.overwrite)
+        
+        shared_link = dbx.sharing_create_shared_link_with_settings(path)
+        return redirect(url_for('.index', 
+                               message=f"ファイル '{file.filename}' を '{path}' にアップロードしました！", 
+                               message_class="success"))
+        
+    except AuthError:
+        # リフレッシュトークンでも更新できなかった場合は、保存した認証情報を削除して再認証を促す
+        token_store.clear()
+        return redirect(url_for('.index', message="認証の有効期限が切れています。再度認証してください。", message_class="error"))
+    
+    except ApiError as e:
+        return redirect(url_for('.index', message=f"APIエラー: {str(e)}", message_class="error"))
+    
+    except Exception as e:
+        return redirect(url_for('.index', message=f"エラー: {str(e)}", message_class="error"))
+
+@bp.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """
+    複数のファイルを並列にDropboxへアップロードし、まとめてコミットする。
+    ファイルごとの結果と全体のスループットをJSONで返す。共有リンクは
+    バックグラウンドで作成し、/upload/batch/<batch_id> で確認できる
+    """
+    from dropbox.exceptions import AuthError
+    from dropbox_uploader import DropboxUploader
+
+    files = [file for file in request.files.getlist('files[]') if file.filename]
+    if not files:
+        return jsonify({'error': 'ファイルが選択されていません'}), 400
+    
+    folder = request.form.get('path', '/uploads/')
+    if not folder.startswith('/'):
+        folder = '/' + folder
+    if not folder.endswith('/'):
+        folder = folder + '/'
+    
+    dbx = token_store.client()
+    if dbx is None:
+        return jsonify({'error': '認証が必要です'}), 401
+    
+    try:
+        items = [(file.stream, folder + os.path.basename(file.filename)) for file in files]
+        batch = DropboxUploader(dbx).upload_batch(items, max_workers=BATCH_WORKERS, link_executor=link_executor)
+    except AuthError:
+        token_store.clear()
+        return jsonify({'error': '認証の有効期限が切れています。再度認証してください。'}), 401
+    
+    with batch_uploads_lock:
+        # 期限切れの結果を削除
+        expired = time.time() - BATCH_TTL
+        while batch_uploads and next(iter(batch_uploads.values())).created < expired:
+            batch_uploads.popitem(last=False)
+        batch_uploads[batch.id] = batch
+    
+    result = batch.to_dict()
+    result['status_url'] = url_for('.upload_batch_status', batch_id=batch.id)
+    print(f"Batch upload {batch.id}: {result['committed_files']}/{len(files)} files, "
+          f"{result['committed_bytes']} bytes in {result['seconds']:.2f}s")
+    return jsonify(result), 200 if result['failed_files'] == 0 else 207
+
+@bp.route('/upload/batch/<batch_id>')
+def upload_batch_status(batch_id):
+    """一括アップロードの結果（共有リンクの作成状況を含む）"""
+    with batch_uploads_lock:
+        batch = batch_uploads.get(batch_id)
+    if batch is None:
+        return jsonify({'error': '一括アップロードの結果が見つかりません。結果はアップロードを受け付けたサーバープロセスで'
+                                 f'{BATCH_TTL}秒だけ保持されるため、期限が切れたか、別のプロセスに届いた可能性があります'}), 404
+    return jsonify(batch.to_dict())
+
+def get_auth_url():
+    """Dropbox認証URLを取得"""
+    return get_dropbox_auth_flow().start()
+
+def get_dropbox_auth_flow():
+    """Dropbox OAuth2認証フローを取得（一度作ったものを使い回す）
+
+    CSRFトークンはFlaskのセッションに保存するため、startとfinishが
+    別のリクエストでも同じフローで検証できる
+    """
+    global oauth_flow
+    if oauth_flow is None:
+        from dropbox.oauth import DropboxOAuth2Flow
+        oauth_flow = DropboxOAuth2Flow(
+            APP_KEY,
+            REDIRECT_URI,
+            session,
+            "dropbox-auth-csrf-token",
+            consumer_secret=APP_SECRET,
+            token_access_type='offline'  # リフレッシュトークンを受け取る
+        )
+    return oauth_flow
\ No newline at end of file
@@ -0,0 +1,283 @@
+# dropbox_uploader.py
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+
+import dropbox
+import requests
+from dropbox.exceptions import ApiError, AuthError, InternalServerError, RateLimitError
+from dropbox.files import (CommitInfo, UploadSessionCursor, UploadSessionFinishArg, UploadSessionFinishError,
+                           WriteMode)
+
+import metrics
+
+# セッションで1回に送る大きさ。Dropboxの推奨に合わせて4MBの倍数にする（上限は150MB）
+CHUNK_SIZE = 8 * 1024 * 1024
+MAX_CONNECTIONS = 8
+# finish_batchで一度にコミットできるファイル数の上限
+BATCH_LIMIT = 1000
+
+# 送り直せば成功する可能性があるエラー
+TRANSIENT_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    InternalServerError,
+    RateLimitError,
+)
+
+# トークンごとのクライアント（HTTPの接続プールを含む）
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(token, session=None, refresh_token=None, expires_at=None, app_key=None, app_secret=None):
+    """トークンごとにDropboxクライアントを1つだけ作り、接続を使い回す
+
+    refresh_tokenを渡した場合はそれをキーにし、アクセストークンの期限が切れたら
+    クライアントが自動で更新する。5xxエラーの再送はDropboxUploaderが受け取り済みの
+    位置から行うため、SDK側では再送しない
+    """
+    key = refresh_token or token
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            session = session or dropbox.create_session(max_connections=MAX_CONNECTIONS)
+            if _observe_round_trip not in session.hooks['response']:
+                session.hooks['response'].append(_observe_round_trip)
+            client = dropbox.Dropbox(
+                token,
+                session=session,
+                max_retries_on_error=0,
+                oauth2_refresh_token=refresh_token,
+                oauth2_access_token_expiration=expires_at,
+                app_key=app_key,
+                app_secret=app_secret,
+            )
+            _clients[key] = client
+        return client
+
+
+def _observe_round_trip(response, *args, **kwargs):
+    """APIの呼び出しごとに、リクエストを送ってからレスポンスのヘッダーを受け取るまでの時間を記録する"""
+    # 例: https://content.dropboxapi.com/2/files/upload_session/append_v2 -> dropbox_files/upload_session/append_v2
+    route = urlsplit(response.url).path.split('/2/', 1)[-1]
+    body = response.request.body
+    metrics.observe(f'dropbox_{route}', response.elapsed.total_seconds(),
+                    len(body) if isinstance(body, (bytes, bytearray)) else None)
+
+
+def forget_client(token):
+    """無効になったトークン（リフレッシュトークンがあればそちら）のクライアントを破棄する"""
+    with _clients_lock:
+        _clients.pop(token, None)
+
+
+def _correct_offset(error):
+    """セッションのオフセットのずれを示すエラーなら、サーバーが受け取り済みのバイト数を返す"""
+    if isinstance(error, UploadSessionFinishError):
+        if not error.is_lookup_failed():
+            return None
+        error = error.get_lookup_failed()
+    if getattr(error, 'is_incorrect_offset', None) and error.is_incorrect_offset():
+        return error.get_incorrect_offset().correct_offset
+    return None
+
+
+class BatchUpload:
+    """複数ファイルを一括でアップロードしたときの、ファイルごとの状態と全体のスループット
+
+    statusはpending → uploading → uploaded → committed（失敗した場合はfailed）と進む。
+    共有リンクはコミット後に別のスレッドで作成し、終わったものからshared_linkに入る
+    """
+
+    def __init__(self, paths):
+        self.id = uuid.uuid4().hex
+        self.created = time.time()
+        self.seconds = None
+        self.files = [{'path': path, 'size': None, 'status': 'pending', 'error': None,
+                       'shared_link': None, 'link_error': None} for path in paths]
+        self._lock = threading.Lock()
+
+    def update(self, index, **fields):
+        with self._lock:
+            self.files[index].update(fields)
+
+    def to_dict(self):
+        with self._lock:
+            files = [dict(entry) for entry in self.files]
+        committed = [entry for entry in files if entry['status'] == 'committed']
+        committed_bytes = sum(entry['size'] for entry in committed)
+        return {
+            'id': self.id,
+            'files': files,
+            'committed_files': len(committed),
+            'failed_files': sum(1 for entry in files if entry['status'] == 'failed'),
+            'committed_bytes': committed_bytes,
+            'seconds': self.seconds,
+            'throughput_mb_s': committed_bytes / self.seconds / (1024 * 1024) if self.seconds else None,
+            'links_pending': sum(1 for entry in committed if not (entry['shared_link'] or entry['link_error'])),
+        }
+
+
+class DropboxUploader:
+    """ストリームをチャンクごとにDropboxへ送る
+
+    1チャンクに収まるものはfiles_uploadで1回で送り、それより大きいものは
+    アップロードセッション（start/append/finish）で送る。チャンクの送信に失敗した場合は、
+    サーバーが受け取り済みの位置から送り直す
+    """
+
+    def __init__(self, client, chunk_size=CHUNK_SIZE, max_retries=3, retry_wait=1.0):
+        self.client = client
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.retry_wait = retry_wait
+        self.retries = 0
+
+    def upload(self, stream, path, mode=WriteMode.overwrite):
+        """streamの現在位置から末尾までをpathにアップロードし、FileMetadataを返す"""
+        chunk = stream.read(self.chunk_size)
+        next_chunk = stream.read(self.chunk_size)
+        if not next_chunk:
+            # 1チャンクに収まる場合はセッションを作らずに送る（上書きなので送り直しても同じ結果になる）
+            return self._retry(lambda: self.client.files_upload(chunk, path, mode=mode))
+
+        session_id = self._retry(lambda: self.client.files_upload_session_start(chunk).session_id)
+        cursor = UploadSessionCursor(session_id=session_id, offset=len(chunk))
+        chunk, next_chunk = next_chunk, stream.read(self.chunk_size)
+        while next_chunk:
+            self._send(chunk, cursor, lambda data: self.client.files_upload_session_append_v2(data, cursor),
+                       skip_received=True)
+            chunk, next_chunk = next_chunk, stream.read(self.chunk_size)
+
+        commit = CommitInfo(path=path, mode=mode)
+        return self._send(chunk, cursor, lambda data: self.client.files_upload_session_finish(data, cursor, commit))
+
+    def upload_batch(self, items, mode=WriteMode.overwrite, max_workers=4, link_executor=None):
+        """(stream, path) の組を並列にセッションへ送り、finish_batchでまとめてコミットする
+
+        1ファイルの失敗は他のファイルに影響しない（AuthErrorは全体の失敗として送出する）。link_executorを渡すと、コミットした
+        ファイルの共有リンクをそこで非同期に作成する。戻り値のBatchUploadは
+        リンクの作成が終わるたびに更新される
+        """
+        batch = BatchUpload([path for _, path in items])
+        start = time.perf_counter()
+
+        staged = []  # (index, UploadSessionFinishArg)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(self._stage, batch, index, stream, path, mode): index
+                       for index, (stream, path) in enumerate(items)}
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    staged.append((index, future.result()))
+                except AuthError:
+                    raise
+                except Exception as e:
+                    batch.update(index, status='failed', error=str(e))
+        staged.sort(key=lambda item: item[0])
+
+        committed = []
+        for offset in range(0, len(staged), BATCH_LIMIT):
+            group = staged[offset:offset + BATCH_LIMIT]
+            try:
+                result = self._retry(
+                    lambda: self.client.files_upload_session_finish_batch_v2([arg for _, arg in group]))
+            except AuthError:
+                raise
+            except Exception as e:
+                for index, _ in group:
+                    batch.update(index, status='failed', error=str(e))
+                continue
+            for (index, arg), entry in zip(group, result.entries):
+                if entry.is_success():
+                    batch.update(index, status='committed')
+                    committed.append((index, entry.get_success().path_display or arg.commit.path))
+                else:
+                    batch.update(index, status='failed', error=str(entry.get_failure()))
+        batch.seconds = time.perf_counter() - start
+
+        if link_executor is not None:
+            for index, path in committed:
+                link_executor.submit(self._share, batch, index, path)
+        return batch
+
+    def _stage(self, batch, index, stream, path, mode):
+        """ファイルをセッションに送り切って閉じ、finish_batchに渡す引数を返す"""
+        batch.update(index, status='uploading')
+        chunk = stream.read(self.chunk_size)
+        next_chunk = stream.read(self.chunk_size)
+        # finish_batchでコミットするには、最後のチャンクでセッションを閉じておく必要がある
+        session_id = self._retry(
+            lambda: self.client.files_upload_session_start(chunk, close=not next_chunk).session_id)
+        cursor = UploadSessionCursor(session_id=session_id, offset=len(chunk))
+        while next_chunk:
+            chunk, next_chunk = next_chunk, stream.read(self.chunk_size)
+            close = not next_chunk
+            self._send(chunk, cursor, lambda data: self.client.files_upload_session_append_v2(data, cursor, close=close),
+                       skip_received=True)
+        batch.update(index, status='uploaded', size=cursor.offset)
+        return UploadSessionFinishArg(cursor=cursor, commit=CommitInfo(path=path, mode=mode))
+
+    def _share(self, batch, index, path):
+        """共有リンクを作成してbatchに記録する。既にリンクがあればそれを使う"""
+        try:
+            url = self.client.sharing_create_shared_link_with_settings(path).url
+        except ApiError as e:
+            existing = e.error.get_shared_link_already_exists() if e.error.is_shared_link_already_exists() else None
+            if existing is None or not existing.is_metadata():
+                batch.update(index, link_error=str(e))
+                return
+            url = existing.get_metadata().url
+        except Exception as e:
+            batch.update(index, link_error=str(e))
+            return
+        batch.update(index, shared_link=url)
+
+    def _send(self, chunk, cursor, call, skip_received=False):
+        """chunkのうちサーバーが受け取っていない部分をcallで送り、cursorを進める
+
+        接続が切れた場合など、サーバーが実際には受け取っていることがある。その場合は
+        incorrect_offsetのエラーで受け取り済みの位置が返るので、そこから続きを送る。
+        skip_receivedがTrueなら、全て受け取り済みのときは何も送らずに終える（appendの場合）
+        """
+        start = cursor.offset
+        attempt = 0
+        while True:
+            sent = cursor.offset - start
+            if skip_received and sent == len(chunk):
+                return None
+            try:
+                result = call(chunk[sent:] if sent else chunk)
+                cursor.offset = start + len(chunk)
+                return result
+            except ApiError as e:
+                offset = _correct_offset(e.error)
+                if offset is None or not start <= offset <= start + len(chunk):
+                    raise
+                cursor.offset = offset
+                error = e
+            except TRANSIENT_ERRORS as e:
+                error = e
+            attempt += 1
+            if attempt > self.max_retries:
+                raise error
+            self.retries += 1
+            metrics.count('dropbox_retry')
+            time.sleep(self.retry_wait * 2 ** (attempt - 1))
+
+    def _retry(self, call):
+        """送り直しても結果が変わらない呼び出しを、一時的なエラーの間だけ繰り返す"""
+        attempt = 0
+        while True:
+            try:
+                return call()
+            except TRANSIENT_ERRORS:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                self.retries += 1
+                metrics.count('dropbox_retry')
+                time.sleep(self.retry_wait * 2 ** (attempt - 1))
@@ -1,34 +1,265 @@
 import os
 from pathlib import Path
-import cv2
 import numpy as np
 from PIL import Image
-from sklearn.cluster import KMeans
-from flask import Flask, request, render_template, send_file, url_for
+from flask import Blueprint, request, render_template, send_file, url_for, jsonify, abort, make_response, Response, stream_with_context
+from werkzeug.utils import secure_filename
 import io
-import base64
+import json
+import math
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-app = Flask(__name__)
+import ingest
+import metrics
+from image_executor import ImageExecutor, ExecutorBusyError
+from page_cache import pages
+from palette_cache import PaletteCache, file_digest
+from result_store import ResultStore
 
-# アップロードされたファイルの一時保存先
+# 色の分析。sklearnは読み込みに時間とメモリを使うため、分析を最初に実行するときに読み込む
+bp = Blueprint('colors', __name__)
+
+# 画像1枚は50MB、一括分析のリクエスト全体は1GBまで受け付ける
+MAX_FILE_SIZE = 50 * 1024 * 1024
+MAX_REQUEST_SIZE = 1024 * 1024 * 1024
+ingest.init_blueprint(bp, max_content_length=MAX_REQUEST_SIZE, max_file_size=MAX_FILE_SIZE)
+
+# アップロードされたファイルの一時保存先（アプリに登録するときに作成する）
 UPLOAD_FOLDER = 'uploads'
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+bp.record_once(lambda state: os.makedirs(UPLOAD_FOLDER, exist_ok=True))
+
+# 代表色の抽出方法（'kmeans', 'minibatch', 'mediancut'）
+PALETTE_ENGINES = ('kmeans', 'minibatch', 'mediancut')
+PALETTE_ENGINE = 'kmeans'
+# 代表色の抽出に使うピクセル数の上限（Noneなら全ピクセルを使う）
+PALETTE_MAX_SAMPLES = None
+
+# 同じ画像の分析結果を使い回すキャッシュ（disk_dirを指定するとディスクにも保存する）
+palette_cache = PaletteCache(max_bytes=64 * 1024 * 1024, disk_dir=None)
+
+# 結果画像の出力形式（形式 -> MIMEタイプ）と品質
+RESULT_FORMATS = {'WEBP': 'image/webp', 'JPEG': 'image/jpeg', 'PNG': 'image/png'}
+RESULT_FORMAT = 'WEBP'
+RESULT_QUALITY = 85
+
+# 一括分析で受け付ける画像の数と拡張子
+MAX_BATCH_FILES = 200
+# 受け付けた一括分析の各画像が、ワーカープロセスの空きを待つ時間（秒）
+BATCH_WAIT = 60
+# ZIPファイルから取り出す画像の合計サイズの上限（1枚ごとの上限はMAX_FILE_SIZE）
+MAX_BATCH_EXTRACT_BYTES = MAX_REQUEST_SIZE
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp', '.tif', '.tiff'}
+
+# 結果画像を短時間保持し、専用のURLから配信する
+result_store = ResultStore(ttl=600)
 
-def get_main_color_list_img(img_path, n_clusters=5, img_size=64, margin=15):
+# 分析処理をリクエストスレッドから切り離して実行するワーカープロセス
+image_executor = ImageExecutor(timeout=30)
+
+def load_image(img_path, max_dimension=1000):
     """
-    対象の画像のメインカラーを算出し、色を横並びにしたPILの画像を取得する。
+    画像を一度だけデコードし、長辺がmax_dimension以下のRGB画像を取得する。
+
+    JPEGはデコード時に1/2〜1/8へ縮小して読み込むため（draft）、
+    フル解像度の画像をメモリに展開せずに済む。
     
     Parameters
     ----------
     img_path : str
         対象の画像のパス。
+    max_dimension : int, optional
+        長辺の最大サイズ。デフォルトは1000px。
+    
+    Returns
+    -------
+    img : Image
+        縮小後のRGB画像。
+    
+    Raises
+    ------
+    FileNotFoundError
+        画像ファイルが見つからない場合
+    ValueError
+        画像の読み込みに失敗した場合
+    """
+    try:
+        img = Image.open(fp=img_path)
+        # JPEG以外では何もしない
+        img.draft('RGB', (max_dimension, max_dimension))
+        img = img.convert('RGB')
+        img.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        return img
+    except FileNotFoundError:
+        raise FileNotFoundError(f"画像ファイルが見つかりません: {img_path}")
+    except Exception as e:
+        raise ValueError(f"画像の読み込みに失敗しました: {img_path} ({str(e)})")
+
+def _median_cut(pixels, n_colors, refine_iterations=5):
+    """
+    各チャンネル5bitの色ヒストグラムを作り、メディアンカットで代表色を求める。
+
+    誤差（重み付きの二乗和）が最も大きいボックスを、分散が最大のチャンネルの
+    重み付き中央値で分割することを繰り返す。最後にヒストグラム上で
+    k-meansの更新を数回行い、KMeansの結果に近づける。
+    """
+    quantized = pixels.astype(np.int32) >> 3
+    keys = (quantized[:, 0] << 10) | (quantized[:, 1] << 5) | quantized[:, 2]
+    counts = np.bincount(keys, minlength=1 << 15)
+    used = np.nonzero(counts)[0]
+    weights = counts[used].astype(np.float64)
+    # ビンごとの平均色
+    colors = np.stack([
+        np.bincount(keys, weights=pixels[:, c], minlength=1 << 15)[used]
+        for c in range(3)
+    ], axis=1) / weights[:, None]
+
+    def box_error(box_colors, box_weights):
+        mean = np.average(box_colors, axis=0, weights=box_weights)
+        return float((box_weights[:, None] * (box_colors - mean) ** 2).sum())
+
+    boxes = [(colors, weights)]
+    errors = [box_error(colors, weights)]
+    while len(boxes) < n_colors:
+        i = int(np.argmax(errors))
+        if errors[i] <= 0:
+            break
+        box_colors, box_weights = boxes.pop(i)
+        errors.pop(i)
+
+        mean = np.average(box_colors, axis=0, weights=box_weights)
+        variance = np.average((box_colors - mean) ** 2, axis=0, weights=box_weights)
+        order = np.argsort(box_colors[:, int(np.argmax(variance))], kind='stable')
+        box_colors, box_weights = box_colors[order], box_weights[order]
+        split = int(np.searchsorted(np.cumsum(box_weights), box_weights.sum() / 2)) + 1
+        split = min(max(split, 1), len(box_weights) - 1)
+
+        for part in ((box_colors[:split], box_weights[:split]), (box_colors[split:], box_weights[split:])):
+            boxes.append(part)
+            errors.append(box_error(*part))
+
+    centers = np.array([np.average(box_colors, axis=0, weights=box_weights) for box_colors, box_weights in boxes])
+
+    # ビンの数は高々32768なので、重み付きのk-means更新も安く済む
+    for _ in range(refine_iterations):
+        labels = ((colors[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+        totals = np.bincount(labels, weights=weights, minlength=len(centers))
+        if (totals == 0).any():
+            break
+        centers = np.stack([
+            np.bincount(labels, weights=weights * colors[:, c], minlength=len(centers))
+            for c in range(3)
+        ], axis=1) / totals[:, None]
+
+    # 色数が足りない（単色の画像など）場合は最後の色で埋める
+    if len(centers) < n_colors:
+        centers = np.vstack([centers, np.repeat(centers[-1:], n_colors - len(centers), axis=0)])
+    return centers
+
+def extract_palette(pixels, n_clusters=5, engine=None, max_samples=None, seed=42):
+    """
+    ピクセルの配列から代表色を抽出する。
+    
+    Parameters
+    ----------
+    pixels : ndarray
+        (ピクセル数, 3) のRGB配列。
+    n_clusters : int, optional
+        抽出する色の数。デフォルトは5。
+    engine : str, optional
+        'kmeans'、'minibatch'（MiniBatchKMeans）、'mediancut'のいずれか。
+        デフォルトはPALETTE_ENGINE。
+    max_samples : int, optional
+        使用するピクセル数の上限。超えた分はseedで決まる乱数で間引く。
+        デフォルトはPALETTE_MAX_SAMPLES。
+    seed : int, optional
+        乱数のシード。デフォルトは42。
+    
+    Returns
+    -------
+    cluster_centers_arr : ndarray
+        (n_clusters, 3) の代表色の配列。
+    
+    Raises
+    ------
+    ValueError
+        engineが不正な場合
+    """
+    engine = engine or PALETTE_ENGINE
+    max_samples = max_samples or PALETTE_MAX_SAMPLES
+
+    if max_samples and len(pixels) > max_samples:
+        rng = np.random.default_rng(seed)
+        pixels = pixels[rng.choice(len(pixels), max_samples, replace=False)]
+
+    if engine == 'kmeans':
+        from sklearn.cluster import KMeans
+        cluster = KMeans(n_clusters=n_clusters, random_state=seed)
+    elif engine == 'minibatch':
+        from sklearn.cluster import MiniBatchKMeans
+        cluster = MiniBatchKMeans(n_clusters=n_clusters, random_state=seed, batch_size=1024, n_init=1, max_iter=20)
+    elif engine == 'mediancut':
+        return _median_cut(pixels, n_clusters).astype(int)
+    else:
+        raise ValueError(f"不明な抽出方法です: {engine}")
+
+    cluster.fit(X=pixels)
+    return cluster.cluster_centers_.astype(int, copy=False)
+
+def render_color_list_img(cluster_centers_arr, img_size=64, margin=15):
+    """
+    代表色の配列から、色を横並びにしたPILの画像を作成する。
+    
+    Parameters
+    ----------
+    cluster_centers_arr : ndarray
+        (色の数, 3) のRGB配列。
+    img_size : int, optional
+        出力画像の各色のサイズ。デフォルトは64。
+    margin : int, optional
+        出力画像の余白。デフォルトは15。
+    
+    Returns
+    -------
+    tiled_color_img : Image
+        色を横並びにしたPILの画像。
+    """
+    width = img_size * len(cluster_centers_arr) + margin * 2
+    height = img_size + margin * 2
+    
+    tiled_color_img = Image.new(
+        mode='RGB', size=(width, height), color='#333333')
+    
+    for i, rgb_arr in enumerate(cluster_centers_arr):
+        color_hex_str = '#%02x%02x%02x' % tuple(rgb_arr)
+        color_img = Image.new(
+            mode='RGB', size=(img_size, img_size),
+            color=color_hex_str)
+        tiled_color_img.paste(
+            im=color_img,
+            box=(margin + img_size * i, margin))
+    return tiled_color_img
+
+def get_main_color_list_img(img_path, n_clusters=5, img_size=64, margin=15, engine=None, max_samples=None):
+    """
+    対象の画像のメインカラーを算出し、色を横並びにしたPILの画像を取得する。
+    
+    Parameters
+    ----------
+    img_path : str or Image
+        対象の画像のパス、またはload_imageで読み込んだ画像。
     n_clusters : int, optional
         抽出する色の数。デフォルトは5。
     img_size : int, optional
         出力画像の各色のサイズ。デフォルトは64。
     margin : int, optional
         出力画像の余白。デフォルトは15。
+    engine : str, optional
+        代表色の抽出方法。extract_paletteを参照。
+    max_samples : int, optional
+        代表色の抽出に使うピクセル数の上限。extract_paletteを参照。
     
     Returns
     -------
@@ -43,45 +274,14 @@ def get_main_color_list_img(img_path, n_clusters=5, img_size=64, margin=15):
         画像の読み込みに失敗した場合
     """
     try:
-        cv2_img = cv2.imread(img_path)
-        if cv2_img is None:
-            raise ValueError(f"画像の読み込みに失敗しました: {img_path}")
-            
-        cv2_img = cv2.cvtColor(cv2_img, cv2.COLOR_BGR2RGB)
-        
-        # メモリ使用量を削減するため、画像をリサイズ
-        max_dimension = 1000
-        height, width = cv2_img.shape[:2]
-        if max(height, width) > max_dimension:
-            scale = max_dimension / max(height, width)
-            new_width = int(width * scale)
-            new_height = int(height * scale)
-            cv2_img = cv2.resize(cv2_img, (new_width, new_height))
+        img = img_path if isinstance(img_path, Image.Image) else load_image(img_path)
+        pixels = np.asarray(img).reshape(-1, 3)
         
-        cv2_img = cv2_img.reshape((cv2_img.shape[0] * cv2_img.shape[1], 3))
-        
-        cluster = KMeans(n_clusters=n_clusters, random_state=42)
-        cluster.fit(X=cv2_img)
-        cluster_centers_arr = cluster.cluster_centers_.astype(int, copy=False)
-        
-        width = img_size * n_clusters + margin * 2
-        height = img_size + margin * 2
-        
-        tiled_color_img = Image.new(
-            mode='RGB', size=(width, height), color='#333333')
-        
-        for i, rgb_arr in enumerate(cluster_centers_arr):
-            color_hex_str = '#%02x%02x%02x' % tuple(rgb_arr)
-            color_img = Image.new(
-                mode='RGB', size=(img_size, img_size),
-                color=color_hex_str)
-            tiled_color_img.paste(
-                im=color_img,
-                box=(margin + img_size * i, margin))
-        return tiled_color_img
+        cluster_centers_arr = extract_palette(pixels, n_clusters, engine, max_samples)
+        return render_color_list_img(cluster_centers_arr, img_size, margin)
         
     except FileNotFoundError:
-        raise FileNotFoundError(f"画像ファイルが見つかりません: {img_path}")
+        raise
     except Exception as e:
         raise ValueError(f"画像処理中にエラーが発生しました: {str(e)}")
 
@@ -91,8 +291,8 @@ def get_original_small_img(img_path, max_width=500):
     
     Parameters
     ----------
-    img_path : str
-        対象の画像のパス。
+    img_path : str or Image
+        対象の画像のパス、またはload_imageで読み込んだ画像。
     max_width : int, optional
         最大幅。デフォルトは500px。
     
@@ -109,7 +309,7 @@ def get_original_small_img(img_path, max_width=500):
         画像の読み込みに失敗した場合
     """
     try:
-        img = Image.open(fp=img_path)
+        img = img_path if isinstance(img_path, Image.Image) else load_image(img_path)
         
         # アスペクト比を保持しながらリサイズ
         if img.width > max_width:
@@ -120,30 +320,26 @@ def get_original_small_img(img_path, max_width=500):
         
         return img
     except FileNotFoundError:
-        raise FileNotFoundError(f"画像ファイルが見つかりません: {img_path}")
+        raise
     except Exception as e:
         raise ValueError(f"画像処理中にエラーが発生しました: {str(e)}")
 
-def process_image(img_path):
+def compose_result_img(small_img, color_img):
     """
-    画像を処理して結果画像を生成する。
+    元画像の縮小版の下にカラーチャートを配置した結果画像を作成する。
     
     Parameters
     ----------
-    img_path : str
-        対象の画像のパス。
+    small_img : Image
+        元画像の縮小版。
+    color_img : Image
+        カラーチャートの画像。
     
     Returns
     -------
     result_img : Image
         処理結果の画像。
     """
-    # 色の抽出
-    color_img = get_main_color_list_img(img_path)
-    
-    # 元画像の縮小版
-    small_img = get_original_small_img(img_path)
-    
     # 結果画像の作成（元画像の下にカラーチャート）
     result_width = max(small_img.width, color_img.width)
     result_height = small_img.height + color_img.height + 20
@@ -160,11 +356,253 @@ def process_image(img_path):
     
     return result_img
 
-@app.route('/')
-def index():
-    return render_template('index.html')
+def process_image(img_path, engine=None, max_samples=None):
+    """
+    画像を処理して結果画像を生成する。
+    
+    Parameters
+    ----------
+    img_path : str
+        対象の画像のパス。
+    engine : str, optional
+        代表色の抽出方法。extract_paletteを参照。
+    max_samples : int, optional
+        代表色の抽出に使うピクセル数の上限。extract_paletteを参照。
+    
+    Returns
+    -------
+    result_img : Image
+        処理結果の画像。
+    """
+    # デコードは一度だけ行い、色の抽出とプレビューで同じ画像を使う
+    img = load_image(img_path)
+    
+    # 色の抽出
+    color_img = get_main_color_list_img(img, engine=engine, max_samples=max_samples)
+    
+    # 元画像の縮小版
+    small_img = get_original_small_img(img)
+    
+    return compose_result_img(small_img, color_img)
+
+def render_analysis(img_path, n_clusters=5, img_size=64, margin=15, engine=None, max_samples=None,
+                    output_format='PNG', quality=RESULT_QUALITY):
+    """
+    画像をデコードして代表色を抽出し、エンコードした結果画像を作成する。
+
+    キャッシュを使わない重い処理の本体で、ワーカープロセスでも実行される。
+    引数はanalyze_imageを参照。
+    
+    Returns
+    -------
+    cluster_centers_arr : ndarray
+        (n_clusters, 3) の代表色の配列。
+    result_data : bytes
+        output_formatでエンコードした結果画像。
+    """
+    with metrics.stage('image_decode'):
+        img = load_image(img_path)
+    with metrics.stage(f'palette_{engine or PALETTE_ENGINE}'):
+        cluster_centers_arr = extract_palette(np.asarray(img).reshape(-1, 3), n_clusters, engine, max_samples)
+    with metrics.stage('result_encode') as timing:
+        result_img = compose_result_img(
+            get_original_small_img(img),
+            render_color_list_img(cluster_centers_arr, img_size, margin))
+        
+        buffered = io.BytesIO()
+        result_img.save(buffered, format=output_format, quality=quality)
+        timing.nbytes = buffered.tell()
+    return cluster_centers_arr, buffered.getvalue()
+
+def analyze_image(img_path, n_clusters=5, img_size=64, margin=15, engine=None, max_samples=None,
+                  output_format='PNG', quality=RESULT_QUALITY, executor=None, digest=None, wait=None):
+    """
+    画像を分析し、代表色とエンコードした結果画像を取得する。
+
+    同じ内容の画像を同じ条件で分析した結果はpalette_cacheから返すため、
+    2回目以降はデコード・クラスタリング・エンコードを行わない。
+    
+    Parameters
+    ----------
+    img_path : str
+        対象の画像のパス。
+    n_clusters : int, optional
+        抽出する色の数。デフォルトは5。
+    img_size : int, optional
+        出力画像の各色のサイズ。デフォルトは64。
+    margin : int, optional
+        出力画像の余白。デフォルトは15。
+    engine : str, optional
+        代表色の抽出方法。extract_paletteを参照。
+    max_samples : int, optional
+        代表色の抽出に使うピクセル数の上限。extract_paletteを参照。
+    output_format : str, optional
+        結果画像の形式（'PNG', 'WEBP', 'JPEG'）。デフォルトは'PNG'。
+    quality : int, optional
+        WEBP/JPEGの品質。デフォルトはRESULT_QUALITY。
+    executor : ImageExecutor, optional
+        指定した場合、キャッシュに無い画像の処理をワーカープロセスで実行する。
+    digest : str, optional
+        画像の内容のSHA-256。受信時に計算済みなら渡すと、ファイルを読み直さずに済む。
+    wait : float, optional
+        executorに空きが無い場合に待つ秒数。Noneなら待たずにExecutorBusyErrorを送出する。
+    
+    Returns
+    -------
+    cluster_centers_arr : ndarray
+        (n_clusters, 3) の代表色の配列。
+    result_data : bytes
+        output_formatでエンコードした結果画像。
+    
+    Raises
+    ------
+    ExecutorBusyError
+        ワーカープロセスの待ちが上限に達している場合（waitを指定した場合は、その秒数待っても空かない場合）
+    TimeoutError
+        ワーカープロセスでの処理が時間内に終わらなかった場合
+    """
+    engine = engine or PALETTE_ENGINE
+    max_samples = max_samples or PALETTE_MAX_SAMPLES
+    key = PaletteCache.make_key(
+        digest or file_digest(img_path), n_clusters=n_clusters, img_size=img_size, margin=margin,
+        engine=engine, max_samples=max_samples, output_format=output_format, quality=quality)
+    cached = palette_cache.get(key)
+    if cached is not None:
+        metrics.count('palette_cache_hit')
+        return cached
+    metrics.count('palette_cache_miss')
+    
+    args = (img_path, n_clusters, img_size, margin, engine, max_samples, output_format, quality)
+    if executor is not None:
+        cluster_centers_arr, result_data = executor.run(render_analysis, *args, wait=wait)
+    else:
+        cluster_centers_arr, result_data = render_analysis(*args)
+    return palette_cache.put(key, cluster_centers_arr, result_data)
+
+def render_contact_sheet(result_datas, thumb_width=250, quality=RESULT_QUALITY):
+    """
+    複数の結果画像を格子状に並べた一覧画像を作成し、JPEGのバイト列を返す。
+    
+    Parameters
+    ----------
+    result_datas : list of bytes
+        エンコード済みの結果画像。
+    thumb_width : int, optional
+        一覧での各画像の幅。デフォルトは250px。
+    quality : int, optional
+        JPEGの品質。デフォルトはRESULT_QUALITY。
+    
+    Returns
+    -------
+    sheet_data : bytes
+        JPEGにエンコードした一覧画像。
+    """
+    thumbs = []
+    for data in result_datas:
+        thumb = Image.open(io.BytesIO(data)).convert('RGB')
+        thumb.thumbnail((thumb_width, thumb_width * 4), Image.LANCZOS)
+        thumbs.append(thumb)
+    
+    columns = math.ceil(math.sqrt(len(thumbs)))
+    rows = math.ceil(len(thumbs) / columns)
+    cell_height = max(thumb.height for thumb in thumbs)
+    margin = 10
+    sheet = Image.new(
+        'RGB',
+        (columns * (thumb_width + margin) + margin, rows * (cell_height + margin) + margin),
+        '#333333')
+    for i, thumb in enumerate(thumbs):
+        row, column = divmod(i, columns)
+        sheet.paste(thumb, (margin + column * (thumb_width + margin), margin + row * (cell_height + margin)))
+    
+    buffered = io.BytesIO()
+    sheet.save(buffered, format='JPEG', quality=quality)
+    return buffered.getvalue()
+
+def requested_format():
+    """フォームのformat（WEBP, JPEG, PNG）を返す。指定が無いか不正な場合はRESULT_FORMAT"""
+    output_format = request.form.get('format', RESULT_FORMAT).upper()
+    return output_format if output_format in RESULT_FORMATS else RESULT_FORMAT
+
+def store_result(img_path, output_format=RESULT_FORMAT, digest=None, wait=None):
+    """
+    画像を分析して結果画像をresult_storeに保存し、(代表色, 結果のID) を返す。
+    waitはワーカープロセスに空きが無い場合に待つ秒数（analyze_imageを参照）。
+    """
+    cluster_centers_arr, result_data = analyze_image(
+        img_path, output_format=output_format, quality=RESULT_QUALITY, executor=image_executor, digest=digest,
+        wait=wait)
+    return cluster_centers_arr, result_store.put(result_data, RESULT_FORMATS[output_format])
+
+def save_batch_files(batch_dir):
+    """
+    一括分析用にアップロードされた画像（images[]、またはZIPファイルのarchive）を保存する。
+    
+    Returns
+    -------
+    saved : list of (str, str, str or None)
+        (元のファイル名, 保存先のパス, 受信時に計算したSHA-256) のリスト。
+        ZIPファイルから取り出した画像のダイジェストはNone。
+    
+    Raises
+    ------
+    ValueError
+        画像の数が上限を超えている場合、ZIPファイルから取り出す画像の大きさが
+        上限を超えている場合、またはZIPファイルが壊れている場合
+    """
+    saved = []
+    extracted = 0
+    
+    def add(filename, source, digest=None):
+        if len(saved) >= MAX_BATCH_FILES:
+            raise ValueError(f'一度に分析できる画像は{MAX_BATCH_FILES}枚までです')
+        path = os.path.join(batch_dir, f'{len(saved):04d}_{secure_filename(filename)}')
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(source, f)
+        saved.append((filename, path, digest))
+    
+    def extract(zipf, info):
+        nonlocal extracted
+        if len(saved) >= MAX_BATCH_FILES:
+            raise ValueError(f'一度に分析できる画像は{MAX_BATCH_FILES}枚までです')
+        filename = os.path.basename(info.filename)
+        # ヘッダーのサイズで先に断り、偽られていても展開しながら数えて止める
+        if info.file_size > MAX_FILE_SIZE:
+            raise ValueError(f'{filename} のサイズが上限（{MAX_FILE_SIZE}バイト）を超えています')
+        path = os.path.join(batch_dir, f'{len(saved):04d}_{secure_filename(filename)}')
+        size = 0
+        with zipf.open(info) as source, open(path, 'wb') as f:
+            while True:
+                chunk = source.read(1024 * 1024)
+                if not chunk:
+                    break
+                size += len(chunk)
+                extracted += len(chunk)
+                if size > MAX_FILE_SIZE:
+                    raise ValueError(f'{filename} のサイズが上限（{MAX_FILE_SIZE}バイト）を超えています')
+                if extracted > MAX_BATCH_EXTRACT_BYTES:
+                    raise ValueError(f'ZIPファイルから取り出す画像の合計が上限（{MAX_BATCH_EXTRACT_BYTES}バイト）を超えています')
+                f.write(chunk)
+        saved.append((filename, path, None))
+    
+    for file in request.files.getlist('images[]'):
+        if file.filename:
+            add(file.filename, file.stream, ingest.upload_digest(file))
+    
+    archive = request.files.get('archive')
+    if archive and archive.filename:
+        try:
+            with zipfile.ZipFile(archive.stream) as zipf:
+                for info in zipf.infolist():
+                    if info.is_dir() or os.path.splitext(info.filename)[1].lower() not in IMAGE_EXTENSIONS:
+                        continue
+                    extract(zipf, info)
+        except zipfile.BadZipFile:
+            raise ValueError('ZIPファイルを読み込めませんでした')
+    
+    return saved
 
-@app.route('/upload', methods=['POST'])
+@bp.route('/colors/upload', methods=['POST'])
 def upload_file():
     if 'file' not in request.files:
         return 'ファイルがありません', 400
@@ -174,31 +612,33 @@ def upload_file():
         return 'ファイルが選択されていません', 400
     
     if file:
-        # ファイルを一時保存
-        filename = os.path.join(UPLOAD_FOLDER, file.filename)
-        file.save(filename)
+        # ファイルを一時保存（同じファイル名の同時アップロードでも上書きしないよう一意な名前にする）
+        filename = ingest.save_upload(file, UPLOAD_FOLDER)
         
         try:
-            # 画像を処理
-            result_img = process_image(filename)
-            
-            # 結果画像をBase64エンコード
-            buffered = io.BytesIO()
-            result_img.save(buffered, format="PNG")
-            img_str = base64.b64encode(buffered.getvalue()).decode()
+            # 画像を処理し、結果画像は専用のURLから配信する（同じ画像の結果はキャッシュから返る）
+            _, result_id = store_result(filename, requested_format(), ingest.upload_digest(file))
+            result_url = url_for('.colors_result', result_id=result_id)
             
             # 一時ファイルを削除
             os.remove(filename)
             
-            return render_template('result.html', image_data=img_str)
+            return render_template('result.html', result_url=result_url)
             
+        except ExecutorBusyError as e:
+            os.remove(filename)
+            return str(e), 503, {'Retry-After': '5'}
+        except TimeoutError:
+            os.remove(filename)
+            return '処理がタイムアウトしました', 504
         except Exception as e:
             # エラーが発生した場合も一時ファイルを削除
             if os.path.exists(filename):
                 os.remove(filename)
             return f'エラーが発生しました: {str(e)}', 500
 
-@app.route('/colors.html', methods=['GET', 'POST'])
+@bp.route('/colors.html', methods=['GET', 'POST'])
+@pages.page
 def colors():
     if request.method == 'POST':
         if 'file' not in request.files:
@@ -209,24 +649,25 @@ def colors():
             return 'ファイルが選択されていません', 400
         
         if file:
-            # ファイルを一時保存
-            filename = os.path.join(UPLOAD_FOLDER, file.filename)
-            file.save(filename)
+            # ファイルを一時保存（同じファイル名の同時アップロードでも上書きしないよう一意な名前にする）
+            filename = ingest.save_upload(file, UPLOAD_FOLDER)
             
             try:
-                # 画像を処理
-                result_img = process_image(filename)
-                
-                # 結果画像をBase64エンコード
-                buffered = io.BytesIO()
-                result_img.save(buffered, format="PNG")
-                img_str = base64.b64encode(buffered.getvalue()).decode()
+                # 画像を処理し、結果画像は専用のURLから配信する（同じ画像の結果はキャッシュから返る）
+                _, result_id = store_result(filename, requested_format(), ingest.upload_digest(file))
+                result_url = url_for('.colors_result', result_id=result_id)
                 
                 # 一時ファイルを削除
                 os.remove(filename)
                 
-                return render_template('colors.html', image_data=img_str)
+                return render_template('colors.html', result_url=result_url)
                 
+            except ExecutorBusyError as e:
+                os.remove(filename)
+                return str(e), 503, {'Retry-After': '5'}
+            except TimeoutError:
+                os.remove(filename)
+                return '処理がタイムアウトしました', 504
             except Exception as e:
                 # エラーが発生した場合も一時ファイルを削除
                 if os.path.exists(filename):
@@ -235,5 +676,90 @@ def colors():
     
     return render_template('colors.html')
 
-if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+@bp.route('/colors/batch', methods=['POST'])
+def colors_batch():
+    """
+    複数の画像をまとめて分析し、終わったものから1行ずつNDJSONで返す。
+    contact_sheet=1を指定すると、最後に結果を並べた一覧画像のURLを返す。
+    """
+    # 混み合っている場合はここで断る。受け付けた後の各画像は、空きが出るまで待って処理する
+    try:
+        image_executor.check_capacity()
+    except ExecutorBusyError as e:
+        return str(e), 503, {'Retry-After': '5'}
+    
+    batch_dir = tempfile.mkdtemp(dir=UPLOAD_FOLDER)
+    try:
+        saved = save_batch_files(batch_dir)
+    except ValueError as e:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        return str(e), 400
+    if not saved:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        return 'ファイルがありません', 400
+    
+    output_format = requested_format()
+    contact_sheet = request.form.get('contact_sheet') == '1'
+    
+    def generate():
+        # 各画像の処理はワーカープロセスで並列に行い、ここでは完了を待って結果を書き出すだけ
+        pool = ThreadPoolExecutor(max_workers=image_executor.max_workers)
+        try:
+            futures = {pool.submit(store_result, path, output_format, digest, BATCH_WAIT): filename
+                       for filename, path, digest in saved}
+            result_ids = []
+            for future in as_completed(futures):
+                line = {'filename': futures[future]}
+                try:
+                    cluster_centers_arr, result_id = future.result()
+                except Exception as e:
+                    line['error'] = str(e)
+                else:
+                    result_ids.append(result_id)
+                    line['colors'] = ['#%02x%02x%02x' % tuple(rgb_arr) for rgb_arr in cluster_centers_arr]
+                    line['result_url'] = url_for('.colors_result', result_id=result_id)
+                yield json.dumps(line, ensure_ascii=False) + '\n'
+            
+            if contact_sheet and result_ids:
+                result_datas = [result[0] for result in map(result_store.get, result_ids) if result]
+                try:
+                    sheet_data = image_executor.run(render_contact_sheet, result_datas, wait=BATCH_WAIT)
+                    sheet_id = result_store.put(sheet_data, 'image/jpeg')
+                    line = {'contact_sheet_url': url_for('.colors_result', result_id=sheet_id)}
+                except Exception as e:
+                    line = {'contact_sheet_error': str(e)}
+                yield json.dumps(line, ensure_ascii=False) + '\n'
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+            shutil.rmtree(batch_dir, ignore_errors=True)
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@bp.route('/colors/result/<result_id>')
+def colors_result(result_id):
+    result = result_store.get(result_id)
+    if result is None:
+        abort(404, description='分析結果が見つかりません。結果は分析したサーバープロセスで'
+                               f'{result_store.ttl}秒だけ保持されるため、期限が切れたか、別のプロセスに届いた可能性があります')
+    
+    data, mimetype = result
+    response = make_response(data)
+    response.mimetype = mimetype
+    # IDは内容のハッシュなので、そのまま強いETagとして使える
+    response.set_etag(result_id)
+    response.cache_control.private = True
+    response.cache_control.max_age = result_store.ttl
+    return response.make_conditional(request)
+
+@bp.route('/colors/cache')
+def colors_cache_stats():
+    return jsonify(palette_cache.stats())
+
+def preload():
+    """分析に使う重いモジュールを読み込み、初回の実行で読み込まれる内部のモジュールも読み込んでおく
+
+    gunicorn --preload でマスタープロセスから呼ぶと、フォークしたワーカーはメモリを共有したまま、
+    読み込みの時間もかからない（分析用のプロセスはforkserverで読み込んでから起動する）。
+    ただし結果画像はワーカーのメモリに置くので、ワーカーは1つにする（-w 1 --threads N）
+    """
+    extract_palette(np.zeros((16, 3), dtype=np.uint8) + np.arange(16)[:, None], n_clusters=2, engine='kmeans')
\ No newline at end of file
@@ -0,0 +1,107 @@
+# image_executor.py
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+
+
+class ExecutorBusyError(Exception):
+    """待ちの処理が上限に達しているときに送出される"""
+
+
+def _mp_context():
+    """ワーカープロセスの起動方法
+
+    スレッドで動くサーバーの中からforkすると、他のスレッドが持っていたロックを持ったままの
+    状態がコピーされ、ワーカーが止まることがある。forkserver（無ければspawn）で起動する
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        # forkserverで一度だけ読み込んでおき、そこからforkするワーカーの起動を速くする
+        context.set_forkserver_preload(['image'])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+def _warm_up():
+    """ワーカープロセスの起動時に一度だけ重いモジュールを読み込んでおく
+
+    forkserverで読み込み済みなら、そこからforkしたプロセスではすぐに終わる
+    """
+    import image
+
+    # sklearnは初回のfitで内部のモジュールを読み込むため、小さなデータで一度実行しておく
+    image.preload()
+
+
+class ImageExecutor:
+    """CPUを使う画像処理を、常駐するワーカープロセスで実行する
+
+    実行中と待ちの処理の合計がmax_queueに達している場合は、待たずにExecutorBusyErrorを送出する。
+    受け付け済みの一括処理のように断りたくないものは、waitを指定すると空きが出るまでその秒数だけ待つ
+    """
+
+    def __init__(self, max_workers=None, max_queue=None, timeout=30):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_queue = max_queue or self.max_workers * 2
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.max_queue)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def check_capacity(self):
+        """空きが無ければExecutorBusyErrorを送出する（リクエストを受け付ける前に確かめるため）"""
+        if not self._slots.acquire(blocking=False):
+            raise ExecutorBusyError('現在混み合っています。しばらくしてから再度お試しください')
+        self._slots.release()
+
+    def submit(self, fn, *args, wait=None, **kwargs):
+        acquired = self._slots.acquire(blocking=False) if wait is None else self._slots.acquire(timeout=wait)
+        if not acquired:
+            raise ExecutorBusyError('現在混み合っています。しばらくしてから再度お試しください')
+        try:
+            future = self._get_executor().submit(fn, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        # タイムアウトで呼び出し側が諦めても、処理が終わるまでは枠を空けない
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def run(self, fn, *args, timeout=None, wait=None, **kwargs):
+        """fnをワーカープロセスで実行して結果を返す。時間内に終わらなければTimeoutErrorを送出する
+
+        waitを指定すると、空きが無い場合にその秒数まで待つ（timeoutは空きを得てからの時間）
+
+        ワーカーで記録した段階の時間はこのプロセスの集計に加える。image_executorの時間との差が待ち時間
+        """
+        with metrics.stage('image_executor'):
+            future = self.submit(metrics.run_collecting, fn, *args, wait=wait, **kwargs)
+            try:
+                result, samples = future.result(timeout=timeout or self.timeout)
+            except TimeoutError:
+                # まだ始まっていなければ取り消す
+                future.cancel()
+                raise
+            except BrokenProcessPool:
+                # ワーカーが異常終了した場合は、次の呼び出しでプールを作り直す
+                self.shutdown()
+                raise
+        metrics.merge(samples)
+        return result
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=_mp_context(),
+                                                     initializer=_warm_up)
+            return self._executor
@@ -0,0 +1,362 @@
+# image_pipeline.py
+"""アップロードされた画像を検証・変換し、内容のハッシュで保存する
+
+画像は デコード → 変換 → エンコード の3段のパイプラインで処理する。段の間は上限付きの
+キューでつなぎ、各段は複数のスレッドで実行する（Pillowはデコード・リサイズ・エンコードの間
+GILを解放するため、スレッドでも複数のコアを使える）。キューが一杯になると前の段が待つので、
+一度にメモリへ展開される画像の数は段ごとのワーカー数とキューの長さまでに抑えられる。
+
+- 形式は拡張子ではなく先頭バイトで判定し、その形式のデコーダーだけで開く
+- EXIFの向きに合わせて回転し、EXIF（位置情報など）は書き出さない
+- 長辺を制限した表示用（web）とサムネイル（thumb）を作る
+- 出力は内容のsha256の名前で保存し、元の画像のsha256から引ける索引に記録する
+"""
+import copy
+import hashlib
+import io
+import json
+import math
+import os
+import queue
+import tempfile
+import threading
+import time
+
+from PIL import Image, ImageOps
+
+import metrics
+
+# 先頭バイト -> Pillowの形式名
+SIGNATURES = (
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (b'GIF87a', 'GIF'),
+    (b'GIF89a', 'GIF'),
+    (b'BM', 'BMP'),
+    (b'II*\x00', 'TIFF'),
+    (b'MM\x00*', 'TIFF'),
+)
+# 先頭バイトの判定に読むサイズ
+SNIFF_SIZE = 16
+# 1枚あたりのファイルサイズとピクセル数の上限
+MAX_IMAGE_BYTES = 50 * 1024 * 1024
+MAX_PIXELS = 50 * 1000 * 1000
+
+# 名前, 長辺の上限, 品質。前のものを縮小して次を作るので、大きい順に並べる
+DERIVATIVES = (('web', 1600, 82), ('thumb', 320, 75))
+OUTPUT_FORMAT = 'WEBP'
+OUTPUT_EXTENSION = 'webp'
+OUTPUT_MIMETYPE = 'image/webp'
+
+STAGES = ('decode', 'transform', 'encode')
+ORIENTATION_TAG = 0x0112
+
+
+class ImageRejected(Exception):
+    """画像として受け付けられないファイル"""
+
+
+def sniff_format(head):
+    """先頭バイトから形式を判定する。対応していない場合はNone"""
+    for signature, fmt in SIGNATURES:
+        if head.startswith(signature):
+            return fmt
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'WEBP'
+    return None
+
+
+def decode(data):
+    """検証してデコードし、(形式, EXIFの向きに合わせた画像, 元の画像の幅と高さ) を返す
+
+    JPEGは縮小してデコードするため、画像の大きさは元の画像より小さいことがある
+    """
+    fmt = sniff_format(data[:SNIFF_SIZE])
+    if fmt is None:
+        raise ImageRejected('対応していない形式です')
+    try:
+        img = Image.open(io.BytesIO(data), formats=[fmt])
+        original_size = img.size
+        if img.width * img.height > MAX_PIXELS:
+            raise ImageRejected(f'画像が大きすぎます（{img.width}x{img.height}）')
+        # JPEGは最も大きい出力以上の範囲で、できるだけ縮小しながらデコードする
+        scale = min(1.0, DERIVATIVES[0][1] / max(img.size))
+        img.draft('RGB', (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+        img.load()
+    except ImageRejected:
+        raise
+    except Exception as e:
+        raise ImageRejected(f'画像を読み込めません: {str(e)}')
+
+    icc_profile = img.info.get('icc_profile')
+    width, height = original_size
+    # 90度回転する向き（5〜8）では幅と高さが入れ替わる
+    if img.getexif().get(ORIENTATION_TAG) in (5, 6, 7, 8):
+        width, height = height, width
+    img = ImageOps.exif_transpose(img)
+    has_alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+    mode = 'RGBA' if has_alpha else 'RGB'
+    if img.mode != mode:
+        img = img.convert(mode)
+    # 色の再現に必要なICCプロファイルだけを引き継ぐ
+    if icc_profile:
+        img.info['icc_profile'] = icc_profile
+    return fmt, img, (width, height)
+
+
+def transform(img):
+    """DERIVATIVESの大きさに縮小した画像を {名前: 画像} で返す（拡大はしない）"""
+    images = {}
+    source = img
+    for name, max_side, _ in DERIVATIVES:
+        scale = min(1.0, max_side / max(source.size))
+        size = (max(1, round(source.width * scale)), max(1, round(source.height * scale)))
+        resized = source if size == source.size else source.resize(size, Image.LANCZOS, reducing_gap=2.0)
+        resized.info['icc_profile'] = img.info.get('icc_profile')
+        images[name] = resized
+        source = resized
+    return images
+
+
+def encode(images):
+    """{名前: 画像} を {名前: バイト列} にする。EXIFは渡さないので書き出されない"""
+    quality = {name: q for name, _, q in DERIVATIVES}
+    encoded = {}
+    for name, img in images.items():
+        buffer = io.BytesIO()
+        options = {'quality': quality[name], 'method': 4}
+        if img.info.get('icc_profile'):
+            options['icc_profile'] = img.info['icc_profile']
+        img.save(buffer, format=OUTPUT_FORMAT, **options)
+        encoded[name] = (buffer.getvalue(), img.size)
+    return encoded
+
+
+class ImageStore:
+    """出力を内容のsha256の名前で保存し、元の画像のsha256 -> 項目 の索引を持つ
+
+    索引は更新時刻が変わったときだけ読み直す。書き込みは一時ファイルを置き換えて行う
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.objects_dir = os.path.join(root, 'objects')
+        self.index_path = os.path.join(root, 'index.json')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self._index = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def lookup(self, digest):
+        """元の画像のsha256に対応する項目。無ければNone"""
+        with self._lock:
+            self._reload()
+            return self._index.get(digest)
+
+    def put_object(self, data, extension=OUTPUT_EXTENSION):
+        """内容を保存して名前を返す。同じ内容が既にあれば書き込まない"""
+        name = f'{hashlib.sha256(data).hexdigest()}.{extension}'
+        path = self.path(name)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _write_atomic(path, data)
+        return name
+
+    def path(self, name):
+        """保存した出力のパス（名前の先頭2文字でディレクトリを分ける）"""
+        return os.path.join(self.objects_dir, name[:2], name)
+
+    def add(self, entries):
+        """{元の画像のsha256: 項目} を索引に追加する"""
+        if not entries:
+            return
+        with self._lock:
+            # 他のプロセスが追加した分を失わないよう、読み直してから書く
+            self._reload()
+            self._index.update(entries)
+            _write_atomic(self.index_path, json.dumps(self._index, ensure_ascii=False).encode('utf-8'))
+            self._mtime = os.stat(self.index_path).st_mtime_ns
+
+    def __len__(self):
+        with self._lock:
+            self._reload()
+            return len(self._index)
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.index_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self._index = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Failed to read image index: {str(e)}")
+            return
+        self._mtime = mtime
+
+
+class _Job:
+    """パイプラインを流れる画像1枚分"""
+
+    def __init__(self, filename, data, digest):
+        self.filename = filename
+        self.data = data
+        self.digest = digest
+        self.value = data  # 前の段の出力
+        self.format = None
+        self.size = None
+        self.status = 'pending'
+        self.error = None
+        self.entry = None
+
+    def to_dict(self):
+        result = {'filename': self.filename, 'status': self.status, 'digest': self.digest}
+        if self.error:
+            result['error'] = self.error
+        if self.entry:
+            # 索引の項目を呼び出し側が書き換えないよう、複製して渡す
+            result.update(copy.deepcopy(self.entry))
+        return result
+
+
+class ImagePipeline:
+    """画像をデコード・変換・エンコードの段に分けて並列に処理し、ImageStoreに保存する"""
+
+    def __init__(self, store, workers=None, queue_size=None):
+        self.store = store
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size or self.workers * 2
+
+    def run(self, items):
+        """items: (ファイル名, ストリーム, sha256またはNone) の並び
+
+        Returns
+        -------
+        result : dict
+            files（ファイルごとの結果。itemsと同じ順）と stats（処理時間とスループット）
+        """
+        start = time.perf_counter()
+        timings = {stage: 0.0 for stage in STAGES}
+        timings_lock = threading.Lock()
+        handlers = {'decode': self._decode, 'transform': self._transform, 'encode': self._encode}
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in STAGES]
+        queues.append(None)  # 最後の段の出力先は無い
+
+        def work(stage, inbox, outbox):
+            while True:
+                job = inbox.get()
+                if job is None:
+                    return
+                if job.status == 'pending':
+                    began = time.perf_counter()
+                    try:
+                        job.value = handlers[stage](job)
+                    except ImageRejected as e:
+                        job.status, job.error, job.value = 'rejected', str(e), None
+                    except Exception as e:
+                        print(f"Failed to process {job.filename} ({stage}): {str(e)}")
+                        job.status, job.error, job.value = 'failed', str(e), None
+                    elapsed = time.perf_counter() - began
+                    metrics.observe(f'pipeline_{stage}', elapsed)
+                    with timings_lock:
+                        timings[stage] += elapsed
+                if outbox is not None:
+                    outbox.put(job)
+
+        threads = []
+        for i, stage in enumerate(STAGES):
+            stage_threads = [threading.Thread(target=work, args=(stage, queues[i], queues[i + 1]), daemon=True)
+                             for _ in range(self.workers)]
+            for thread in stage_threads:
+                thread.start()
+            threads.append(stage_threads)
+
+        # 読み込みはこのスレッドで行う。デコードの段が詰まっていれば、ここで待つ
+        jobs = []
+        seen = set()
+        bytes_in = 0
+        for filename, stream, digest in items:
+            job = self._read(filename, stream, digest, seen)
+            bytes_in += len(job.data or b'')
+            jobs.append(job)
+            queues[0].put(job)
+
+        # 前の段から順に終了させる
+        for i, stage_threads in enumerate(threads):
+            for _ in stage_threads:
+                queues[i].put(None)
+            for thread in stage_threads:
+                thread.join()
+
+        stored = {job.digest: job.entry for job in jobs if job.status == 'stored'}
+        self.store.add(stored)
+        for job in jobs:
+            if job.status == 'duplicate' and job.entry is None:
+                job.entry = stored.get(job.digest)
+
+        seconds = time.perf_counter() - start
+        processed = sum(1 for job in jobs if job.status == 'stored')
+        return {
+            'files': [job.to_dict() for job in jobs],
+            'stats': {
+                'files': len(jobs),
+                'stored': processed,
+                'duplicates': sum(1 for job in jobs if job.status == 'duplicate'),
+                'rejected': sum(1 for job in jobs if job.status == 'rejected'),
+                'failed': sum(1 for job in jobs if job.status == 'failed'),
+                'workers': self.workers,
+                'seconds': round(seconds, 3),
+                'images_per_s': round(processed / seconds, 2) if seconds else None,
+                'mb_per_s': round(bytes_in / 1024 / 1024 / seconds, 2) if seconds else None,
+                # 各段のスレッドが処理に使った時間の合計と、1枚あたりの平均
+                'stages': {stage: {'seconds': round(timings[stage], 3),
+                                   'ms_per_image': round(timings[stage] / processed * 1000, 1) if processed else None}
+                           for stage in STAGES},
+            },
+        }
+
+    def _read(self, filename, stream, digest, seen):
+        stream.seek(0)
+        data = stream.read(MAX_IMAGE_BYTES + 1)
+        job = _Job(filename, data, digest or hashlib.sha256(data).hexdigest())
+        if len(data) > MAX_IMAGE_BYTES:
+            job.status, job.error, job.data = 'rejected', f'ファイルが大きすぎます（上限 {MAX_IMAGE_BYTES // 1024 // 1024}MB）', None
+        elif sniff_format(data[:SNIFF_SIZE]) is None:
+            job.status, job.error, job.data = 'rejected', '対応していない形式です', None
+        else:
+            # 処理済みの画像（同じリクエスト内の重複を含む）は作り直さない
+            job.entry = self.store.lookup(job.digest)
+            if job.digest in seen or job.entry is not None:
+                job.status, job.data = 'duplicate', None
+        seen.add(job.digest)
+        return job
+
+    @staticmethod
+    def _decode(job):
+        job.format, img, job.size = decode(job.data)
+        job.data = None  # 元のバイト列はもう使わない
+        return img
+
+    @staticmethod
+    def _transform(job):
+        return transform(job.value)
+
+    def _encode(self, job):
+        derivatives = {}
+        for name, (data, (width, height)) in encode(job.value).items():
+            derivatives[name] = {'file': self.store.put_object(data), 'width': width, 'height': height,
+                                 'bytes': len(data)}
+        job.entry = {'format': job.format, 'width': job.size[0], 'height': job.size[1],
+                     'derivatives': derivatives}
+        job.status = 'stored'
+        return None
+
+
+def _write_atomic(path, data):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
@@ -0,0 +1,102 @@
+# ingest.py
+import hashlib
+import os
+import shutil
+import tempfile
+from flask import Request, current_app, request
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.utils import secure_filename
+
+import metrics
+
+# メモリ上に保持する上限。これを超えたら一時ファイルに書き出す
+SPOOL_SIZE = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+class HashingSpooledFile(tempfile.SpooledTemporaryFile):
+    """受信しながらサイズを数え、SHA-256を計算する一時ファイル
+
+    max_sizeを超えて書き込まれた時点でRequestEntityTooLargeを送出する
+    """
+
+    def __init__(self, max_file_size=None, spool_size=SPOOL_SIZE, spool_dir=None):
+        super().__init__(max_size=spool_size, prefix='upload-', dir=spool_dir)
+        self.max_file_size = max_file_size
+        self.size = 0
+        self._hash = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_file_size is not None and self.size > self.max_file_size:
+            raise RequestEntityTooLarge(f'ファイルサイズが上限（{self.max_file_size}バイト）を超えています')
+        self._hash.update(data)
+        return super().write(data)
+
+    @property
+    def digest(self):
+        return self._hash.hexdigest()
+
+
+class IngestRequest(Request):
+    """multipartのファイルを固定サイズのチャンクで一時ファイルへ書き出すRequest
+
+    リクエスト全体の上限はMAX_CONTENT_LENGTH、ファイルごとの上限はMAX_FILE_SIZEで設定する。
+    ブループリントごとの上限は init_blueprint でリクエストに設定する
+    """
+
+    max_file_size = None
+
+    def _load_form_data(self):
+        if 'form' in self.__dict__:
+            return
+        # 本文の受信と一時ファイルへの書き出しはここでまとめて行われる
+        with metrics.stage('upload_parse', self.content_length):
+            super()._load_form_data()
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        config = current_app.config
+        return HashingSpooledFile(
+            max_file_size=self.max_file_size if self.max_file_size is not None else config.get('MAX_FILE_SIZE'),
+            spool_size=config.get('UPLOAD_SPOOL_SIZE', SPOOL_SIZE),
+            spool_dir=config.get('UPLOAD_SPOOL_DIR'),
+        )
+
+
+def init_app(app, max_content_length=None, max_file_size=None, spool_size=SPOOL_SIZE, spool_dir=None):
+    """アップロードの受信にIngestRequestを使い、サイズの上限を設定する
+
+    引数はapp.configに設定が無い場合のデフォルト。create_appに渡した設定などが優先される
+    """
+    app.request_class = IngestRequest
+    # FlaskはMAX_CONTENT_LENGTHをNoneで用意しているので、setdefaultでは上書きできない
+    if app.config.get('MAX_CONTENT_LENGTH') is None:
+        app.config['MAX_CONTENT_LENGTH'] = max_content_length
+    app.config.setdefault('MAX_FILE_SIZE', max_file_size)
+    app.config.setdefault('UPLOAD_SPOOL_SIZE', spool_size)
+    app.config.setdefault('UPLOAD_SPOOL_DIR', spool_dir)
+
+
+def init_blueprint(bp, max_content_length, max_file_size):
+    """ブループリントのルートだけ、アップロードのサイズの上限をアプリ全体の設定から変える"""
+
+    @bp.before_request
+    def set_upload_limits():
+        # フォームはビューで初めて読み込まれるので、ここで設定すれば受信時に使われる
+        request.max_content_length = max_content_length
+        request.max_file_size = max_file_size
+
+
+def upload_digest(file):
+    """受信時に計算したSHA-256を返す。IngestRequest経由でなければNone"""
+    return getattr(file.stream, 'digest', None)
+
+
+def save_upload(file, folder):
+    """アップロードされたファイルを、他のリクエストと衝突しない名前でfolderに保存してパスを返す"""
+    suffix = os.path.splitext(secure_filename(file.filename or ''))[1]
+    fd, path = tempfile.mkstemp(suffix=suffix, prefix='upload-', dir=folder)
+    with metrics.stage('upload_save') as timing, os.fdopen(fd, 'wb') as f:
+        shutil.copyfileobj(file.stream, f, CHUNK_SIZE)
+        timing.nbytes = f.tell()
+    return path
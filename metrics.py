@@ -0,0 +1,326 @@
+# metrics.py
+"""処理の段階ごとの時間と件数を集計し、Prometheusのテキスト形式で /metrics から返す
+
+各処理では次のように計測する（無効にしたときは何もしないオブジェクトを返すだけ）:
+
+    with metrics.stage('zip_build'):
+        ...
+    metrics.observe('zip_deflate', cpu_time, nbytes=file_size)
+    metrics.count('palette_cache_hit')
+
+init_app を呼ぶと、リクエストごとの時間も記録し、SLOW_REQUEST_SECONDS を超えた
+リクエストはそのリクエストの段階ごとの内訳と一緒にJSONでログに出す。
+PROFILE_REQUESTS を有効にすると、?profile=1 を付けたリクエストの間だけ全スレッドの
+スタックを一定間隔で取得し、PROFILE_DIR にcollapsed形式（flamegraph.pl などで読める）で書き出す。
+
+集計はプロセスごとに行う。ワーカープロセス（ImageExecutor）で計測した分は
+run_collecting で結果と一緒に返し、呼び出し側のプロセスで merge する。
+"""
+import bisect
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter as _Tally
+
+from flask import Response, request
+
+# 秒。1ms から、大きなアップロードの受信が入る2分まで
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+SLOW_REQUEST_SECONDS = 2.0
+PROFILE_INTERVAL = 0.005
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Falseにすると stage / observe / count は何もしない
+enabled = True
+_local = threading.local()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def collect(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        for labelvalues, value in values:
+            yield f'{self.name}{_labels(self.labelnames, labelvalues)} {value}'
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values = {}  # ラベルの値 -> [バケットごとの件数..., 合計, 件数]
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labelvalues)
+            if entry is None:
+                entry = self._values[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def collect(self):
+        with self._lock:
+            values = sorted((labelvalues, list(entry)) for labelvalues, entry in self._values.items())
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        for labelvalues, entry in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), entry):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield f'{self.name}_bucket{_labels(self.labelnames, labelvalues, ("le", le))} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labelnames, labelvalues)} {entry[-2]}'
+            yield f'{self.name}_count{_labels(self.labelnames, labelvalues)} {entry[-1]}'
+
+
+REGISTRY = []
+
+STAGE_SECONDS = Histogram('app_stage_seconds', 'Time spent in each processing stage.', ('stage',))
+STAGE_BYTES = Counter('app_stage_bytes_total', 'Bytes handled by each processing stage.', ('stage',))
+EVENTS = Counter('app_events_total', 'Cache hits, retries and other events.', ('event',))
+REQUEST_SECONDS = Histogram('app_request_seconds', 'Request duration until the response is closed.',
+                            ('endpoint', 'method', 'status'))
+SLOW_REQUESTS = Counter('app_slow_requests_total', 'Requests slower than SLOW_REQUEST_SECONDS.', ('endpoint',))
+
+
+def observe(name, seconds, nbytes=None):
+    """段階nameにかかった時間（と扱ったバイト数）を記録する"""
+    if not enabled:
+        return
+    buffer = getattr(_local, 'buffer', None)
+    if buffer is not None:
+        # run_collecting の中では、呼び出し元のプロセスへ返すために溜めておく
+        buffer.append((name, seconds, nbytes))
+        return
+    STAGE_SECONDS.observe(seconds, name)
+    if nbytes:
+        STAGE_BYTES.inc(nbytes, name)
+    stages = getattr(_local, 'request_stages', None)
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + seconds
+
+
+def count(event, amount=1):
+    if enabled:
+        EVENTS.inc(amount, event)
+
+
+class _Stage:
+    __slots__ = ('name', 'nbytes', 'start')
+
+    def __init__(self, name, nbytes):
+        self.name = name
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.perf_counter() - self.start, self.nbytes)
+
+
+class _NullStage:
+    """無効のときに stage が返す。nbytesを設定しても無視する"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name, nbytes=None):
+    """withで囲んだ範囲の時間を段階nameとして記録する。バイト数は as で受けたものに設定できる"""
+    if not enabled:
+        return _NULL_STAGE
+    return _Stage(name, nbytes)
+
+
+def run_collecting(fn, *args, **kwargs):
+    """fnを実行し、(結果, その間に記録した段階の一覧) を返す。ワーカープロセスで使う"""
+    _local.buffer = []
+    try:
+        result = fn(*args, **kwargs)
+        return result, _local.buffer
+    finally:
+        _local.buffer = None
+
+
+def merge(samples):
+    """run_collecting で受け取った段階の記録を、このプロセスの集計に加える"""
+    for name, seconds, nbytes in samples:
+        observe(name, seconds, nbytes)
+
+
+def render():
+    """Prometheusのテキスト形式"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.collect())
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        lines += ['# HELP process_resident_memory_bytes Resident memory size in bytes.',
+                  '# TYPE process_resident_memory_bytes gauge',
+                  f'process_resident_memory_bytes {rss}']
+    except (OSError, ValueError):
+        # /proc が無い環境では出さない
+        pass
+    return '\n'.join(lines) + '\n'
+
+
+class Sampler:
+    """一定間隔で全スレッドのスタックを取得し、スタックごとの回数を数えるプロファイラー
+
+    計測しているスレッドは止めないので、有効にしたリクエストでも遅くなるのは取得の分だけ
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples = _Tally()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.samples
+
+    def _run(self):
+        names = {}
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident in threading.enumerate():
+                names[ident.ident] = ident.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def write(self, path):
+        """collapsed形式（スタック 回数）で書き出す"""
+        with open(path, 'w') as f:
+            for stack, n in self.samples.most_common():
+                f.write(f'{stack} {n}\n')
+
+
+def init_app(app):
+    """リクエストの計測、遅いリクエストのログ、/metrics とプロファイラーを設定する
+
+    設定（環境変数でも指定できる）:
+        METRICS_ENABLED        Falseにすると計測しない（/metrics も登録しない）
+        SLOW_REQUEST_SECONDS   これより遅いリクエストをログに出す
+        PROFILE_REQUESTS       Trueにすると ?profile=1 のリクエストをプロファイルする
+        PROFILE_DIR            プロファイルの書き出し先
+    """
+    global enabled
+    app.config.setdefault('METRICS_ENABLED', os.environ.get('METRICS_ENABLED', '1') != '0')
+    app.config.setdefault('SLOW_REQUEST_SECONDS', float(os.environ.get('SLOW_REQUEST_SECONDS', SLOW_REQUEST_SECONDS)))
+    app.config.setdefault('PROFILE_REQUESTS', os.environ.get('PROFILE_REQUESTS') == '1')
+    app.config.setdefault('PROFILE_DIR', os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'profiles')))
+    enabled = app.config['METRICS_ENABLED']
+    if not enabled:
+        return
+
+    slow_seconds = app.config['SLOW_REQUEST_SECONDS']
+    profile_requests = app.config['PROFILE_REQUESTS']
+    profile_dir = app.config['PROFILE_DIR']
+
+    @app.before_request
+    def start_request():
+        _local.request_stages = {}
+        request.environ['metrics.start'] = time.perf_counter()
+        if profile_requests and request.args.get('profile') == '1':
+            request.environ['metrics.sampler'] = Sampler().start()
+
+    @app.after_request
+    def finish_request(response):
+        start = request.environ.get('metrics.start')
+        if start is None:
+            return response
+        endpoint = request.endpoint or 'unknown'
+        method = request.method
+        path = request.path
+        status = response.status_code
+        sampler = request.environ.get('metrics.sampler')
+        profile_path = None
+        if sampler is not None:
+            profile_path = os.path.join(profile_dir, f'{time.strftime("%Y%m%d-%H%M%S")}-{endpoint}-{os.getpid()}.folded')
+            response.headers['X-Profile'] = os.path.basename(profile_path)
+
+        def close():
+            # ストリーミングのレスポンスも含め、送り終えた時点までを計る
+            seconds = time.perf_counter() - start
+            stages = getattr(_local, 'request_stages', None) or {}
+            _local.request_stages = None
+            REQUEST_SECONDS.observe(seconds, endpoint, method, str(status))
+            if sampler is not None:
+                sampler.stop()
+                os.makedirs(profile_dir, exist_ok=True)
+                sampler.write(profile_path)
+            if seconds >= slow_seconds:
+                SLOW_REQUESTS.inc(1, endpoint)
+                app.logger.warning(json.dumps({
+                    'event': 'slow_request', 'method': method, 'path': path, 'endpoint': endpoint,
+                    'status': status, 'seconds': round(seconds, 3),
+                    'stages': {name: round(value, 3) for name, value in stages.items()},
+                    'profile': profile_path,
+                }, ensure_ascii=False))
+
+        response.call_on_close(close)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(render(), content_type=CONTENT_TYPE)
@@ -0,0 +1,260 @@
+# page_cache.py
+"""リクエストごとの内容を持たないページを、描画済みのバイト列としてメモリに保持する
+
+@pages.page を付けたビューは初回だけ描画し、以降はメモリ上の本文と、
+事前に圧縮したgzip（brotliがあればbrも）を返す。使ったテンプレート（extendsした親を含む）と
+watch_filesのどれかの更新時刻が変わったら描画し直す。ETagとLast-Modifiedを付け、
+条件付きリクエストには304を返す。デバッグ時はキャッシュしない。
+
+フロントのプロキシから直接配信する場合は、静的なファイルとして書き出す:
+    flask --app app export-pages [--output export]
+"""
+import gzip
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from functools import wraps
+
+import click
+from flask import Response, current_app, request, template_rendered
+from jinja2 import TemplateNotFound, meta
+from werkzeug.http import http_date, is_resource_modified, quote_etag
+
+try:
+    import brotli
+except ImportError:
+    # brotliが無い環境ではgzipだけを作る
+    brotli = None
+
+# Accept-Encodingで優先する順
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+SUFFIXES = dict(ENCODINGS)
+EXPORT_DIR = 'export'
+
+
+def compress(body):
+    """Content-Encoding -> 圧縮した本文"""
+    encoded = {'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        encoded['br'] = brotli.compress(body, quality=11)
+    return encoded
+
+
+class CachedPage:
+    """描画済みのページ1つ分"""
+
+    def __init__(self, body, mimetype, dependencies, mtime):
+        self.body = body
+        self.mimetype = mimetype
+        self.dependencies = dependencies  # 更新時刻を確認するファイルのパス
+        self.mtime = mtime  # 依存するファイルの更新時刻の組（変更の検出用）
+        newest = max((m for m in mtime if m is not None), default=time.time_ns())
+        self.last_modified = datetime.fromtimestamp(newest // 10 ** 9, timezone.utc)
+        self.checked = time.monotonic()
+        etag = hashlib.sha256(body).hexdigest()[:32]
+
+        # 表現ごとの本文とヘッダーは描画時に作っておき、リクエストごとには組み立てない
+        self.variants = {None: self._variant(body, etag, None)}
+        for encoding, data in compress(body).items():
+            # 圧縮版は別の表現なので、ETagを区別する
+            self.variants[encoding] = self._variant(data, f'{etag}-{encoding}', encoding)
+
+    def _variant(self, data, etag, encoding):
+        headers = [
+            ('ETag', quote_etag(etag)),
+            ('Last-Modified', http_date(self.last_modified)),
+            # キャッシュは使ってよいが、毎回304で確認させる
+            ('Cache-Control', 'public, no-cache'),
+            ('Vary', 'Accept-Encoding'),
+        ]
+        if encoding:
+            headers.append(('Content-Encoding', encoding))
+        return data, etag, headers
+
+
+class _AppState:
+    """アプリごとのキャッシュ"""
+
+    def __init__(self, watch_files):
+        self.watch_files = list(watch_files)
+        self.pages = {}  # エンドポイント -> CachedPage
+        self.lock = threading.Lock()
+
+
+class PageCache:
+    """@page を付けたビューの出力をキャッシュする
+
+    ブループリントのモジュールで @pages.page を付け、アプリの作成時に init_app を呼ぶ。
+    更新時刻の確認はページごとにcheck_interval秒に1回に抑える
+    """
+
+    def __init__(self, check_interval=1.0):
+        self.check_interval = check_interval
+        self._views = set()
+
+    def init_app(self, app, watch_files=()):
+        """watch_filesはテンプレート以外で、更新されたら描画し直すファイル"""
+        app.extensions['page_cache'] = _AppState(watch_files)
+        app.cli.add_command(self._export_command())
+
+    def page(self, view):
+        """ビューの出力をキャッシュする。GET・HEAD以外のメソッドは毎回ビューを呼ぶ"""
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            state = current_app.extensions.get('page_cache')
+            if request.method not in ('GET', 'HEAD') or state is None or current_app.debug:
+                return view(*args, **kwargs)
+            cached = self._get(state, request.endpoint)
+            if cached is None:
+                cached = self._render(state, request.endpoint, view, args, kwargs)
+                if cached is None:
+                    return view(*args, **kwargs)
+            return self._respond(cached)
+
+        self._views.add(wrapper)
+        return wrapper
+
+    def clear(self, app=None):
+        state = (app or current_app).extensions['page_cache']
+        with state.lock:
+            state.pages.clear()
+
+    def _get(self, state, endpoint):
+        with state.lock:
+            cached = state.pages.get(endpoint)
+            if cached is None:
+                return None
+            now = time.monotonic()
+            if now - cached.checked < self.check_interval:
+                return cached
+            cached.checked = now
+        if _mtimes(cached.dependencies) != cached.mtime:
+            # デバッグ時以外はJinjaがテンプレートの変更を確認しないので、コンパイル済みのものを捨てる
+            if current_app.jinja_env.cache is not None:
+                current_app.jinja_env.cache.clear()
+            return None
+        return cached
+
+    def _render(self, state, endpoint, view, args, kwargs):
+        """ビューを呼んで描画したテンプレートを記録する。文字列以外を返した場合はキャッシュしない"""
+        rendered = []
+
+        def record(sender, template, context, **extra):
+            rendered.append(template.name)
+
+        with template_rendered.connected_to(record, current_app._get_current_object()):
+            result = view(*args, **kwargs)
+        if isinstance(result, Response):
+            if result.status_code != 200 or result.direct_passthrough:
+                return None
+            body, mimetype = result.get_data(), result.mimetype
+        elif isinstance(result, str):
+            body, mimetype = result.encode('utf-8'), 'text/html'
+        else:
+            return None
+
+        dependencies = self._template_files(rendered) + state.watch_files
+        cached = CachedPage(body, mimetype, dependencies, _mtimes(dependencies))
+        with state.lock:
+            state.pages[endpoint] = cached
+        return cached
+
+    def _template_files(self, names):
+        """描画したテンプレートと、extends・include・importで参照するテンプレートのファイル"""
+        env = current_app.jinja_env
+        files = []
+        seen = set()
+        pending = list(names)
+        while pending:
+            name = pending.pop()
+            if name is None or name in seen:
+                continue
+            seen.add(name)
+            try:
+                source, filename, _ = env.loader.get_source(env, name)
+            except TemplateNotFound:
+                continue
+            if filename:
+                files.append(filename)
+            # 変数で指定した参照（None）は追えないので除く
+            pending.extend(meta.find_referenced_templates(env.parse(source)))
+        return files
+
+    @staticmethod
+    def _respond(cached):
+        encoding = None
+        for name, _ in ENCODINGS:
+            if name in cached.variants and request.accept_encodings[name]:
+                encoding = name
+                break
+
+        data, etag, headers = cached.variants[encoding]
+        if not is_resource_modified(request.environ, etag=etag, last_modified=cached.last_modified):
+            return Response(status=304, headers=headers)
+        return Response(data, mimetype=cached.mimetype, headers=headers)
+
+    def export(self, output_dir=EXPORT_DIR):
+        """@page を付けた引数の無いURLを描画し、圧縮版と一緒にファイルとして書き出す
+
+        Returns
+        -------
+        written : list of str
+            書き出したページのパス（output_dirからの相対パス）
+        """
+        client = current_app.test_client()
+        written = []
+        for rule in current_app.url_map.iter_rules():
+            if current_app.view_functions.get(rule.endpoint) not in self._views \
+                    or rule.arguments or 'GET' not in rule.methods:
+                continue
+            response = client.get(rule.rule)
+            if response.status_code != 200:
+                print(f"Failed to export {rule.rule}: {response.status}")
+                continue
+            body = response.get_data()
+            name = rule.rule.lstrip('/')
+            if not name or name.endswith('/'):
+                name += 'index.html'
+            path = os.path.join(output_dir, *name.split('/'))
+            _write_atomic(path, body)
+            for encoding, data in compress(body).items():
+                _write_atomic(path + SUFFIXES[encoding], data)
+            written.append(name)
+        return written
+
+    def _export_command(self):
+        @click.command('export-pages')
+        @click.option('--output', default=EXPORT_DIR, show_default=True, help='書き出し先のディレクトリ')
+        def export_pages(output):
+            """キャッシュするページを静的なHTMLとして書き出す"""
+            start = time.perf_counter()
+            written = self.export(output)
+            print(f"Exported {len(written)} pages to {output} in {time.perf_counter() - start:.2f}s")
+
+        return export_pages
+
+
+# ブループリントのモジュールで使う共通のインスタンス
+pages = PageCache()
+
+
+def _mtimes(paths):
+    result = []
+    for path in paths:
+        try:
+            result.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            result.append(None)
+    return tuple(result)
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
@@ -0,0 +1,173 @@
+# palette_cache.py
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def file_digest(path, chunk_size=64 * 1024):
+    """ファイルの内容のSHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PaletteCache:
+    """画像の内容のハッシュと抽出条件をキーに、代表色と結果画像を保存するLRUキャッシュ
+
+    メモリ上の合計サイズがmax_bytesを超えたら、最も長く使われていないものから削除する。
+    disk_dirを指定すると、メモリから追い出されたものもディスクから読み戻せる
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, disk_dir=None, disk_max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()  # key -> (centers, result_bytes)
+        self._total_bytes = 0
+        self._disk_entries = OrderedDict()  # key -> size（古い順）
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._load_disk_index()
+
+    @staticmethod
+    def make_key(digest, **params):
+        """内容のダイジェストと抽出条件（n_clusters, img_size, marginなど）からキーを作る"""
+        options = ','.join(f'{name}={params[name]}' for name in sorted(params))
+        return hashlib.sha256(f'{digest}|{options}'.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """(代表色の配列, 結果画像のバイト列) を返す。無ければNone"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._store(key, entry)
+            return entry
+
+    def put(self, key, centers, result_bytes):
+        entry = (np.asarray(centers), result_bytes)
+        with self._lock:
+            self._store(key, entry)
+        self._write_disk(key, entry)
+        return entry
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+                'disk_entries': len(self._disk_entries),
+                'disk_bytes': self._disk_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+            }
+
+    def _store(self, key, entry):
+        size = self._entry_size(entry)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._total_bytes -= self._entry_size(self._entries.pop(key))
+        self._entries[key] = entry
+        self._total_bytes += size
+        while self._total_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._total_bytes -= self._entry_size(evicted)
+            self.evictions += 1
+
+    @staticmethod
+    def _entry_size(entry):
+        centers, result_bytes = entry
+        return centers.nbytes + len(result_bytes)
+
+    def _disk_paths(self, key):
+        return os.path.join(self.disk_dir, f'{key}.json'), os.path.join(self.disk_dir, f'{key}.bin')
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        meta_path, data_path = self._disk_paths(key)
+        try:
+            with open(meta_path, 'r') as f:
+                centers = np.array(json.load(f)['centers'])
+            with open(data_path, 'rb') as f:
+                return centers, f.read()
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write_disk(self, key, entry):
+        if not self.disk_dir:
+            return
+        centers, result_bytes = entry
+        meta_path, data_path = self._disk_paths(key)
+        try:
+            # 書きかけのファイルを読まないよう、一時ファイルに書いてから置き換える
+            # メタデータを後に書くので、メタデータがあれば結果画像も揃っている
+            for path, mode, content in ((data_path, 'wb', result_bytes),
+                                        (meta_path, 'w', json.dumps({'centers': centers.tolist()}))):
+                temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+                with open(temp_path, mode) as f:
+                    f.write(content)
+                os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Failed to write palette cache: {str(e)}")
+            return
+
+        with self._lock:
+            size = len(result_bytes)
+            self._disk_bytes -= self._disk_entries.pop(key, 0)
+            self._disk_entries[key] = size
+            self._disk_bytes += size
+            evicted = []
+            while self._disk_bytes > self.disk_max_bytes and len(self._disk_entries) > 1:
+                old_key, old_size = self._disk_entries.popitem(last=False)
+                self._disk_bytes -= old_size
+                evicted.append(old_key)
+
+        for old_key in evicted:
+            for path in self._disk_paths(old_key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _load_disk_index(self):
+        entries = []
+        for item in os.listdir(self.disk_dir):
+            if not item.endswith('.bin'):
+                continue
+            path = os.path.join(self.disk_dir, item)
+            try:
+                entries.append((os.path.getmtime(path), item[:-len('.bin')], os.path.getsize(path)))
+            except OSError:
+                pass
+        for _, key, size in sorted(entries):
+            self._disk_entries[key] = size
+            self._disk_bytes += size
@@ -0,0 +1,283 @@
+# responsive_images.py
+"""static/images の画像から、幅の異なる配信用の画像（WebP・AVIF・JPEG）を作成する
+
+作成した画像はstatic/derivedに内容と出力の設定のハッシュを含む名前で保存し、manifest.jsonに
+元の画像ごとの一覧を書き出す。2回目以降は内容が変わった画像だけを処理する。
+テンプレートでは init_app で登録する responsive_img() で <picture> を出力する。
+
+使い方:
+    python responsive_images.py [--workers N] [--force]
+"""
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from PIL import Image, ImageOps, features
+from markupsafe import Markup, escape
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+SOURCE_DIR = 'images'  # STATIC_FOLDERからの相対パス
+OUTPUT_DIR = 'derived'
+MANIFEST_NAME = 'manifest.json'
+SOURCE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp'}
+
+WIDTHS = (320, 640, 960, 1280, 1920)
+# AVIFに対応していないPillowでは作らない。JPEGは<img>のフォールバックとして必ず作る
+FORMATS = ('avif', 'webp', 'jpeg') if features.check('avif') else ('webp', 'jpeg')
+QUALITY = {'avif': 55, 'webp': 80, 'jpeg': 82}
+MIME_TYPES = {'avif': 'image/avif', 'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+# 出力は名前に内容と設定のハッシュを含み、内容が変わることはないので長くキャッシュさせる
+MAX_AGE = 365 * 24 * 3600
+
+
+def _settings():
+    """出力の設定。変わった場合は全ての画像を作り直す"""
+    return {'widths': list(WIDTHS), 'formats': list(FORMATS), 'quality': QUALITY}
+
+
+def _settings_tag():
+    """出力のファイル名に含める設定のハッシュ。品質などを変えるとURLも変わり、キャッシュに古い画像が残らない"""
+    return hashlib.sha256(json.dumps(_settings(), sort_keys=True).encode('utf-8')).hexdigest()[:8]
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _target_widths(width):
+    """元の幅より小さい幅と、元の幅そのもの（拡大はしない）"""
+    return [w for w in WIDTHS if w < width] + [width]
+
+
+def render_derivatives(source_path, digest, static_folder=STATIC_FOLDER, overwrite=False):
+    """1枚の画像から全ての幅・形式の画像を作り、マニフェストの項目を返す
+
+    ワーカープロセスで実行する。出力のファイル名は内容と設定のハッシュから決まるため、
+    同じ内容の画像（手作業でコピーしたものなど）は同じ出力を共有する。
+    overwriteを指定すると、既にある出力も書き直す
+    """
+    tag = _settings_tag()
+    with Image.open(source_path) as img:
+        # 向きをEXIFに合わせて直し、位置情報などのメタデータは書き出さない
+        img = ImageOps.exif_transpose(img)
+        has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+        img = img.convert('RGBA' if has_alpha else 'RGB')
+        width, height = img.size
+
+        derivatives = {fmt: [] for fmt in FORMATS}
+        for target_width in _target_widths(width):
+            target_height = max(1, round(height * target_width / width))
+            resized = img if target_width == width else img.resize(
+                (target_width, target_height), Image.LANCZOS, reducing_gap=2.0)
+            for fmt in FORMATS:
+                frame = resized
+                if fmt == 'jpeg' and has_alpha:
+                    # JPEGは透過できないので白で塗りつぶす
+                    frame = Image.new('RGB', resized.size, (255, 255, 255))
+                    frame.paste(resized, mask=resized.getchannel('A'))
+                filename = f'{OUTPUT_DIR}/{digest[:16]}-{tag}-{target_width}.{"jpg" if fmt == "jpeg" else fmt}'
+                path = os.path.join(static_folder, filename)
+                if overwrite or not os.path.exists(path):
+                    _save(frame, path, fmt)
+                derivatives[fmt].append({'width': target_width, 'file': filename})
+
+    return {'sha256': digest, 'width': width, 'height': height, 'alpha': has_alpha, 'derivatives': derivatives}
+
+
+def _save(img, path, fmt):
+    """書きかけのファイルを配信しないよう、一時ファイルに書いてから置き換える"""
+    options = {'quality': QUALITY[fmt]}
+    if fmt == 'jpeg':
+        options.update(optimize=True, progressive=True)
+    elif fmt == 'webp':
+        options.update(method=4)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            img.save(f, format=fmt.upper(), **options)
+        os.replace(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+def load_manifest(static_folder=STATIC_FOLDER):
+    try:
+        with open(os.path.join(static_folder, OUTPUT_DIR, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'settings': None, 'images': {}}
+
+
+def build(static_folder=STATIC_FOLDER, workers=None, force=False):
+    """static/images を走査して配信用の画像とマニフェストを作る
+
+    Returns
+    -------
+    stats : dict
+        processed（作り直した画像の数）, skipped（変更がなかった画像の数）,
+        removed（不要になって削除した出力の数）, seconds
+    """
+    start = time.perf_counter()
+    source_root = os.path.join(static_folder, SOURCE_DIR)
+    output_root = os.path.join(static_folder, OUTPUT_DIR)
+    os.makedirs(output_root, exist_ok=True)
+
+    previous = load_manifest(static_folder)
+    reuse = not force and previous.get('settings') == _settings()
+    images = {}
+    pending = {}  # 元の画像の相対パス -> (絶対パス, ダイジェスト)
+    skipped = 0
+    for directory, _, filenames in os.walk(source_root):
+        for filename in sorted(filenames):
+            if os.path.splitext(filename)[1].lower() not in SOURCE_EXTENSIONS:
+                continue
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, source_root).replace(os.sep, '/')
+            digest = _file_digest(path)
+            entry = previous['images'].get(name)
+            if reuse and entry and entry['sha256'] == digest and _outputs_exist(entry, static_folder):
+                images[name] = entry
+                skipped += 1
+            else:
+                pending[name] = (path, digest)
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(render_derivatives, path, digest, static_folder, force): name
+                       for name, (path, digest) in pending.items()}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    images[name] = future.result()
+                except Exception as e:
+                    print(f"Failed to process {name}: {str(e)}")
+
+    manifest = {'settings': _settings(), 'images': dict(sorted(images.items()))}
+    _write_manifest(manifest, output_root)
+
+    # どの画像からも参照されなくなった出力を削除する
+    referenced = {os.path.basename(item['file'])
+                  for entry in images.values() for items in entry['derivatives'].values() for item in items}
+    removed = 0
+    for filename in os.listdir(output_root):
+        if filename != MANIFEST_NAME and filename not in referenced:
+            os.remove(os.path.join(output_root, filename))
+            removed += 1
+
+    return {'processed': len(pending), 'skipped': skipped, 'removed': removed,
+            'seconds': time.perf_counter() - start}
+
+
+def _outputs_exist(entry, static_folder):
+    return all(os.path.exists(os.path.join(static_folder, item['file']))
+               for items in entry['derivatives'].values() for item in items)
+
+
+def _write_manifest(manifest, output_root):
+    path = os.path.join(output_root, MANIFEST_NAME)
+    fd, temp_path = tempfile.mkstemp(dir=output_root, suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(temp_path, path)
+
+
+class ResponsiveImages:
+    """マニフェストを読み込み、テンプレート用の srcset / <picture> を作る
+
+    マニフェストは更新時刻が変わったときだけ読み直す。マニフェストに無い画像は
+    元の画像をそのまま<img>で出力する
+    """
+
+    def __init__(self, static_folder=STATIC_FOLDER, url_for_static=None):
+        self.static_folder = static_folder
+        self.url_for_static = url_for_static
+        self._manifest = {'images': {}}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def lookup(self, filename):
+        """static/images からの相対パスに対応するマニフェストの項目。無ければNone"""
+        path = os.path.join(self.static_folder, OUTPUT_DIR, MANIFEST_NAME)
+        with self._lock:
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                mtime = None
+            if mtime != self._mtime:
+                self._manifest = load_manifest(self.static_folder) if mtime else {'images': {}}
+                self._mtime = mtime
+            return self._manifest['images'].get(filename)
+
+    def srcset(self, filename, fmt='jpeg'):
+        entry = self.lookup(filename)
+        if entry is None:
+            return ''
+        return ', '.join(f"{self.url_for_static(item['file'])} {item['width']}w"
+                         for item in entry['derivatives'].get(fmt, []))
+
+    def picture(self, filename, alt='', sizes=None, loading='lazy', **attrs):
+        """<picture>要素を返す。sizesを省略すると、元の幅を上限に画面幅に合わせる"""
+        entry = self.lookup(filename)
+        extra = ''.join(f' {escape(name)}="{escape(value)}"' for name, value in attrs.items())
+        if entry is None:
+            src = self.url_for_static(f'{SOURCE_DIR}/{filename}')
+            return Markup(f'<img src="{escape(src)}" alt="{escape(alt)}" loading="{escape(loading)}"{extra}>')
+
+        if sizes is None:
+            sizes = f"(max-width: {entry['width']}px) 100vw, {entry['width']}px"
+        sources = ''.join(
+            f'<source type="{MIME_TYPES[fmt]}" srcset="{escape(self.srcset(filename, fmt))}" sizes="{escape(sizes)}">'
+            for fmt in FORMATS if fmt != 'jpeg' and entry['derivatives'].get(fmt))
+        fallback = entry['derivatives']['jpeg'][-1]['file']
+        return Markup(
+            f'<picture>{sources}'
+            f'<img src="{escape(self.url_for_static(fallback))}" srcset="{escape(self.srcset(filename))}" '
+            f'sizes="{escape(sizes)}" width="{entry["width"]}" height="{entry["height"]}" '
+            f'alt="{escape(alt)}" loading="{escape(loading)}" decoding="async"{extra}></picture>')
+
+
+def init_app(app):
+    """テンプレートで responsive_img() と image_srcset() を使えるようにする
+
+    static/derived は静的ファイルと同じURLのまま、immutableを付けて長くキャッシュさせるルートで配信する
+    """
+    from flask import send_from_directory, url_for
+
+    def send_derived(filename):
+        response = send_from_directory(os.path.join(app.static_folder, OUTPUT_DIR), filename,
+                                       max_age=MAX_AGE, conditional=True)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    # /static/<path:filename> より具体的なので、こちらが使われる
+    app.add_url_rule(f'{app.static_url_path}/{OUTPUT_DIR}/<path:filename>', 'responsive_image', send_derived)
+    images = ResponsiveImages(app.static_folder, lambda filename: url_for('static', filename=filename))
+    app.jinja_env.globals['responsive_img'] = images.picture
+    app.jinja_env.globals['image_srcset'] = images.srcset
+    return images
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--force', action='store_true', help='変更の有無に関わらず全て作り直す')
+    args = parser.parse_args()
+
+    stats = build(workers=args.workers, force=args.force)
+    print(f"Responsive images: {stats['processed']} processed, {stats['skipped']} unchanged, "
+          f"{stats['removed']} stale outputs removed in {stats['seconds']:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# result_store.py
+"""分析結果の画像を短時間保持する、プロセス内のストア
+
+結果はこのプロセスのメモリにだけあるので、結果のURLが別のプロセスに届くと404になる。
+アプリは1つのワーカープロセスで動かす（app.py の起動方法を参照）
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultStore:
+    """分析結果の画像を短時間だけ保持し、IDで取り出せるようにする
+
+    IDは内容のハッシュなので、同じ結果には同じURLが割り当てられ、ETagとしても使える
+    """
+
+    def __init__(self, ttl=600, max_bytes=128 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # result_id -> (data, mimetype, created)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def put(self, data, mimetype):
+        """結果を保存してIDを返す"""
+        result_id = hashlib.sha256(data).hexdigest()[:32]
+        with self._lock:
+            if result_id in self._entries:
+                self._total_bytes -= len(self._entries.pop(result_id)[0])
+            self._entries[result_id] = (data, mimetype, time.time())
+            self._total_bytes += len(data)
+            self._evict()
+        return result_id
+
+    def get(self, result_id):
+        """(データ, MIMEタイプ) を返す。期限切れや存在しない場合はNone"""
+        with self._lock:
+            self._evict()
+            entry = self._entries.get(result_id)
+            if entry is None:
+                return None
+            return entry[0], entry[1]
+
+    def _evict(self):
+        expired = time.time() - self.ttl
+        # 先頭が最も古いもの
+        while self._entries:
+            result_id, (data, _, created) = next(iter(self._entries.items()))
+            if created >= expired and self._total_bytes <= self.max_bytes:
+                break
+            del self._entries[result_id]
+            self._total_bytes -= len(data)
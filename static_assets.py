@@ -0,0 +1,210 @@
+# static_assets.py
+"""static 以下のファイルに内容のハッシュを含む名前を付け、長期間キャッシュできるURLで配信する
+
+ビルドでは static/assets に「元の名前.ハッシュ.拡張子」のコピーと、テキストの場合は
+gzip・brotliで圧縮したものを作り、manifest.jsonに元の名前との対応を書き出す。
+init_appを呼ぶとテンプレートの url_for('static', filename=...) がハッシュ付きのURLを返し、
+/assets/ から Cache-Control: immutable で配信する。デバッグ時やマニフェストに無い
+ファイルは、これまでどおり /static のURLを返す。
+
+使い方:
+    python static_assets.py
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import tempfile
+import threading
+import time
+
+from flask import abort, request, send_file, url_for
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    # brotliが無い環境ではgzipだけを作る
+    brotli = None
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+OUTPUT_DIR = 'assets'
+MANIFEST_NAME = 'manifest.json'
+# 作成済みの出力。derivedは名前に内容のハッシュを含むので対象にしない
+EXCLUDE_DIRS = {OUTPUT_DIR, 'derived'}
+COMPRESS_EXTENSIONS = {'.css', '.js', '.html', '.svg', '.json', '.txt', '.xml', '.map'}
+# 1年。ハッシュが変わればURLも変わるため、古いものを配信し続けることはない
+MAX_AGE = 365 * 24 * 3600
+# Accept-Encodingで優先する順
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def _fingerprint(name, digest):
+    root, ext = os.path.splitext(name)
+    return f'{root}.{digest[:12]}{ext}'
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def build(static_folder=STATIC_FOLDER):
+    """ハッシュ付きのコピーと圧縮版を作り、マニフェストを書き出す
+
+    Returns
+    -------
+    stats : dict
+        files（対象のファイル数）, written（新しく書き出したファイル数）,
+        removed（不要になって削除したファイル数）, seconds
+    """
+    start = time.perf_counter()
+    output_root = os.path.join(static_folder, OUTPUT_DIR)
+    os.makedirs(output_root, exist_ok=True)
+
+    files = {}
+    outputs = set()
+    written = 0
+    for directory, dirnames, filenames in os.walk(static_folder):
+        if directory == static_folder:
+            dirnames[:] = [d for d in dirnames if d not in EXCLUDE_DIRS]
+        for filename in sorted(filenames):
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, static_folder).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                data = f.read()
+            digest = hashlib.sha256(data).hexdigest()
+            hashed = _fingerprint(name, digest)
+            files[name] = {'file': hashed, 'sha256': digest, 'encodings': []}
+
+            # 同じ内容なら同じ名前になるので、既にあるものは作り直さない
+            variants = [('', lambda: data)]
+            if os.path.splitext(name)[1].lower() in COMPRESS_EXTENSIONS:
+                variants.append(('.gz', lambda: gzip.compress(data, compresslevel=9, mtime=0)))
+                if brotli is not None:
+                    variants.append(('.br', lambda: brotli.compress(data, quality=11)))
+            for suffix, make in variants:
+                target = os.path.join(output_root, hashed + suffix)
+                if not os.path.exists(target):
+                    payload = make()
+                    if suffix and len(payload) >= len(data):
+                        # 小さくならない圧縮版は作らない
+                        continue
+                    _write_atomic(target, payload)
+                    written += 1
+                outputs.add(os.path.normpath(target))
+                if suffix:
+                    files[name]['encodings'].append(suffix)
+
+    _write_atomic(os.path.join(output_root, MANIFEST_NAME),
+                  json.dumps({'files': files}, indent=1, ensure_ascii=False).encode('utf-8'))
+    outputs.add(os.path.normpath(os.path.join(output_root, MANIFEST_NAME)))
+
+    removed = 0
+    for directory, _, filenames in os.walk(output_root):
+        for filename in filenames:
+            path = os.path.normpath(os.path.join(directory, filename))
+            if path not in outputs:
+                os.remove(path)
+                removed += 1
+
+    return {'files': len(files), 'written': written, 'removed': removed, 'seconds': time.perf_counter() - start}
+
+
+class StaticAssets:
+    """マニフェストを読み込み、ハッシュ付きの名前の解決と配信を行う
+
+    マニフェストは更新時刻が変わったときだけ読み直す
+    """
+
+    def __init__(self, static_folder=STATIC_FOLDER):
+        self.static_folder = static_folder
+        self.output_root = os.path.join(static_folder, OUTPUT_DIR)
+        self._files = {}  # 元の名前 -> 項目
+        self._hashed = {}  # ハッシュ付きの名前 -> 項目
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        path = os.path.join(self.output_root, MANIFEST_NAME)
+        with self._lock:
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                mtime = None
+            if mtime == self._mtime:
+                return
+            files = {}
+            if mtime is not None:
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        files = json.load(f)['files']
+                except (OSError, ValueError, KeyError) as e:
+                    print(f"Failed to read asset manifest: {str(e)}")
+            self._files = files
+            self._hashed = {entry['file']: entry for entry in files.values()}
+            self._mtime = mtime
+
+    def lookup(self, filename):
+        """元の名前に対応するハッシュ付きの名前。無ければNone"""
+        self._load()
+        entry = self._files.get(filename)
+        return entry['file'] if entry else None
+
+    def send(self, filename):
+        """ハッシュ付きの名前のファイルを、Accept-Encodingに合わせた圧縮版で返す"""
+        self._load()
+        entry = self._hashed.get(filename)
+        path = safe_join(self.output_root, filename)
+        if entry is None or path is None or not os.path.isfile(path):
+            abort(404)
+
+        encoding = None
+        for name, suffix in ENCODINGS:
+            if suffix in entry['encodings'] and request.accept_encodings[name] and os.path.isfile(path + suffix):
+                encoding, path = name, path + suffix
+                break
+
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        # ETagは内容のハッシュ（圧縮版は別の表現なので区別する）
+        etag = entry['sha256'][:32] + (f'-{encoding}' if encoding else '')
+        response = send_file(path, mimetype=mimetype, etag=etag, max_age=MAX_AGE, conditional=True)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        response.vary.add('Accept-Encoding')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+
+def init_app(app):
+    """テンプレートの url_for('static', ...) をハッシュ付きのURLに置き換え、/assets/ を配信する"""
+    assets = StaticAssets(app.static_folder)
+    app.add_url_rule('/assets/<path:filename>', 'static_assets', assets.send)
+
+    def asset_url_for(endpoint, **values):
+        # デバッグ時は編集したファイルがすぐ反映されるよう、元のURLのままにする
+        if endpoint == 'static' and not app.debug:
+            hashed = assets.lookup(values.get('filename'))
+            if hashed is not None:
+                values['filename'] = hashed
+                return url_for('static_assets', **values)
+        return url_for(endpoint, **values)
+
+    app.jinja_env.globals['url_for'] = asset_url_for
+    return assets
+
+
+def main():
+    stats = build()
+    print(f"Static assets: {stats['files']} files, {stats['written']} written, "
+          f"{stats['removed']} stale removed in {stats['seconds']:.2f}s"
+          + ('' if brotli else ' (brotli not installed: gzip only)'))
+
+
+if __name__ == '__main__':
+    main()
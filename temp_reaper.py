@@ -0,0 +1,275 @@
+# temp_reaper.py
+import heapq
+import itertools
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def _path_size(path):
+    """ファイルならそのサイズ、ディレクトリなら中身の合計サイズ"""
+    try:
+        if os.path.isdir(path):
+            total = 0
+            for root, _, filenames in os.walk(path):
+                for filename in filenames:
+                    try:
+                        total += os.path.getsize(os.path.join(root, filename))
+                    except OSError:
+                        pass
+            return total
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _delete_path(path):
+    """ファイルまたはディレクトリを削除する。既に無い場合は何もしない"""
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class _Entry:
+    __slots__ = ('path', 'size', 'deadline', 'on_remove', 'attempts')
+
+    def __init__(self, path, size, deadline, on_remove, attempts=0):
+        self.path = path
+        self.size = size
+        self.deadline = deadline
+        self.on_remove = on_remove
+        self.attempts = attempts
+
+
+class TempReaper:
+    """作成した一時ファイルを期限付きで登録し、期限が来たものから削除する
+
+    期限はヒープで管理するので、ディレクトリを定期的に走査する必要はない。
+    登録中の合計サイズがmax_bytesを超えた場合は、古く登録されたものから削除する。
+    pinしたパス（処理中の入力や、送信中・ダウンロード待ちのZIP）は、unpinされるまで
+    期限切れでも容量超過でも削除しない。max_bytesはアップロードの上限以上にしておく
+    """
+
+    def __init__(self, default_ttl=3600, max_bytes=5 * 1024 ** 3, retry_interval=60, max_attempts=3):
+        self.default_ttl = default_ttl
+        self.max_bytes = max_bytes
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+        self._heap = []  # (deadline, seq, entry)
+        self._entries = OrderedDict()  # path -> entry（登録順 = 古い順）
+        self._pins = {}  # path -> 使用中の数
+        self._doomed = set()  # 使用中に削除を頼まれたパス（最後のunpinで削除する）
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self.pending_bytes = 0
+        self.expired = 0
+        self.evictions = 0
+        self.failures = 0
+
+    def track(self, path, ttl=None, on_remove=None, created=None):
+        """pathを登録し、ttl秒後に削除する。同じパスを再登録すると期限とサイズを更新する
+
+        on_removeは期限切れや容量超過で削除したときに、削除したパスを引数に呼ばれる
+        """
+        size = _path_size(path)
+        if ttl is None:
+            ttl = self.default_ttl
+        deadline = (time.time() if created is None else created) + ttl
+        with self._cond:
+            self._push(_Entry(path, size, deadline, on_remove))
+
+    def pin(self, path):
+        """使用中にする。unpinと同じ回数呼ばれるまで、pathは削除しない（登録前に呼んでもよい）"""
+        with self._cond:
+            self._pins[path] = self._pins.get(path, 0) + 1
+
+    def unpin(self, path):
+        """pinを1つ外す。使用中に remove されていれば、最後のunpinで削除する"""
+        with self._cond:
+            count = self._pins.get(path)
+            if count is None:
+                return
+            if count > 1:
+                self._pins[path] = count - 1
+                return
+            del self._pins[path]
+            doomed = path in self._doomed
+            self._doomed.discard(path)
+            # 容量超過で待たせていたものを削除できるようにする
+            self._cond.notify()
+        if doomed:
+            self.remove(path)
+
+    @contextmanager
+    def pinned(self, path):
+        """withの間だけpinする"""
+        self.pin(path)
+        try:
+            yield path
+        finally:
+            self.unpin(path)
+
+    def discard(self, path):
+        """登録を取り消す（ファイルは削除しない）"""
+        with self._cond:
+            entry = self._entries.pop(path, None)
+            if entry is not None:
+                self.pending_bytes -= entry.size
+
+    def remove(self, path):
+        """登録を取り消して削除する。使用中なら最後のunpinまで待つ。on_removeは呼ばない"""
+        self.discard(path)
+        with self._cond:
+            if path in self._pins:
+                self._doomed.add(path)
+                return
+        try:
+            _delete_path(path)
+        except OSError as e:
+            print(f"Failed to remove {path}: {str(e)}")
+            with self._cond:
+                self.failures += 1
+
+    def adopt(self, folder, ttl=None):
+        """folder内に既にあるものを更新時刻を基準に登録する（前回起動時の残りを掃除するため）"""
+        if not os.path.isdir(folder):
+            return
+        for item in os.listdir(folder):
+            item_path = os.path.join(folder, item)
+            with self._cond:
+                if item_path in self._entries:
+                    continue
+            try:
+                created = os.path.getmtime(item_path)
+            except OSError:
+                continue
+            self.track(item_path, ttl, created=created)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'pending_items': len(self._entries),
+                'pending_bytes': self.pending_bytes,
+                'pinned_items': len(self._pins),
+                'expired': self.expired,
+                'evictions': self.evictions,
+                'failures': self.failures,
+            }
+
+    def _push(self, entry):
+        old = self._entries.pop(entry.path, None)
+        if old is not None:
+            self.pending_bytes -= old.size
+        self._entries[entry.path] = entry
+        self.pending_bytes += entry.size
+        heapq.heappush(self._heap, (entry.deadline, next(self._seq), entry))
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='temp-reaper', daemon=True)
+            self._thread.start()
+        self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                due = self._collect_due()
+                if not due:
+                    timeout = self._heap[0][0] - time.time() if self._heap else None
+                    self._cond.wait(timeout)
+                    continue
+
+            # 削除とコールバックはロックの外で行う
+            for entry, evicted in due:
+                self._delete_entry(entry, evicted)
+
+    def _collect_due(self):
+        due = []
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            _, _, entry = heapq.heappop(self._heap)
+            # 再登録や取り消しで古くなったヒープの要素は読み飛ばす
+            if self._entries.get(entry.path) is not entry:
+                continue
+            if entry.path in self._pins:
+                # 使用中のものは削除を先に延ばす
+                entry.deadline = now + self.retry_interval
+                heapq.heappush(self._heap, (entry.deadline, next(self._seq), entry))
+                continue
+            del self._entries[entry.path]
+            self.pending_bytes -= entry.size
+            due.append((entry, False))
+
+        if self.pending_bytes > self.max_bytes:
+            for path in list(self._entries):
+                if self.pending_bytes <= self.max_bytes:
+                    break
+                if path in self._pins:
+                    continue
+                entry = self._entries.pop(path)
+                self.pending_bytes -= entry.size
+                due.append((entry, True))
+        return due
+
+    def _delete_entry(self, entry, evicted):
+        with self._cond:
+            if entry.path in self._pins:
+                # 集めてから削除するまでの間に使用中になった
+                self._push(_Entry(entry.path, entry.size, time.time() + self.retry_interval,
+                                  entry.on_remove, entry.attempts))
+                return
+        try:
+            _delete_path(entry.path)
+        except OSError as e:
+            print(f"Failed to remove {entry.path}: {str(e)}")
+            with self._cond:
+                self.failures += 1
+                if entry.attempts + 1 < self.max_attempts:
+                    # しばらくしてから再試行する
+                    self._push(_Entry(entry.path, entry.size, time.time() + self.retry_interval,
+                                      entry.on_remove, entry.attempts + 1))
+            return
+
+        with self._cond:
+            if evicted:
+                self.evictions += 1
+            else:
+                self.expired += 1
+
+        if entry.on_remove is not None:
+            try:
+                entry.on_remove(entry.path)
+            except Exception as e:
+                print(f"Error occurred in reaper callback: {str(e)}")
+
+
+_shared_reaper = None
+_shared_lock = threading.Lock()
+
+
+def init_app(app):
+    """共有するTempReaperの容量の上限を、アップロードの上限に合わせて広げる
+
+    TEMP_MAX_BYTES（デフォルトはMAX_CONTENT_LENGTHの2倍。ジョブの入力とできたZIPが同時に残るため）
+    を、少なくともMAX_CONTENT_LENGTH以上にする。ingest.init_app の後に呼ぶ
+    """
+    upload_limit = app.config.get('MAX_CONTENT_LENGTH') or 0
+    app.config.setdefault('TEMP_MAX_BYTES', 2 * upload_limit)
+    reaper = get_reaper()
+    reaper.max_bytes = max(reaper.max_bytes, app.config['TEMP_MAX_BYTES'], upload_limit)
+
+
+def get_reaper():
+    """プロセス内で共有するTempReaperを返す"""
+    global _shared_reaper
+    with _shared_lock:
+        if _shared_reaper is None:
+            _shared_reaper = TempReaper()
+        return _shared_reaper
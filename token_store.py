@@ -0,0 +1,143 @@
+# token_store.py
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+Credential = namedtuple('Credential', ['access_token', 'refresh_token', 'expires_at'])
+
+
+def _to_epoch(expires_at):
+    """datetime（タイムゾーン無しはUTCとみなす）またはエポック秒をエポック秒にする"""
+    if expires_at is None or isinstance(expires_at, (int, float)):
+        return expires_at
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    return expires_at.timestamp()
+
+
+class TokenStore:
+    """Dropboxの認証情報をファイルに保存し、メモリ上にキャッシュする
+
+    ファイルを読むのは初回と、他のプロセスが書き換えたとき（更新時刻が変わったとき）だけで、
+    更新時刻の確認もcheck_interval秒に1回に抑える。書き込みは一時ファイルを置き換えて行うため、
+    他のワーカーが書きかけの内容を読むことはない。
+    リフレッシュトークンがあれば、アクセストークンの期限切れはクライアントが自動で更新する
+    """
+
+    def __init__(self, path, app_key=None, app_secret=None, check_interval=5.0):
+        self.path = path
+        self.app_key = app_key
+        self.app_secret = app_secret
+        self.check_interval = check_interval
+        self._credential = None
+        self._mtime = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """有効な認証情報を返す。無い場合や、期限切れでリフレッシュトークンも無い場合はNone"""
+        with self._lock:
+            now = time.monotonic()
+            if self._checked is None or now - self._checked >= self.check_interval:
+                self._checked = now
+                self._reload()
+            credential = self._credential
+        if credential is None:
+            return None
+        if credential.refresh_token is None and credential.expires_at is not None \
+                and credential.expires_at <= time.time():
+            return None
+        return credential
+
+    def client(self, session=None):
+        """認証情報に対応するDropboxクライアント（プロセス内で使い回す）。未認証ならNone"""
+        import dropbox_uploader  # Dropbox SDKは使うときに読み込む
+
+        credential = self.get()
+        if credential is None:
+            return None
+        expiration = None
+        if credential.expires_at is not None:
+            # SDKはタイムゾーン無しのUTCで期限を比較する
+            expiration = datetime.fromtimestamp(credential.expires_at, timezone.utc).replace(tzinfo=None)
+        return dropbox_uploader.get_client(
+            credential.access_token,
+            session=session,
+            refresh_token=credential.refresh_token,
+            expires_at=expiration,
+            app_key=self.app_key,
+            app_secret=self.app_secret,
+        )
+
+    def save(self, access_token, refresh_token=None, expires_at=None):
+        """認証情報を保存する。同じディレクトリの一時ファイルに書いてから置き換える"""
+        credential = Credential(access_token, refresh_token, _to_epoch(expires_at))
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(prefix='.token-', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(credential._asdict(), f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(temp_path, 0o600)
+            os.replace(temp_path, self.path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        with self._lock:
+            self._credential = credential
+            self._mtime = os.stat(self.path).st_mtime_ns
+            self._checked = time.monotonic()
+        return credential
+
+    def clear(self):
+        """認証情報を削除し、クライアントも破棄する"""
+        with self._lock:
+            credential = self._credential
+            self._credential = None
+            self._mtime = None
+            self._checked = time.monotonic()
+        if credential is not None:
+            import dropbox_uploader
+            dropbox_uploader.forget_client(credential.refresh_token or credential.access_token)
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            self._credential = None
+            self._mtime = None
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path, 'r') as f:
+                content = f.read().strip()
+        except OSError as e:
+            print(f"Failed to read token file: {str(e)}")
+            return
+        self._mtime = mtime
+        self._credential = self._parse(content)
+
+    @staticmethod
+    def _parse(content):
+        if not content:
+            return None
+        try:
+            data = json.loads(content)
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            # 以前の形式（アクセストークンだけを書いたテキスト）
+            return Credential(content, None, None)
+        return Credential(data['access_token'], data.get('refresh_token'), data.get('expires_at'))
@@ -0,0 +1,118 @@
+# zip_cache.py
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from temp_reaper import get_reaper
+
+
+class ZipCache:
+    """(ファイル名, 内容のハッシュ) の並びをキーに、作成済みのZIPファイルを再利用する
+
+    容量の上限を超えたら、最後に使われてから最も時間が経ったものからキャッシュから外す。
+    外したファイルと、最後に使われてからmax_ageを過ぎたファイルはTempReaperが削除する。
+    ただし送信中やダウンロード待ちでpinされている間は削除しない
+    """
+
+    def __init__(self, folder, max_bytes=2 * 1024 ** 3, max_age=3600, reaper=None):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.reaper = reaper or get_reaper()
+        self._entries = OrderedDict()  # key -> (path, size, created)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(members):
+        """[(ファイル名, 内容のダイジェスト), ...] からキャッシュのキーを作る"""
+        key = hashlib.sha256()
+        for filename, digest in members:
+            key.update(filename.encode('utf-8') + b'\0' + digest.encode('ascii') + b'\0')
+        return key.hexdigest()
+
+    def get(self, key):
+        """キャッシュ済みのZIPファイルのパスを返す。無ければNone
+
+        返したパスはpinしてあるので、使い終わったら reaper.unpin を呼ぶ
+        """
+        with self._lock:
+            self._evict()
+            entry = self._entries.get(key)
+            if entry is None or not os.path.exists(entry[0]):
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            path = entry[0]
+            # ロックを持ったまま使用中にするので、返すまでの間に容量超過で削除されることはない
+            self.reaper.pin(path)
+            self._entries.move_to_end(key)
+            self.hits += 1
+            # 期限は最後に使われた時点から数え直す
+            self._track(key, path)
+        return path
+
+    def put(self, key, path):
+        """作成したZIPファイルを登録する"""
+        size = os.path.getsize(path)
+        # 上限より大きいものはキャッシュせず、期限での削除だけを任せる
+        if size <= self.max_bytes:
+            with self._lock:
+                if key in self._entries:
+                    self._drop(key)
+                self._entries[key] = (path, size, time.time())
+                self._total_bytes += size
+                self._evict()
+        self._track(key, path)
+
+    def evict(self):
+        with self._lock:
+            self._evict()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+            }
+
+    def _evict(self):
+        # OrderedDictの先頭が最も長く使われていないもの
+        while self._total_bytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+
+    def _track(self, key, path):
+        self.reaper.track(path, self.max_age, on_remove=lambda removed, key=key: self._forget(key, removed))
+
+    def _remove(self, key):
+        """キャッシュから外し、ファイルはすぐに期限切れにしてリーパーに削除させる
+
+        送信中やダウンロード待ちでpinされていれば、リーパーはunpinされるまで削除しない
+        """
+        path = self._drop(key)
+        self.evictions += 1
+        self.reaper.track(path, 0)
+
+    def _forget(self, key, path):
+        """リーパーがファイルを削除したときに呼ばれる"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == path:
+                self._drop(key)
+                self.evictions += 1
+
+    def _drop(self, key):
+        path, size, _ = self._entries.pop(key)
+        self._total_bytes -= size
+        return path
@@ -1,84 +1,380 @@
 # zip_handler.py
+import hashlib
 import os
 import zipfile
 import shutil
-from datetime import datetime, timedelta
-import threading
+import sys
+from datetime import datetime
 import time
+import uuid
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug.utils import secure_filename
 
+import metrics
+from ingest import upload_digest
+from temp_reaper import get_reaper
+from zip_cache import ZipCache
+
+# ストリーミング時に一度に読み込むサイズ
+CHUNK_SIZE = 64 * 1024
+
+# 並列に圧縮するのはこのサイズまでのメンバー（大きいものはメモリに読み込まず、順に書き込む）
+PARALLEL_MAX_MEMBER_SIZE = 8 * 1024 * 1024
+# 並列に圧縮するために同時にメモリに読み込む元のデータの合計の上限
+PARALLEL_MAX_BYTES = 64 * 1024 * 1024
+
+# 圧縮方式の判定に使う先頭サンプルのサイズ
+SAMPLE_SIZE = 64 * 1024
+# 試し圧縮でこれ以上縮まなければ無圧縮で格納する
+MIN_SAVING = 0.05
+
+# 既に圧縮されている形式（deflateしてもほとんど縮まない）
+COMPRESSED_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar',
+    '.mp3', '.m4a', '.aac', '.mp4', '.mov', '.avi', '.mkv',
+}
+
+# 同じく先頭バイトで判定するためのシグネチャ
+COMPRESSED_SIGNATURES = (
+    b'\xff\xd8\xff',          # JPEG
+    b'\x89PNG\r\n\x1a\n',     # PNG
+    b'GIF8',                  # GIF
+    b'PK\x03\x04',            # ZIP
+    b'\x1f\x8b',              # gzip
+    b'BZh',                   # bzip2
+    b'\xfd7zXZ\x00',          # xz
+    b'7z\xbc\xaf\x27\x1c',    # 7z
+    b'Rar!',                  # RAR
+)
+
+
+class _StreamBuffer:
+    """ZipFileの書き込み先。書かれたバイト列を溜めておき、ジェネレータが取り出す"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def choose_compression(filename, sample, min_saving=MIN_SAVING):
+    """ファイル名・先頭バイト・試し圧縮の結果から、メンバーの圧縮方式を選ぶ"""
+    if not sample:
+        return zipfile.ZIP_STORED
+
+    if os.path.splitext(filename)[1].lower() in COMPRESSED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+
+    if (sample.startswith(COMPRESSED_SIGNATURES)
+            or sample[8:12] == b'WEBP'       # RIFF....WEBP
+            or sample[4:8] == b'ftyp'):      # MP4 / MOV / HEIC / AVIF
+        return zipfile.ZIP_STORED
+
+    # 先頭サンプルを最速レベルで試し圧縮し、効果が薄ければ無圧縮で格納する
+    trial = zlib.compress(sample, 1)
+    if len(trial) > len(sample) * (1 - min_saving):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def _read_sample(stream, size=SAMPLE_SIZE):
+    """ストリームの先頭を読み、読む前の位置に戻す"""
+    position = stream.tell()
+    sample = stream.read(size)
+    stream.seek(position)
+    return sample
+
+
+def _stream_size(stream):
+    """ストリームの現在位置から末尾までのバイト数"""
+    position = stream.tell()
+    size = stream.seek(0, os.SEEK_END) - position
+    stream.seek(position)
+    return size
+
+
+def _stream_digest(stream, chunk_size=CHUNK_SIZE):
+    """ストリームの現在位置から末尾までのSHA-256を計算し、位置を元に戻す"""
+    position = stream.tell()
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        digest.update(chunk)
+    stream.seek(position)
+    return digest.hexdigest()
+
+
+# _write_precompressed が使うzipfile.ZipFileの内部の属性と、内部の手順を確認したPythonのバージョン
+_ZIPFILE_INTERNALS = ('_lock', '_writecheck', '_writing', '_didModify', 'start_dir', 'fp')
+_PRECOMPRESSED_VERSIONS = ((3, 8), (3, 13))
+
+
+def can_write_precompressed(zipf):
+    """_write_precompressed でzipfの内部に直接書き込めるか"""
+    low, high = _PRECOMPRESSED_VERSIONS
+    return low <= sys.version_info[:2] <= high and all(hasattr(zipf, name) for name in _ZIPFILE_INTERNALS)
+
+
+def _compress_member(data, compress_type, level):
+    """メンバー1つ分を圧縮し、(CRC32, 格納するデータ, 圧縮に使ったCPU時間)を返す"""
+    if compress_type != zipfile.ZIP_DEFLATED:
+        return zlib.crc32(data), data, 0.0
+
+    start = time.thread_time()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    payload = compressor.compress(data) + compressor.flush()
+    return zlib.crc32(data), payload, time.thread_time() - start
+
+
+def _write_precompressed(zipf, filename, compress_type, crc, file_size, data):
+    """圧縮済みのデータを再圧縮せずにZIPメンバーとして書き込む
+
+    zipfileには圧縮済みのデータを書く公開APIが無いため、zipfileの内部
+    （_lock, _writecheck, _writing, _didModify, start_dir, fp）を使ってwritestrと同じ手順を行う。
+    CPython 3.8〜3.13 でのみ使う。呼ぶ前に can_write_precompressed で確かめること
+    """
+    zinfo = zipfile.ZipInfo(filename, date_time=time.localtime(time.time())[:6])
+    zinfo.compress_type = compress_type
+    zinfo.external_attr = 0o600 << 16
+    zinfo.file_size = file_size
+    zinfo.compress_size = len(data)
+    zinfo.CRC = crc
+    if zipf._writing:
+        raise ValueError("Can't write to ZIP archive while an open writing handle exists.")
+    with zipf._lock:
+        zipf._writecheck(zinfo)
+        zipf._didModify = True
+        zinfo.header_offset = zipf.fp.tell()
+        zipf.fp.write(zinfo.FileHeader())
+        zipf.fp.write(data)
+        zipf.filelist.append(zinfo)
+        zipf.NameToInfo[zinfo.filename] = zinfo
+        zipf.start_dir = zipf.fp.tell()
+
+
+class ArchiveStats:
+    """1つのアーカイブについて、圧縮で減らせたバイト数と使ったCPU時間を集計する"""
+
+    def __init__(self, progress=None):
+        self.progress = progress
+        self.members = 0
+        self.deflated = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_time = 0.0
+
+    def add(self, compress_type, file_size, compress_size, cpu_time=0.0):
+        self.members += 1
+        if compress_type == zipfile.ZIP_DEFLATED:
+            self.deflated += 1
+            metrics.observe('zip_deflate', cpu_time, file_size)
+        self.bytes_in += file_size
+        self.bytes_out += compress_size
+        self.cpu_time += cpu_time
+        if self.progress is not None:
+            self.progress(file_size)
+
+    @property
+    def bytes_saved(self):
+        return self.bytes_in - self.bytes_out
+
+    def __str__(self):
+        return (f"{self.members} files ({self.deflated} deflated), "
+                f"{self.bytes_in} -> {self.bytes_out} bytes, "
+                f"saved {self.bytes_saved} bytes for {self.cpu_time:.3f}s CPU")
+
+
 class ZipHandler:
-    def __init__(self, upload_folder='uploads', temp_zip_folder='temp_zips'):
-        self.UPLOAD_FOLDER = upload_folder
-        self.TEMP_ZIP_FOLDER = temp_zip_folder
+    def __init__(self, upload_folder='uploads', temp_zip_folder='temp_zips', chunk_size=CHUNK_SIZE,
+                 compress_workers=1, compresslevel=zlib.Z_DEFAULT_COMPRESSION, min_saving=MIN_SAVING,
+                 cache_max_bytes=2 * 1024 ** 3, cache_max_age=3600, reaper=None):
+        # リーパーのpinと送信時のパスが一致するよう、絶対パスで扱う
+        self.UPLOAD_FOLDER = os.path.abspath(upload_folder)
+        self.TEMP_ZIP_FOLDER = os.path.abspath(temp_zip_folder)
+        self.chunk_size = chunk_size
+        self.compress_workers = compress_workers
+        self.compresslevel = compresslevel
+        self.min_saving = min_saving
         
         # ディレクトリの作成
         os.makedirs(self.UPLOAD_FOLDER, exist_ok=True)
         os.makedirs(self.TEMP_ZIP_FOLDER, exist_ok=True)
-        
-        # クリーンアップスレッドの開始
-        self.cleanup_thread = threading.Thread(target=self._cleanup_old_files, daemon=True)
-        self.cleanup_thread.start()
-
-    def _cleanup_old_files(self):
-        """1時間以上前の一時ファイルを削除"""
-        while True:
-            try:
-                current_time = datetime.now()
-                if os.path.exists(self.UPLOAD_FOLDER):
-                    for item in os.listdir(self.UPLOAD_FOLDER):
-                        item_path = os.path.join(self.UPLOAD_FOLDER, item)
-                        if os.path.isdir(item_path):
-                            folder_time = datetime.fromtimestamp(os.path.getctime(item_path))
-                            if current_time - folder_time > timedelta(hours=1):
-                                shutil.rmtree(item_path, ignore_errors=True)
-
-                if os.path.exists(self.TEMP_ZIP_FOLDER):
-                    for item in os.listdir(self.TEMP_ZIP_FOLDER):
-                        item_path = os.path.join(self.TEMP_ZIP_FOLDER, item)
-                        if os.path.isfile(item_path):
-                            file_time = datetime.fromtimestamp(os.path.getctime(item_path))
-                            if current_time - file_time > timedelta(hours=1):
-                                try:
-                                    os.remove(item_path)
-                                except:
-                                    pass
-            except:
-                pass
-            time.sleep(3600)  # 1時間ごとに実行
-
-    def process_files(self, files):
-        """ファイルを処理してZIPファイルを作成"""
+
+        # 一時ファイルの削除はプロセス内で共有するリーパーに任せる
+        # 前回の起動時に残ったものも、更新時刻から1時間で削除されるよう登録しておく
+        self.reaper = reaper or get_reaper()
+        self.reaper.adopt(self.UPLOAD_FOLDER)
+        self.reaper.adopt(self.TEMP_ZIP_FOLDER)
+
+        # 同じファイルの組み合わせから作ったZIPを使い回すキャッシュ
+        self.cache = ZipCache(self.TEMP_ZIP_FOLDER, cache_max_bytes, cache_max_age, self.reaper)
+
+    def process_files(self, files, workers=None, progress=None, digests=None):
+        """ファイルを処理してZIPファイルを作成
+
+        メンバーごとに内容を見て、無圧縮で格納するかdeflateで圧縮するかを選ぶ。
+        workersが2以上の場合、小さい圧縮するメンバーをスレッドプールで並列に圧縮する
+        （同時にメモリに読み込むのはPARALLEL_MAX_BYTESまで。zipfileの内部を使えない版のPythonでは順に書き込む）。
+        progressを渡すと、メンバーを1つ書き終えるたびに元のバイト数を引数に呼び出す。
+        digestsには受信時に計算済みの各ファイルのSHA-256を渡せる（無ければ読み直して計算する）
+
+        返すZIPはリーパーが削除しないようpinしてあるので、送り終えたら release を呼ぶ
+        """
+        if workers is None:
+            workers = self.compress_workers
+
         if not files:
             raise ValueError('ファイルが選択されていません')
 
+        # 同じファイルの組み合わせなら、作成済みのZIPをそのまま返す
+        if digests is None:
+            digests = [upload_digest(file) for file in files]
+        members = [(secure_filename(file.filename), digest or _stream_digest(file.stream))
+                   for file, digest in zip(files, digests)]
+        cache_key = ZipCache.make_key(members)
+        zip_path = self.cache.get(cache_key)
+        if zip_path is not None:
+            # cache.getがpinして返す
+            print(f"Reusing cached zip: {zip_path}")
+            metrics.count('zip_cache_hit')
+            if progress is not None:
+                for file in files:
+                    progress(_stream_size(file.stream))
+            return zip_path
+
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        temp_dir = os.path.join(self.UPLOAD_FOLDER, timestamp)
-        os.makedirs(temp_dir, exist_ok=True)
+        # 同じ秒に複数のジョブが走っても上書きしないよう、ランダムな接尾辞を付ける
+        zip_path = os.path.join(self.TEMP_ZIP_FOLDER, f'files_{timestamp}_{uuid.uuid4().hex[:8]}.zip')
+        stats = ArchiveStats(progress)
+        # キャッシュとリーパーに登録した直後に容量超過で削除されないよう、先にpinしておく
+        self.reaper.pin(zip_path)
 
         try:
-            if len(files) <= 10:
-                print("Creating uncompressed zip")
-                zip_path = os.path.join(self.TEMP_ZIP_FOLDER, f'files_{timestamp}.zip')
-                with zipfile.ZipFile(zip_path, 'w') as zipf:
-                    for file in files:
-                        print(f"Processing file: {file.filename}")
-                        filename = secure_filename(file.filename)
-                        zipf.writestr(filename, file.read())
-            else:
-                print("Creating compressed zip")
-                zip_path = os.path.join(self.TEMP_ZIP_FOLDER, f'compressed_{timestamp}.zip')
-                with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            with metrics.stage('zip_build') as timing, zipfile.ZipFile(zip_path, 'w') as zipf:
+                if workers > 1 and can_write_precompressed(zipf):
+                    self._write_parallel(zipf, files, workers, stats)
+                else:
                     for file in files:
                         print(f"Processing file: {file.filename}")
-                        filename = secure_filename(file.filename)
-                        temp_path = os.path.join(temp_dir, filename)
-                        file.save(temp_path)
-                        zipf.write(temp_path, filename)
+                        compress_type = self._choose_compression(file)
+                        self._write_member(zipf, file, compress_type, stats)
+                timing.nbytes = stats.bytes_in
+        except Exception:
+            # 書きかけのZIPは残さない
+            self.reaper.unpin(zip_path)
+            self.reaper.remove(zip_path)
+            raise
 
-            return zip_path
+        print(f"Archive stats: {stats}")
+        self.cache.put(cache_key, zip_path)
+        return zip_path
+
+    def release(self, zip_path):
+        """process_filesが返したZIPを使い終えたことを知らせる（以降はキャッシュの期限や容量で削除される）"""
+        self.reaper.unpin(zip_path)
+
+    def _choose_compression(self, file):
+        """アップロードされたファイルの先頭を見て圧縮方式を選ぶ"""
+        sample = _read_sample(file.stream)
+        return choose_compression(file.filename, sample, self.min_saving)
+
+    def _new_member(self, file, compress_type):
+        zinfo = zipfile.ZipInfo(secure_filename(file.filename), date_time=time.localtime(time.time())[:6])
+        zinfo.compress_type = compress_type
+        zinfo._compresslevel = self.compresslevel
+        zinfo.external_attr = 0o600 << 16
+        # サイズを先に入れておくと、zipfileが必要に応じてZIP64で書いてくれる
+        zinfo.file_size = _stream_size(file.stream)
+        return zinfo
+
+    def _write_member(self, zipf, file, compress_type, stats):
+        """アップロードされたファイルを一時ファイルを介さずにチャンク単位でZIPへ書き込む"""
+        zinfo = self._new_member(file, compress_type)
+        start = time.thread_time()
+        with zipf.open(zinfo, 'w') as member:
+            shutil.copyfileobj(file.stream, member, self.chunk_size)
+        cpu_time = time.thread_time() - start if compress_type == zipfile.ZIP_DEFLATED else 0.0
+        stats.add(compress_type, zinfo.file_size, zinfo.compress_size, cpu_time)
+
+    def _write_parallel(self, zipf, files, workers, stats):
+        """小さい圧縮するメンバーを並列に圧縮し、元の順番どおりにZIPへ書き込む"""
+        # zlibは圧縮中にGILを解放するので、スレッドプールで複数コアを使える
+        # メモリに読み込むのは、処理中のメンバーの合計がPARALLEL_MAX_BYTESまで
+        pending = deque()
+        pending_bytes = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for file in files:
+                print(f"Processing file: {file.filename}")
+                compress_type = self._choose_compression(file)
+                file_size = _stream_size(file.stream)
+                if compress_type != zipfile.ZIP_DEFLATED or file_size > PARALLEL_MAX_MEMBER_SIZE:
+                    # 無圧縮のものと大きいものは、順番を保つため先に待ち分を書いてから、チャンク単位で書き込む
+                    while pending:
+                        pending_bytes -= self._write_completed(zipf, pending.popleft(), stats)
+                    self._write_member(zipf, file, compress_type, stats)
+                    continue
+
+                while pending and pending_bytes + file_size > PARALLEL_MAX_BYTES:
+                    pending_bytes -= self._write_completed(zipf, pending.popleft(), stats)
+                data = file.stream.read()
+                future = executor.submit(_compress_member, data, compress_type, self.compresslevel)
+                pending.append((secure_filename(file.filename), compress_type, len(data), future))
+                pending_bytes += len(data)
+
+            while pending:
+                self._write_completed(zipf, pending.popleft(), stats)
+
+    def _write_completed(self, zipf, item, stats):
+        filename, compress_type, file_size, future = item
+        crc, data, cpu_time = future.result()
+        _write_precompressed(zipf, filename, compress_type, crc, file_size, data)
+        stats.add(compress_type, file_size, len(data), cpu_time)
+        return file_size
+
+    def stream_files(self, files):
+        """ファイルを読みながらZIPのバイト列を逐次返す（ディスクには書き込まない）"""
+        if not files:
+            raise ValueError('ファイルが選択されていません')
+        return self._generate_zip_stream(files)
 
-        finally:
-            # 一時ディレクトリの削除
-            if os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir, ignore_errors=True)
\ No newline at end of file
+    def _generate_zip_stream(self, files):
+        # 書き込み先はシーク不可なので、zipfileはデータディスクリプタ付きで各メンバーを書き出す
+        buffer = _StreamBuffer()
+        stats = ArchiveStats()
+        with zipfile.ZipFile(buffer, 'w') as zipf:
+            for file in files:
+                print(f"Streaming file: {file.filename}")
+                compress_type = self._choose_compression(file)
+                zinfo = self._new_member(file, compress_type)
+                start = time.thread_time()
+                with zipf.open(zinfo, 'w') as member:
+                    # ローカルヘッダーをすぐに送り出す
+                    yield buffer.drain()
+                    while True:
+                        chunk = file.stream.read(self.chunk_size)
+                        if not chunk:
+                            break
+                        member.write(chunk)
+                        data = buffer.drain()
+                        if data:
+                            yield data
+                cpu_time = time.thread_time() - start if compress_type == zipfile.ZIP_DEFLATED else 0.0
+                stats.add(compress_type, zinfo.file_size, zinfo.compress_size, cpu_time)
+                data = buffer.drain()
+                if data:
+                    yield data
+        # セントラルディレクトリ
+        yield buffer.drain()
+        print(f"Archive stats: {stats}")
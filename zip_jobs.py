@@ -0,0 +1,148 @@
+# zip_jobs.py
+"""ZIPファイルをバックグラウンドで作成するジョブのキュー
+
+ジョブの記録と作業用のファイルは、このプロセスのメモリとローカルディスクにだけある。
+状態の確認やダウンロードが別のプロセスに届くと見つからないので、アプリは1つの
+ワーカープロセスで動かす（app.py の起動方法を参照）
+"""
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.datastructures import FileStorage
+from werkzeug.utils import secure_filename
+
+from ingest import upload_digest
+
+
+class QueueFullError(Exception):
+    """待ちジョブが上限に達しているときに送出される"""
+
+
+class ZipJob:
+    """バックグラウンドで作成中のZIPファイル1件の状態"""
+
+    def __init__(self, job_id, total_members, total_bytes):
+        self.id = job_id
+        self.status = 'queued'
+        self.total_members = total_members
+        self.total_bytes = total_bytes
+        self.members_done = 0
+        self.bytes_done = 0
+        self.zip_path = None
+        self.error = None
+        self.created = time.time()
+
+    def update(self, file_size):
+        """メンバーを1つ書き終えるたびにZipHandlerから呼ばれる"""
+        self.members_done += 1
+        self.bytes_done += file_size
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'members_done': self.members_done,
+            'total_members': self.total_members,
+            'bytes_done': self.bytes_done,
+            'total_bytes': self.total_bytes,
+            'error': self.error,
+        }
+
+
+class ZipJobQueue:
+    """ZIP作成をリクエストスレッドから切り離して、決まった数のワーカースレッドで処理する"""
+
+    def __init__(self, zip_handler, max_workers=2, max_pending=20, job_ttl=3600):
+        self.zip_handler = zip_handler
+        self.job_ttl = job_ttl
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='zip-job')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, files):
+        """アップロードされたファイルを保存してジョブを登録し、すぐにジョブを返す"""
+        if not files:
+            raise ValueError('ファイルが選択されていません')
+        if not self._slots.acquire(blocking=False):
+            raise QueueFullError('現在混み合っています。しばらくしてから再度お試しください')
+
+        try:
+            job_id = uuid.uuid4().hex
+            # リクエスト終了後はFileStorageが閉じられるため、ジョブ用のディレクトリに退避しておく
+            job_dir = os.path.join(self.zip_handler.UPLOAD_FOLDER, job_id)
+            # 処理が終わるまでは、容量超過でもリーパーに削除させない
+            self.zip_handler.reaper.pin(job_dir)
+            os.makedirs(job_dir)
+            saved = []
+            for index, file in enumerate(files):
+                path = os.path.join(job_dir, f'{index:05d}_{secure_filename(file.filename)}')
+                file.save(path)
+                saved.append((path, file.filename, upload_digest(file)))
+            # 処理が終わらずに残ってしまっても、リーパーが期限で削除する
+            self.zip_handler.reaper.track(job_dir)
+
+            job = ZipJob(job_id, len(saved), sum(os.path.getsize(path) for path, _, _ in saved))
+            with self._lock:
+                self._prune()
+                self._jobs[job_id] = job
+            self.executor.submit(self._run, job, job_dir, saved)
+            return job
+        except Exception:
+            self.zip_handler.reaper.unpin(job_dir)
+            self.zip_handler.reaper.remove(job_dir)
+            self._slots.release()
+            raise
+
+    def get(self, job_id):
+        with self._lock:
+            self._prune()
+            return self._jobs.get(job_id)
+
+    def prune(self):
+        with self._lock:
+            self._prune()
+
+    def _run(self, job, job_dir, saved):
+        job.status = 'running'
+        files = []
+        try:
+            # 保存したファイルを開けなければ（削除された、ファイル記述子が足りないなど）、ジョブをエラーにして終える
+            try:
+                for path, filename, _ in saved:
+                    files.append(FileStorage(stream=open(path, 'rb'), filename=filename))
+            except OSError as e:
+                print(f"Error occurred in job {job.id}: {str(e)}")
+                job.error = f'アップロードされたファイルを読み込めませんでした: {str(e)}'
+                job.status = 'failed'
+                return
+            # 受信時に計算したダイジェストを渡し、キャッシュのキーを作るための読み直しを省く
+            digests = [digest for _, _, digest in saved]
+            zip_path = self.zip_handler.process_files(files, progress=job.update, digests=digests)
+            # できたZIPはprocess_filesがpinしたまま返す。ジョブの記録を消すまで削除させない
+            job.zip_path = zip_path
+            job.status = 'done'
+        except Exception as e:
+            print(f"Error occurred in job {job.id}: {str(e)}")
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            for file in files:
+                file.close()
+            self.zip_handler.reaper.unpin(job_dir)
+            self.zip_handler.reaper.remove(job_dir)
+            self._slots.release()
+            # 次のリクエストが来なくても、期限が来たらZIPのpinを外す
+            timer = threading.Timer(max(0.0, job.created + self.job_ttl - time.time()) + 1, self.prune)
+            timer.daemon = True
+            timer.start()
+
+    def _prune(self):
+        """一定時間が過ぎたジョブの記録を削除（ZIPファイル自体はpinを外し、リーパーが削除する）"""
+        expired = time.time() - self.job_ttl
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.created < expired]:
+            job = self._jobs.pop(job_id)
+            if job.zip_path is not None:
+                self.zip_handler.release(job.zip_path)